@@ -0,0 +1,70 @@
+import os
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from common import PromptCacheRequest, npu_scheduler, global_state, inject_tool_prompt, request_priority
+from scheduler import Priority, QueueRejected
+from utils import apply_chat_template
+from prompt_cache import prompt_caches
+from image_store import image_store
+from rkllm import save_RKLLM_prompt_cache
+
+router = APIRouter()
+
+def cache_disabled_response():
+    return JSONResponse(status_code=404, content={"error": {"message": "Prompt cache library is disabled (start with --prompt_cache_dir)", "type": "invalid_request_error", "code": "prompt_cache_disabled"}})
+
+@router.get("/v1/prompt_caches")
+def list_prompt_caches():
+    if not prompt_caches.enabled:
+        return cache_disabled_response()
+    return JSONResponse(content={
+        "object": "list",
+        "data": [e.to_dict() for e in prompt_caches.entries()],
+        "total_bytes": prompt_caches.total_bytes(),
+        "max_bytes": prompt_caches.max_bytes
+    })
+
+@router.post("/v1/prompt_caches")
+async def create_prompt_cache(request: PromptCacheRequest, http_request: Request):
+    """Prefills a system prompt and/or tool block once and saves it for reuse by later requests."""
+    if not prompt_caches.enabled:
+        return cache_disabled_response()
+
+    messages = list(request.messages)
+    if request.system:
+        messages.insert(0, {"role": "system", "content": request.system})
+    if request.tools:
+        messages = inject_tool_prompt(messages, request.tools)
+    if not messages:
+        return JSONResponse(status_code=400, content={"error": {"message": "Nothing to cache", "type": "invalid_request_error", "code": "empty_prefix"}})
+
+    await image_store.put_inline(messages)
+    prefix = apply_chat_template(messages, thinking=request.think, add_generation_prompt=False)
+    key = prompt_caches.key(prefix)
+    entry = prompt_caches.get(key)
+    if entry is not None:
+        prompt_caches.touch(entry)
+        return JSONResponse(content={**entry.to_dict(), "created": False})
+
+    try:
+        ticket = await npu_scheduler.acquire(request_priority(http_request, Priority.BACKGROUND))
+    except QueueRejected as e:
+        return JSONResponse(status_code=503, headers=e.headers(),
+                            content={"error": {"message": "Server busy", "type": "server_error", "code": e.reason}})
+    try:
+        ok = await save_RKLLM_prompt_cache(global_state.rkllm_model, prefix, prompt_caches.path(key))
+    finally:
+        ticket.release()
+
+    if not ok or not os.path.exists(prompt_caches.path(key)):
+        return JSONResponse(status_code=500, content={"error": {"message": "RKLLM runtime did not save the prompt cache", "type": "server_error", "code": "internal_error"}})
+    entry = prompt_caches.add(prefix, label=request.label)
+    return JSONResponse(headers=ticket.headers(), content={**entry.to_dict(), "created": True})
+
+@router.delete("/v1/prompt_caches/{key}")
+def delete_prompt_cache(key: str):
+    if not prompt_caches.enabled:
+        return cache_disabled_response()
+    if not prompt_caches.remove(key):
+        return JSONResponse(status_code=404, content={"error": {"message": f"Prompt cache {key} not found", "type": "invalid_request_error", "code": "not_found"}})
+    return JSONResponse(content={"id": key, "deleted": True})
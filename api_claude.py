@@ -1,76 +1,184 @@
 import os
 import json
 import time
+import uuid
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, StreamingResponse
-from common import hw_lock, global_state
-from utils import apply_chat_template
+from starlette.background import BackgroundTask
+from common import npu_scheduler, global_state, request_priority, request_timeout
+from scheduler import Priority, QueueRejected, iterate_with_ticket
+from singleflight import flights
+from session import plan_session, prepare_prompt_cache
+from tools import tool_registry, tool_call_text, tool_response_text
 from rkllm import get_RKLLM_output
+from vision_encoder import ImageError, vision_encoder
+from image_store import image_store
+from completion_cache import completion_cache, replay_tokens
+from limits import GenerationLimits
+from stream_encoder import TOKEN, sse, frames
+from stream_parser import CONTENT, TOOL_CALL, StreamParser, parse_stream, parse_text
+from sampling import SamplingError, resolve_sampling, sampling_headers, pick
 
 router = APIRouter()
 
+def has_cache_control(blocks) -> bool:
+    return any(isinstance(b, dict) and b.get("cache_control") for b in blocks)
+
+def block_text(block: dict) -> str:
+    """Text of a content block; tool_use and tool_result blocks become the model's own tool markup."""
+    if block["type"] == "tool_use":
+        return tool_call_text(block.get("name", ""), block.get("input", {}))
+    if block["type"] == "tool_result":
+        return tool_response_text(block.get("content", ""))
+    return block.get("text", "")
+
 @router.post("/v1/messages")
 async def anthropic_messages(request: Request):
     body = await request.json()
     stream = body.get("stream", False)
 
-    # Convert Anthropic messages format to flat list
+    # Convert Anthropic messages format to flat list.
+    # cache_control blocks mark the end of a prefix to keep as a prompt cache;
+    # the cache covers every message up to the last marked one.
     messages = []
+    cache_breakpoint = None
     system_prompt = body.get("system", "")
     if system_prompt:
         if isinstance(system_prompt, list):
+            if has_cache_control(system_prompt):
+                cache_breakpoint = 0
             system_prompt = " ".join(b.get("text", "") for b in system_prompt if isinstance(b, dict))
         messages.append({"role": "system", "content": system_prompt})
     for msg in body.get("messages", []):
         content = msg.get("content", "")
         if isinstance(content, list):
-            content = " ".join(b.get("text", "") for b in content if isinstance(b, dict) and b.get("type") == "text")
+            if has_cache_control(content):
+                cache_breakpoint = len(messages)
+            images = [b for b in content if isinstance(b, dict) and b.get("type") == "image"]
+            content = " ".join(block_text(b) for b in content if isinstance(b, dict) and b.get("type") in ("text", "tool_use", "tool_result"))
+            if images:
+                # Image blocks are rendered by apply_chat_template through the image store
+                content = images + [{"type": "text", "text": content}]
         messages.append({"role": msg["role"], "content": content})
+    messages, tool_set = tool_registry.prepare(messages, body.get("tools"))
+    if tool_set is not None:
+        if not system_prompt and cache_breakpoint is not None:
+            # prepare() put a new system message in front
+            cache_breakpoint += 1
+        if cache_breakpoint is None:
+            cache_breakpoint = tool_registry.breakpoint(messages, tool_set)
 
     model_name = body.get("model", os.path.basename(global_state.model_path) if global_state.model_path else "rkllm")
     msg_id = f"msg_{int(time.time())}"
+    # Extended thinking is opt-in, as in the Anthropic API
+    thinking = (body.get("thinking") or {}).get("type") == "enabled"
+    limits = GenerationLimits(max_tokens=body.get("max_tokens"), stop=body.get("stop_sequences"),
+                              timeout=request_timeout(request))
+    # Inline images are decoded off the event loop before the request is rendered
+    await image_store.put_inline(messages)
+    try:
+        sampling, adjusted = resolve_sampling(global_state.rkllm_model, pick(body, ("temperature", "top_p", "top_k")))
+        vision_encoder.check(messages)
+    except (SamplingError, ImageError) as e:
+        return JSONResponse(status_code=400, content={"type": "error", "error": {"type": "invalid_request_error", "message": str(e)}})
 
-    if stream:
-        def stream_generator():
-            if not hw_lock.acquire(blocking=True, timeout=30):
-                yield f"event: error\ndata: {json.dumps({'type':'error','error':{'type':'overloaded_error','message':'Server busy'}})}\n\n"
-                return
-            try:
-                messages_formatted = apply_chat_template(messages, thinking=False)
-                results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-                yield f"event: message_start\ndata: {json.dumps({'type':'message_start','message':{'id':msg_id,'type':'message','role':'assistant','content':[],'model':model_name,'stop_reason':None,'usage':{'input_tokens':0,'output_tokens':1}}})}\n\n"
-                yield f"event: content_block_start\ndata: {json.dumps({'type':'content_block_start','index':0,'content_block':{'type':'text','text':''}})}\n\n"
-                yield "event: ping\ndata: {\"type\":\"ping\"}\n\n"
-                output_tokens = 0
-                try:
-                    for token in results:
-                        output_tokens += 1
-                        yield f"event: content_block_delta\ndata: {json.dumps({'type':'content_block_delta','index':0,'delta':{'type':'text_delta','text':token}})}\n\n"
-                except Exception:
-                    pass
-                finally:
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type':'content_block_stop','index':0})}\n\n"
-                    yield f"event: message_delta\ndata: {json.dumps({'type':'message_delta','delta':{'stop_reason':'end_turn','stop_sequence':None},'usage':{'output_tokens':output_tokens}})}\n\n"
-                    yield "event: message_stop\ndata: {\"type\":\"message_stop\"}\n\n"
-            finally:
-                hw_lock.release()
-        return StreamingResponse(stream_generator(), media_type="text/event-stream")
+    def event(name, payload):
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
 
-    if not hw_lock.acquire(blocking=True, timeout=30):
-        return JSONResponse(status_code=529, content={"type": "error", "error": {"type": "overloaded_error", "message": "Server busy"}})
-    try:
-        messages_formatted = apply_chat_template(messages, thinking=False)
-        results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-        full_text = "".join(list(results))
-        return JSONResponse(content={
+    async def stream_generator(results, outcome):
+        yield event("message_start", {'type':'message_start','message':{'id':msg_id,'type':'message','role':'assistant','content':[],'model':model_name,'stop_reason':None,'usage':{'input_tokens':0,'output_tokens':1}}})
+        yield "event: ping\ndata: {\"type\":\"ping\"}\n\n"
+        # Content blocks are opened as the parser switches between text, thinking and tool calls
+        index, block, block_delta = 0, None, None
+        parser = StreamParser(thinking)
+        try:
+            async for kind, value in parse_stream(frames(results), parser=parser):
+                if block is not None and block != kind:
+                    yield event("content_block_stop", {'type':'content_block_stop','index':index})
+                    index, block = index + 1, None
+                if kind == TOOL_CALL:
+                    yield event("content_block_start", {'type':'content_block_start','index':index,'content_block':{'type':'tool_use','id':f"toolu_{uuid.uuid4().hex[:24]}",'name':value['name'],'input':{}}})
+                    yield event("content_block_delta", {'type':'content_block_delta','index':index,'delta':{'type':'input_json_delta','partial_json':json.dumps(value['arguments'])}})
+                    yield event("content_block_stop", {'type':'content_block_stop','index':index})
+                    index += 1
+                    continue
+                if block is None:
+                    start, delta = ({'type':'text','text':''}, {'type':'text_delta','text':TOKEN}) if kind == CONTENT else \
+                        ({'type':'thinking','thinking':''}, {'type':'thinking_delta','thinking':TOKEN})
+                    yield event("content_block_start", {'type':'content_block_start','index':index,'content_block':start})
+                    block, block_delta = kind, sse({'type':'content_block_delta','index':index,'delta':delta}, event="content_block_delta")
+                yield block_delta(value)
+        except Exception as e:
+            # Headers are gone already; Anthropic streams report failures as an error event instead of a stop
+            print(f"[Error] Anthropic stream failed: {e}")
+            yield event("error", {'type':'error','error':{'type':'api_error','message':str(e) or type(e).__name__}})
+            return
+        if block is None and index == 0:
+            yield event("content_block_start", {'type':'content_block_start','index':0,'content_block':{'type':'text','text':''}})
+            block = CONTENT
+        if block is not None:
+            yield event("content_block_stop", {'type':'content_block_stop','index':index})
+        stop_reason = "tool_use" if parser.tool_calls and outcome.anthropic_stop_reason == "end_turn" else outcome.anthropic_stop_reason
+        yield event("message_delta", {'type':'message_delta','delta':{'stop_reason':stop_reason,'stop_sequence':outcome.stop_sequence},'usage':{'input_tokens':outcome.prompt_tokens,'output_tokens':outcome.completion_tokens}})
+        yield "event: message_stop\ndata: {\"type\":\"message_stop\"}\n\n"
+
+    def build_response(full_text, outcome, headers):
+        text, thinking_text, tool_calls = parse_text(full_text, thinking)
+        content = [{"type": "thinking", "thinking": thinking_text}] if thinking_text else []
+        if text or not tool_calls:
+            content.append({"type": "text", "text": text})
+        content += [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": call["name"], "input": call["arguments"]}
+                    for call in tool_calls]
+        stop_reason = "tool_use" if tool_calls and outcome.anthropic_stop_reason == "end_turn" else outcome.anthropic_stop_reason
+        return JSONResponse(headers=headers, content={
             "id": msg_id,
             "type": "message",
             "role": "assistant",
-            "content": [{"type": "text", "text": full_text}],
+            "content": content,
             "model": model_name,
-            "stop_reason": "end_turn",
-            "stop_sequence": None,
-            "usage": {"input_tokens": 0, "output_tokens": len(full_text.split())}
+            "stop_reason": stop_reason,
+            "stop_sequence": outcome.stop_sequence,
+            "usage": {"input_tokens": outcome.prompt_tokens, "output_tokens": outcome.completion_tokens}
         })
-    finally:
-        hw_lock.release()
\ No newline at end of file
+
+    cache_key = completion_cache.key_for(global_state.rkllm_model, global_state.model_path, messages, thinking=thinking,
+                                         limits=limits, sampling=sampling)
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+        headers = {**completion_cache.headers(cache_key, "hit"), **sampling_headers(adjusted)}
+        if stream:
+            return StreamingResponse(stream_generator(replay_tokens(cached, limits), limits), headers=headers,
+                                     media_type="text/event-stream")
+        limits.restore(cached)
+        return build_response("".join(cached["tokens"]), limits, headers)
+
+    async def start_generation():
+        # Image encoding runs on its own thread, overlapping the wait for the NPU
+        vision_encoder.prefetch(messages)
+        ticket = await npu_scheduler.acquire(request_priority(request, Priority.INTERACTIVE))
+        try:
+            plan = plan_session(global_state.rkllm_model, messages, thinking=thinking, cache_breakpoint=cache_breakpoint)
+            await prepare_prompt_cache(global_state.rkllm_model, plan)
+        except BaseException:
+            ticket.release()
+            raise
+        results = get_RKLLM_output(global_state.rkllm_model, plan.prompt, session=plan, limits=limits,
+                                   on_complete=lambda tokens: completion_cache.put(cache_key, tokens, limits))
+        return {**ticket.headers(), **plan.headers()}, iterate_with_ticket(ticket, results)
+
+    flight, shared = flights.attach(limits.flight_key(cache_key), start_generation, limits)
+    try:
+        headers = {**await flight.ready(), **completion_cache.headers(cache_key, "shared" if shared else "miss"),
+                   **sampling_headers(adjusted)}
+    except QueueRejected as e:
+        return JSONResponse(status_code=529, headers=e.headers(),
+                            content={"type": "error", "error": {"type": "overloaded_error", "message": "Server busy"}})
+
+    if stream:
+        subscription = flight.subscribe()
+        # Leaves the shared generation even if the body is never iterated
+        return StreamingResponse(stream_generator(subscription, flight.limits), headers=headers,
+                                 media_type="text/event-stream", background=BackgroundTask(subscription.aclose))
+
+    full_text = "".join([r async for r in flight.subscribe()])
+    return build_response(full_text, flight.limits, headers)
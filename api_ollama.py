@@ -1,66 +1,127 @@
 import os
 import json
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from datetime import datetime, timezone
-from common import ChatRequest, ChatResponse, ResponseMessage, hw_lock, global_state, inject_tool_prompt, parse_model_output
-from utils import apply_chat_template
+from common import ChatRequest, ChatResponse, ResponseMessage, npu_scheduler, global_state, parse_model_output, request_priority, request_timeout
+from scheduler import Priority, QueueRejected, iterate_with_ticket
+from singleflight import flights
+from session import plan_session, prepare_prompt_cache
+from tools import tool_registry
 from rkllm import get_RKLLM_output
+from vision_encoder import ImageError, vision_encoder
+from image_store import image_store
+from completion_cache import completion_cache, replay_tokens
+from limits import GenerationLimits
+from stream_encoder import TOKEN, ndjson, frames
+from stream_parser import CONTENT, THINKING, parse_stream
+from sampling import SamplingError, resolve_sampling, sampling_headers, pick
 
 router = APIRouter()
 
-@router.post("/api/chat")
-def chat_endpoint(request: ChatRequest):
-    if request.stream:
-        def stream_generator():
-            if not hw_lock.acquire(blocking=True, timeout=30):
-                yield json.dumps({"error": "Server busy"}) + "\n"
-                return
-            try:
-                messages = request.messages
-                if request.tools:
-                    messages = inject_tool_prompt(messages, request.tools)
-                messages_formatted = apply_chat_template(messages, thinking=request.think)
-                results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-                for r in results:
-                    yield json.dumps({
-                        "model": request.model if hasattr(request, 'model') else "rkllm",
-                        "created_at": datetime.now(timezone.utc).isoformat() + "Z",
-                        "message": {"role": "assistant", "content": r},
-                        "done": False
-                    }) + "\n"
-                yield json.dumps({
-                    "model": request.model if hasattr(request, 'model') else "rkllm",
-                        "created_at": datetime.now(timezone.utc).isoformat() + "Z",
-                        "message": {"role": "assistant", "content": ""},
-                        "done": True
-                    }) + "\n"
-            finally:
-                hw_lock.release()
-        return StreamingResponse(stream_generator(), media_type="application/x-ndjson")
+def ollama_usage(outcome) -> dict:
+    """Ollama's token counts and durations (ns); the durations are the runtime's own prefill and decode times."""
+    return {"eval_count": outcome.completion_tokens, "prompt_eval_count": outcome.prompt_tokens,
+            "prompt_eval_duration": int(outcome.prefill_ms * 1e6), "eval_duration": int(outcome.generate_ms * 1e6)}
 
-    if not hw_lock.acquire(blocking=True, timeout=30):
-        raise HTTPException(status_code=503, detail="RKLLM Hardware is currently processing another request.")
+@router.post("/api/chat")
+async def chat_endpoint(request: ChatRequest, http_request: Request):
+    messages, tool_set = tool_registry.prepare(request.messages, request.tools)
+    options = request.options or {}
+    limits = GenerationLimits(max_tokens=options.get("num_predict"), stop=options.get("stop"),
+                              timeout=request_timeout(http_request))
+    # Inline images are decoded off the event loop before the request is rendered
+    await image_store.put_inline(messages)
     try:
-        messages = request.messages
-        if request.tools:
-            messages = inject_tool_prompt(messages, request.tools)
-        messages_formatted = apply_chat_template(messages, thinking=request.think)
-        results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-        full_text = "".join(list(results))
-        clean_content, thinking_content, _ = parse_model_output(full_text, request.think is not False)
-        resp_msg = ResponseMessage(role="assistant", content=clean_content)
+        sampling, adjusted = resolve_sampling(global_state.rkllm_model, pick(options))
+        vision_encoder.check(messages)
+    except (SamplingError, ImageError) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    async def stream_generator(results, outcome):
+        model = request.model if hasattr(request, 'model') else "rkllm"
+        # One timestamp for the token chunks; rendering it per token costs more than the token itself
+        created_at = datetime.now(timezone.utc).isoformat() + "Z"
+        content_chunk = ndjson({"model": model, "created_at": created_at,
+                                "message": {"role": "assistant", "content": TOKEN}, "done": False})
+        thinking_chunk = ndjson({"model": model, "created_at": created_at,
+                                 "message": {"role": "assistant", "content": "", "thinking": TOKEN}, "done": False})
+        async for kind, value in parse_stream(frames(results), request.think is not False):
+            if kind == CONTENT:
+                yield content_chunk(value)
+            elif kind == THINKING:
+                yield thinking_chunk(value)
+            else:
+                yield json.dumps({"model": model, "created_at": created_at, "done": False,
+                                  "message": {"role": "assistant", "content": "", "tool_calls": [{"function": value}]}}) + "\n"
+        yield json.dumps({
+            "model": model,
+                "created_at": datetime.now(timezone.utc).isoformat() + "Z",
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                "done_reason": outcome.ollama_done_reason,
+                **ollama_usage(outcome)
+            }) + "\n"
+
+    def build_response(full_text, outcome, headers):
+        clean_content, thinking_content, tool_calls = parse_model_output(full_text, request.think is not False)
+        resp_msg = ResponseMessage(role="assistant", content=clean_content, tool_calls=tool_calls or None)
         if thinking_content:
             resp_msg.thinking = thinking_content
         response_data = ChatResponse(
             model=request.model if hasattr(request, 'model') else "rkllm",
             created_at=datetime.now(timezone.utc).isoformat() + "Z",
             message=resp_msg,
-            done=True
+            done=True,
+            done_reason=outcome.ollama_done_reason,
+            **ollama_usage(outcome)
         ).model_dump(exclude_none=True)
-        return JSONResponse(content=response_data)
-    finally:
-        hw_lock.release()
+        return JSONResponse(headers=headers, content=response_data)
+
+    cache_key = completion_cache.key_for(global_state.rkllm_model, global_state.model_path, messages,
+                                         thinking=request.think, limits=limits, sampling=sampling)
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+        headers = {**completion_cache.headers(cache_key, "hit"), **sampling_headers(adjusted)}
+        if request.stream:
+            return StreamingResponse(stream_generator(replay_tokens(cached, limits), limits), headers=headers,
+                                     media_type="application/x-ndjson")
+        limits.restore(cached)
+        return build_response("".join(cached["tokens"]), limits, headers)
+
+    async def start_generation():
+        # Image encoding runs on its own thread, overlapping the wait for the NPU
+        vision_encoder.prefetch(messages)
+        ticket = await npu_scheduler.acquire(request_priority(http_request, Priority.INTERACTIVE))
+        try:
+            # The tool block is kept as a prompt cache, so other requests with the same tools skip its prefill
+            plan = plan_session(global_state.rkllm_model, messages, thinking=request.think,
+                                cache_breakpoint=tool_registry.breakpoint(messages, tool_set))
+            await prepare_prompt_cache(global_state.rkllm_model, plan, label=f"tools:{tool_set.key}" if tool_set else "")
+        except BaseException:
+            ticket.release()
+            raise
+        results = get_RKLLM_output(global_state.rkllm_model, plan.prompt, session=plan, limits=limits,
+                                   on_complete=lambda tokens: completion_cache.put(cache_key, tokens, limits))
+        return {**ticket.headers(), **plan.headers()}, iterate_with_ticket(ticket, results)
+
+    flight, shared = flights.attach(limits.flight_key(cache_key), start_generation, limits)
+    try:
+        headers = {**await flight.ready(), **completion_cache.headers(cache_key, "shared" if shared else "miss"),
+                   **sampling_headers(adjusted)}
+    except QueueRejected as e:
+        return JSONResponse(status_code=503, headers=e.headers(),
+                            content={"error": "RKLLM Hardware is currently processing another request."})
+
+    if request.stream:
+        subscription = flight.subscribe()
+        # Leaves the shared generation even if the body is never iterated
+        return StreamingResponse(stream_generator(subscription, flight.limits), headers=headers,
+                                 media_type="application/x-ndjson", background=BackgroundTask(subscription.aclose))
+
+    full_text = "".join([r async for r in flight.subscribe()])
+    return build_response(full_text, flight.limits, headers)
 
 @router.get("/api/version")
 def ollama_version():
@@ -1,88 +1,200 @@
 import os
 import json
 import time
-from fastapi import APIRouter
+import uuid
+from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, StreamingResponse
-from datetime import datetime, timezone
-from common import ChatRequest, EmbeddingRequest, hw_lock, global_state
-from utils import apply_chat_template, make_llm_response
-from rkllm import get_RKLLM_output, get_RKLLM_embeddings
+from starlette.background import BackgroundTask
+from common import ChatRequest, EmbeddingRequest, npu_scheduler, global_state, request_priority, request_timeout
+from scheduler import Priority, QueueRejected, iterate_with_ticket
+from singleflight import flights
+from utils import make_llm_response
+from session import plan_session, prepare_prompt_cache
+from tools import tool_registry
+from rkllm import get_RKLLM_output
+from vision_encoder import ImageError, vision_encoder
+from image_store import image_store
+from embeddings import postprocess, encode, chunk_spans, aggregate
+from embedding_cache import get_cached_embeddings
+from completion_cache import completion_cache, replay_tokens
+from limits import GenerationLimits
+from stream_encoder import TOKEN, sse, frames
+from stream_parser import CONTENT, THINKING, StreamParser, parse_stream, parse_text
+from sampling import SamplingError, resolve_sampling, sampling_headers, pick
 
 router = APIRouter()
 
+# Room left in the context for the runtime's own special tokens when chunking embeddings
+CHUNK_MARGIN_TOKENS = 16
+
+def busy_response(e: QueueRejected):
+    return JSONResponse(
+        status_code=503,
+        headers=e.headers(),
+        content={"error": {"message": "Server busy", "type": "server_error", "code": e.reason}}
+    )
+
+def openai_tool_call(call: dict, index: int = None) -> dict:
+    """A parsed <tool_call> in OpenAI form; stream deltas also carry the call's index."""
+    arguments = call["arguments"]
+    tool_call = {
+        "id": f"call_{uuid.uuid4().hex[:24]}",
+        "type": "function",
+        "function": {"name": call["name"], "arguments": arguments if isinstance(arguments, str) else json.dumps(arguments)}
+    }
+    return tool_call if index is None else {"index": index, **tool_call}
+
+def openai_usage(outcome) -> dict:
+    return {"prompt_tokens": outcome.prompt_tokens, "completion_tokens": outcome.completion_tokens,
+            "total_tokens": outcome.total_tokens}
+
 @router.post("/v1/embeddings")
-def openai_embeddings(request: EmbeddingRequest):
-    if not hw_lock.acquire(blocking=False):
-        return JSONResponse(
-            status_code=503,
-            content={"error": {"message": "Server busy", "type": "server_error", "code": "server_busy"}}
-        )
+async def openai_embeddings(request: EmbeddingRequest, http_request: Request):
+    inputs = request.input if isinstance(request.input, list) else [request.input]
 
-    try:
-        inputs = request.input if isinstance(request.input, list) else [request.input]
-        data_results = []
-
-        for idx, text in enumerate(inputs):
-            vector = get_RKLLM_embeddings(global_state.rkllm_model, text)
-
-            data_results.append({
-                "object": "embedding",
-                "embedding": vector,
-                "index": idx
-            })
-
-        return JSONResponse(content={
-            "object": "list",
-            "data": data_results,
-            "model": request.model,
-            "usage": {
-                "prompt_tokens": 0,
-                "total_tokens": 0
-            }
-        })
+    # Split over-long inputs into overlapping windows; every window is embedded (and cached) on its own
+    max_window = global_state.rkllm_model.max_context_len - CHUNK_MARGIN_TOKENS
+    window = min(request.chunk_size or max_window, max_window)
+    spans = [chunk_spans(text, window, request.chunk_overlap) for text in inputs]
+    pieces = [text[start:end] for text, text_spans in zip(inputs, spans) for start, end in text_spans]
 
+    usage = {"prompt_tokens": 0}
+    try:
+        vectors, cached, headers = await get_cached_embeddings(
+            global_state.rkllm_model, global_state.model_path, pieces, request.pooling,
+            request_priority(http_request, Priority.BACKGROUND), usage=usage)
+    except QueueRejected as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": {"message": str(e), "type": "server_error", "code": "internal_error"}}
         )
-    finally:
-        hw_lock.release()
+
+    data_results = []
+    offset = 0
+    for idx, text_spans in enumerate(spans):
+        chunk_vectors = vectors[offset:offset + len(text_spans)]
+        offset += len(text_spans)
+        item = {"object": "embedding", "index": idx}
+
+        if len(text_spans) > 1 and request.aggregate == "none":
+            item["chunks"] = [{
+                "embedding": encode(postprocess(vector, request.dimensions, request.normalize),
+                                    request.encoding_format, request.dtype),
+                "start": start,
+                "end": end
+            } for vector, (start, end) in zip(chunk_vectors, text_spans)]
+        else:
+            vector = chunk_vectors[0] if len(text_spans) == 1 else aggregate(
+                chunk_vectors, [end - start for start, end in text_spans], request.aggregate)
+            item["embedding"] = encode(postprocess(vector, request.dimensions, request.normalize),
+                                       request.encoding_format, request.dtype)
+        data_results.append(item)
+
+    return JSONResponse(headers=headers, content={
+        "object": "list",
+        "data": data_results,
+        "model": request.model,
+        "usage": {
+            "prompt_tokens": usage["prompt_tokens"],
+            "total_tokens": usage["prompt_tokens"],
+            "cached_inputs": cached
+        }
+    })
 
 @router.post("/v1/chat/completions")
-async def openai_chat_completions(request: ChatRequest):
+async def openai_chat_completions(request: ChatRequest, http_request: Request):
     created_time = int(time.time())
+    messages, tool_set = tool_registry.prepare(request.messages, request.tools)
     model_name = os.path.basename(global_state.model_path) if global_state.model_path else "rkllm"
-
-    if request.stream:
-        def stream_generator():
-            if not hw_lock.acquire(blocking=True, timeout=30):
-                yield f"data: {json.dumps({'error': {'message': 'Server busy', 'type': 'server_error', 'code': 'server_busy'}})}\n\n"
-                return
-            try:
-                messages_formatted = apply_chat_template(request.messages)
-                results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-                for r in results:
-                    yield f"data: {json.dumps({'id': f'chatcmpl-{created_time}', 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': 0, 'delta': {'content': r}, 'finish_reason': None}]})}\n\n"
-                yield "data: [DONE]\n\n"
-            finally:
-                hw_lock.release()
-        return StreamingResponse(stream_generator(), media_type="text/event-stream")
-
-    if not hw_lock.acquire(blocking=True, timeout=30):
-        return JSONResponse(status_code=503, content={"error": {"message": "Server is busy", "type": "server_error", "code": "server_busy"}})
+    limits = GenerationLimits(max_tokens=request.max_completion_tokens or request.max_tokens, stop=request.stop,
+                              timeout=request_timeout(http_request))
+    try:
+        sampling, adjusted = resolve_sampling(global_state.rkllm_model, pick(request.model_dump()))
+    except SamplingError as e:
+        return JSONResponse(status_code=400, content={"error": {"message": str(e), "type": "invalid_request_error", "code": "unsupported_sampling"}})
+    # Inline images are decoded off the event loop before the request is rendered
+    await image_store.put_inline(messages)
     try:
-        messages_formatted = apply_chat_template(request.messages)
-        results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-        rkllm_output = "".join(list(results))
-        response_data = make_llm_response(rkllm_output)
+        vision_encoder.check(messages)
+    except ImageError as e:
+        return JSONResponse(status_code=400, content={"error": {"message": str(e), "type": "invalid_request_error", "code": "invalid_image"}})
+
+    async def stream_generator(results, outcome):
+        chunk = {'id': f'chatcmpl-{created_time}', 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name}
+        content_chunk = sse({**chunk, 'choices': [{'index': 0, 'delta': {'content': TOKEN}, 'finish_reason': None}]})
+        thinking_chunk = sse({**chunk, 'choices': [{'index': 0, 'delta': {'reasoning_content': TOKEN}, 'finish_reason': None}]})
+        parser = StreamParser()
+        async for kind, value in parse_stream(frames(results), parser=parser):
+            if kind == CONTENT:
+                yield content_chunk(value)
+            elif kind == THINKING:
+                yield thinking_chunk(value)
+            else:
+                # Sent whole as soon as </tool_call> arrives, while the model may still be writing
+                yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {'tool_calls': [openai_tool_call(value, parser.tool_calls - 1)]}, 'finish_reason': None}]})}\n\n"
+        finish_reason = "tool_calls" if parser.tool_calls and outcome.openai_finish_reason == "stop" else outcome.openai_finish_reason
+        yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]})}\n\n"
+        if (request.stream_options or {}).get("include_usage"):
+            yield f"data: {json.dumps({**chunk, 'choices': [], 'usage': openai_usage(outcome)})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def build_response(rkllm_output, outcome, headers):
+        content, reasoning, calls = parse_text(rkllm_output)
+        tool_calls = [openai_tool_call(call) for call in calls]
+        finish_reason = "tool_calls" if tool_calls and outcome.openai_finish_reason == "stop" else outcome.openai_finish_reason
+        response_data = make_llm_response(content, finish_reason, outcome.completion_tokens, reasoning, tool_calls,
+                                          prompt_tokens=outcome.prompt_tokens)
         response_data["created"] = created_time
         response_data["model"] = model_name
-        return JSONResponse(content=response_data)
+        return JSONResponse(headers=headers, content=response_data)
+
+    # Greedy decoding makes identical prompts produce identical replies; serve repeats without the NPU
+    cache_key = completion_cache.key_for(global_state.rkllm_model, global_state.model_path, messages,
+                                         limits=limits, sampling=sampling)
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+        headers = {**completion_cache.headers(cache_key, "hit"), **sampling_headers(adjusted)}
+        if request.stream:
+            return StreamingResponse(stream_generator(replay_tokens(cached, limits), limits), headers=headers,
+                                     media_type="text/event-stream")
+        limits.restore(cached)
+        return build_response("".join(cached["tokens"]), limits, headers)
+
+    async def start_generation():
+        # Image encoding runs on its own thread, overlapping the wait for the NPU
+        vision_encoder.prefetch(messages)
+        ticket = await npu_scheduler.acquire(request_priority(http_request, Priority.INTERACTIVE))
+        try:
+            plan = plan_session(global_state.rkllm_model, messages, cache_breakpoint=tool_registry.breakpoint(messages, tool_set))
+            await prepare_prompt_cache(global_state.rkllm_model, plan, label=f"tools:{tool_set.key}" if tool_set else "")
+        except BaseException:
+            ticket.release()
+            raise
+        results = get_RKLLM_output(global_state.rkllm_model, plan.prompt, session=plan, limits=limits,
+                                   on_complete=lambda tokens: completion_cache.put(cache_key, tokens, limits))
+        return {**ticket.headers(), **plan.headers()}, iterate_with_ticket(ticket, results)
+
+    # Identical requests arriving while this one runs share its generation
+    flight, shared = flights.attach(limits.flight_key(cache_key), start_generation, limits)
+    try:
+        headers = {**await flight.ready(), **completion_cache.headers(cache_key, "shared" if shared else "miss"),
+                   **sampling_headers(adjusted)}
+    except QueueRejected as e:
+        return busy_response(e)
+
+    if request.stream:
+        subscription = flight.subscribe()
+        # Leaves the shared generation even if the body is never iterated
+        return StreamingResponse(stream_generator(subscription, flight.limits), headers=headers,
+                                 media_type="text/event-stream", background=BackgroundTask(subscription.aclose))
+
+    try:
+        rkllm_output = "".join([r async for r in flight.subscribe()])
+        return build_response(rkllm_output, flight.limits, headers)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": {"message": str(e), "type": "server_error", "code": "internal_error"}})
-    finally:
-        hw_lock.release()
 
 @router.get("/v1/models")
 def list_openai_models():
@@ -0,0 +1,138 @@
+import asyncio
+import functools
+
+import numpy as np
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from common import (CollectionRequest, UpsertRequest, DeleteDocumentsRequest, SearchRequest,
+                    global_state, request_priority)
+from scheduler import Priority, QueueRejected
+from embeddings import chunk_spans, aggregate
+from embedding_cache import get_cached_embeddings
+from vector_index import VectorShapeError, vector_index
+from api_openai import busy_response, CHUNK_MARGIN_TOKENS
+
+router = APIRouter()
+
+def error_response(status_code: int, message: str, code: str):
+    return JSONResponse(status_code=status_code, content={"error": {"message": message, "type": "invalid_request_error", "code": code}})
+
+def collection_not_found(name: str):
+    return error_response(404, f"Collection {name} not found", "not_found")
+
+async def embed_texts(texts: list, pooling: str, priority: Priority):
+    """Embeds whole documents, averaging the windows of ones longer than the context."""
+    window = global_state.rkllm_model.max_context_len - CHUNK_MARGIN_TOKENS
+    spans = [chunk_spans(text, window, 64) for text in texts]
+    pieces = [text[start:end] for text, text_spans in zip(texts, spans) for start, end in text_spans]
+    vectors, cached, headers = await get_cached_embeddings(
+        global_state.rkllm_model, global_state.model_path, pieces, pooling, priority)
+
+    results = []
+    offset = 0
+    for text_spans in spans:
+        chunk_vectors = vectors[offset:offset + len(text_spans)]
+        offset += len(text_spans)
+        if len(chunk_vectors) == 1:
+            results.append(chunk_vectors[0])
+        else:
+            results.append(aggregate(chunk_vectors, [end - start for start, end in text_spans]))
+    return results, headers
+
+@router.get("/v1/collections")
+def list_collections():
+    return JSONResponse(content={"object": "list", "data": [c.info() for c in vector_index.collections.values()]})
+
+@router.post("/v1/collections/{name}")
+def create_collection(name: str, request: CollectionRequest):
+    existing = vector_index.get(name)
+    if existing is not None:
+        if existing.metric != request.metric:
+            return error_response(409, f"Collection {name} already exists with metric {existing.metric}", "conflict")
+        return JSONResponse(content={**existing.info(), "created": False})
+    try:
+        collection = vector_index.create(name, request.metric)
+    except ValueError as e:
+        return error_response(400, str(e), "invalid_collection")
+    return JSONResponse(content={**collection.info(), "created": True})
+
+@router.delete("/v1/collections/{name}")
+def delete_collection(name: str):
+    if not vector_index.drop(name):
+        return collection_not_found(name)
+    return JSONResponse(content={"id": name, "deleted": True})
+
+@router.post("/v1/collections/{name}/upsert")
+async def upsert_documents(name: str, request: UpsertRequest, http_request: Request):
+    """Embeds the documents (through the embedding cache) and stores them, creating the collection on first use."""
+    if not request.documents:
+        return error_response(400, "No documents given", "empty_input")
+    try:
+        collection = vector_index.get(name) or vector_index.create(name)
+    except ValueError as e:
+        return error_response(400, str(e), "invalid_collection")
+
+    # Later duplicates of an id win, as they would with separate upserts
+    documents = list({doc.id: doc for doc in request.documents}.values())
+    try:
+        vectors, headers = await embed_texts([doc.text for doc in documents], request.pooling,
+                                             request_priority(http_request, Priority.BACKGROUND))
+    except QueueRejected as e:
+        return busy_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": {"message": str(e), "type": "server_error", "code": "internal_error"}})
+
+    try:
+        # File appends and the memmap refresh stay off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, collection.upsert, [doc.model_dump() for doc in documents], vectors)
+    except VectorShapeError as e:
+        return error_response(400, str(e), "invalid_vectors")
+    except ValueError as e:
+        return error_response(400, str(e), "dimension_mismatch")
+    return JSONResponse(headers=headers, content={**collection.info(), "upserted": len(documents)})
+
+@router.post("/v1/collections/{name}/delete")
+def delete_documents(name: str, request: DeleteDocumentsRequest):
+    collection = vector_index.get(name)
+    if collection is None:
+        return collection_not_found(name)
+    deleted = collection.delete(request.ids)
+    return JSONResponse(content={**collection.info(), "deleted": deleted})
+
+@router.post("/v1/search")
+async def search(request: SearchRequest, http_request: Request):
+    """Top-k documents of a collection for a text query (embedded on the NPU) or a raw vector."""
+    collection = vector_index.get(request.collection)
+    if collection is None:
+        return collection_not_found(request.collection)
+    if (request.query is None) == (request.vector is None):
+        return error_response(400, "Give exactly one of 'query' or 'vector'", "invalid_query")
+
+    headers = {}
+    if request.vector is not None:
+        query = np.asarray(request.vector, dtype=np.float32)
+    else:
+        try:
+            vectors, headers = await embed_texts([request.query], request.pooling,
+                                                 request_priority(http_request, Priority.INTERACTIVE))
+        except QueueRejected as e:
+            return busy_response(e)
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": {"message": str(e), "type": "server_error", "code": "internal_error"}})
+        query = vectors[0]
+
+    try:
+        # Scoring, and IVF training when a collection first needs it, run off the event loop
+        results = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(collection.search, query, top_k=max(1, request.top_k), nprobe=max(1, request.nprobe)))
+    except VectorShapeError as e:
+        return error_response(400, str(e), "invalid_vectors")
+    except ValueError as e:
+        return error_response(400, str(e), "dimension_mismatch")
+    return JSONResponse(headers=headers, content={
+        "object": "list",
+        "collection": collection.name,
+        "metric": collection.metric,
+        "data": results
+    })
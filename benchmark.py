@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+DIALECTS = {
+    "openai": "/v1/chat/completions",
+    "ollama": "/api/chat",
+    "claude": "/v1/messages",
+    "embeddings": "/v1/embeddings",
+}
+
+# Status codes the server uses to shed load (see scheduler.QueueRejected)
+REJECTED = (429, 503, 529)
+
+
+class Result(object):
+    """Timings of one request; `chunks` holds the arrival time of every streamed piece of text."""
+
+    def __init__(self, dialect: str, index: int):
+        self.dialect = dialect
+        self.index = index
+        self.status = None
+        self.error = None
+        self.start = None
+        self.end = None
+        self.chunks = []
+        self.tokens = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200 and self.error is None
+
+    @property
+    def latency(self) -> float:
+        return self.end - self.start
+
+    @property
+    def ttft(self):
+        return self.chunks[0] - self.start if self.chunks else None
+
+    @property
+    def inter_token(self) -> list:
+        return [b - a for a, b in zip(self.chunks, self.chunks[1:])]
+
+    @property
+    def completion_tokens(self) -> int:
+        # Prefer the server's own count; a coalesced chunk can hold several tokens
+        return self.tokens if self.tokens is not None else len(self.chunks)
+
+    @property
+    def tokens_per_s(self):
+        if not self.chunks or self.completion_tokens < 2 or self.end <= self.chunks[0]:
+            return None
+        return (self.completion_tokens - 1) / (self.end - self.chunks[0])
+
+    def to_dict(self) -> dict:
+        return {"dialect": self.dialect, "index": self.index, "status": self.status, "error": self.error,
+                "latency": self.latency, "ttft": self.ttft, "tokens": self.completion_tokens,
+                "tokens_per_s": self.tokens_per_s}
+
+
+def load_workload(path: str) -> list:
+    """
+    Reads a JSONL workload. A line may carry `messages`, `prompt`, `input`
+    (embeddings) or, as in requests.jsonl, `title` and `body`; optional
+    `dialect` and `max_tokens` override the command line for that line.
+    """
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "messages" not in entry:
+                text = entry.get("prompt") or entry.get("input") or \
+                    "\n\n".join(part for part in (entry.get("title"), entry.get("body")) if part)
+                entry["messages"] = [{"role": "user", "content": text}]
+            items.append(entry)
+    return items
+
+
+def add_nonce(messages: list, nonce: str) -> list:
+    """
+    Prefixes the last message with `nonce`, so the completion cache and request
+    coalescing cannot answer it and every request reaches the NPU.
+    """
+    *history, last = messages
+    content = last["content"]
+    if isinstance(content, list):
+        content = [{"type": "text", "text": nonce}] + content
+    else:
+        content = f"{nonce} {content}"
+    return history + [{**last, "content": content}]
+
+
+def build_payload(dialect: str, item: dict, args, index: int) -> dict:
+    messages = item["messages"]
+    if args.nonce:
+        messages = add_nonce(messages, f"[{args.run_id}-{index}]")
+    max_tokens = item.get("max_tokens", args.max_tokens)
+    if dialect == "embeddings":
+        text = item.get("input") or item["messages"][-1]["content"]
+        return {"input": f"[{args.run_id}-{index}] {text}" if args.nonce else text, "model": "rkllm-model"}
+    if dialect == "ollama":
+        return {"messages": messages, "stream": args.stream, "think": False, "options": {"num_predict": max_tokens}}
+    if dialect == "claude":
+        return {"messages": messages, "stream": args.stream, "max_tokens": max_tokens, "model": "rkllm"}
+    payload = {"messages": messages, "stream": args.stream, "max_tokens": max_tokens}
+    if args.stream:
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def parse_line(dialect: str, line: str, result: Result, now: float):
+    """Records text-bearing stream events and the server's token count from one SSE/NDJSON line."""
+    if dialect == "ollama":
+        data = json.loads(line)
+        message = data.get("message") or {}
+        if message.get("content") or message.get("thinking"):
+            result.chunks.append(now)
+        if data.get("done"):
+            result.tokens = data.get("eval_count")
+        return
+    if not line.startswith("data: ") or line == "data: [DONE]":
+        return
+    data = json.loads(line[6:])
+    if dialect == "claude":
+        delta = data.get("delta") or {}
+        if data.get("type") == "content_block_delta" and (delta.get("text") or delta.get("thinking")):
+            result.chunks.append(now)
+        elif data.get("type") == "message_delta":
+            result.tokens = (data.get("usage") or {}).get("output_tokens")
+        return
+    choices = data.get("choices") or []
+    if choices and (choices[0].get("delta", {}).get("content") or choices[0].get("delta", {}).get("reasoning_content")):
+        result.chunks.append(now)
+    if data.get("usage"):
+        result.tokens = data["usage"].get("completion_tokens")
+
+
+def parse_body(dialect: str, data: dict, result: Result):
+    if dialect == "ollama":
+        result.tokens = data.get("eval_count")
+    elif dialect == "claude":
+        result.tokens = (data.get("usage") or {}).get("output_tokens")
+    elif dialect == "openai":
+        result.tokens = (data.get("usage") or {}).get("completion_tokens")
+
+
+async def send(client: httpx.AsyncClient, args, dialect: str, item: dict, index: int) -> Result:
+    result = Result(dialect, index)
+    payload = build_payload(dialect, item, args, index)
+    stream = args.stream and dialect != "embeddings"
+    result.start = time.monotonic()
+    try:
+        async with client.stream("POST", DIALECTS[dialect], json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+            elif stream:
+                async for line in response.aiter_lines():
+                    if line:
+                        parse_line(dialect, line, result, time.monotonic())
+            else:
+                body = await response.aread()
+                parse_body(dialect, json.loads(body), result)
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.end = time.monotonic()
+    return result
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {"count": 0}
+
+    def pick(q):
+        # Linear interpolation between closest ranks
+        pos = (len(values) - 1) * q
+        low = int(pos)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+    return {"count": len(values), "mean": sum(values) / len(values), "p50": pick(0.5), "p95": pick(0.95),
+            "p99": pick(0.99), "max": values[-1]}
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    ok = [r for r in results if r.ok]
+    rejected = [r for r in results if r.status in REJECTED]
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "rejected": len(rejected),
+        "errors": len(results) - len(ok) - len(rejected),
+        "rejection_rate": len(rejected) / len(results) if results else 0.0,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "output_tokens_per_s": sum(r.completion_tokens for r in ok) / elapsed if elapsed > 0 else 0.0,
+        "latency_s": percentiles([r.latency for r in ok]),
+        "ttft_s": percentiles([r.ttft for r in ok]),
+        "inter_token_s": percentiles([gap for r in ok for gap in r.inter_token]),
+        "tokens_per_s": percentiles([r.tokens_per_s for r in ok]),
+    }
+
+
+async def run_closed_loop(client, args, workload: list) -> list:
+    """`concurrency` workers each send their next request as soon as the previous one returns."""
+    counter = iter(range(args.requests))
+    results = []
+
+    async def worker():
+        for index in counter:
+            item = workload[index % len(workload)]
+            results.append(await send(client, args, item.get("dialect", args.dialect), item, index))
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results
+
+
+async def run_open_loop(client, args, workload: list) -> list:
+    """Requests arrive as a Poisson process at `rate` per second, whether or not earlier ones have returned."""
+    rng = random.Random(args.seed)
+    tasks = []
+    for index in range(args.requests):
+        item = workload[index % len(workload)]
+        tasks.append(asyncio.create_task(send(client, args, item.get("dialect", args.dialect), item, index)))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    return list(await asyncio.gather(*tasks))
+
+
+def print_report(summary: dict, by_dialect: dict):
+    print("-" * 72)
+    print(f"Requests: {summary['requests']}  ok: {summary['succeeded']}  rejected: {summary['rejected']} "
+          f"({summary['rejection_rate']:.1%})  errors: {summary['errors']}")
+    print(f"Elapsed: {summary['elapsed_s']:.2f}s  throughput: {summary['requests_per_s']:.2f} req/s, "
+          f"{summary['output_tokens_per_s']:.1f} output tok/s")
+    print(f"{'metric':<22}{'p50':>12}{'p95':>12}{'p99':>12}{'max':>12}")
+    for name, label, scale in (("latency_s", "latency (ms)", 1000), ("ttft_s", "ttft (ms)", 1000),
+                               ("inter_token_s", "inter-token (ms)", 1000), ("tokens_per_s", "decode (tok/s)", 1)):
+        stats = summary[name]
+        if not stats["count"]:
+            continue
+        print(f"{label:<22}" +
+              "".join(f"{stats[q] * scale:>12.1f}" for q in ("p50", "p95", "p99", "max")))
+    if len(by_dialect) > 1:
+        for dialect, stats in by_dialect.items():
+            print(f"  {dialect}: {stats['succeeded']}/{stats['requests']} ok, p50 latency "
+                  f"{(stats['latency_s'].get('p50') or 0) * 1000:.1f} ms")
+
+
+def print_comparison(summary: dict, baseline: dict):
+    """Relative change of the headline numbers against an earlier --output file."""
+    print("-" * 72)
+    print(f"Compared with {baseline.get('meta', {}).get('label') or 'baseline'}:")
+    for name in ("latency_s", "ttft_s", "inter_token_s", "tokens_per_s"):
+        for q in ("p50", "p95", "p99"):
+            old = baseline["summary"].get(name, {}).get(q)
+            new = summary[name].get(q)
+            if old and new is not None:
+                print(f"  {name} {q}: {old:.4f} -> {new:.4f} ({(new - old) / old:+.1%})")
+    old, new = baseline["summary"]["rejection_rate"], summary["rejection_rate"]
+    print(f"  rejection_rate: {old:.1%} -> {new:.1%}")
+
+
+async def main(args):
+    if args.workload:
+        workload = load_workload(args.workload)
+    else:
+        workload = [{"messages": [{"role": "user", "content": args.prompt}]}]
+    if not workload:
+        print("[!] Workload is empty")
+        sys.exit(1)
+
+    # Distinguishes this run's nonces from those of earlier runs still in the completion cache
+    args.run_id = f"{random.getrandbits(32):08x}"
+    mode = f"open loop, {args.rate} req/s" if args.rate else f"closed loop, concurrency {args.concurrency}"
+    print(f"[-] {args.requests} requests against {args.host} ({args.dialect}, {mode}, stream {'on' if args.stream else 'off'})")
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.host, timeout=timeout, limits=limits) as client:
+        for _ in range(args.warmup):
+            await send(client, args, args.dialect, workload[0], -1)
+        start = time.monotonic()
+        if args.rate:
+            results = await run_open_loop(client, args, workload)
+        else:
+            results = await run_closed_loop(client, args, workload)
+        elapsed = time.monotonic() - start
+
+    summary = summarize(results, elapsed)
+    dialects = sorted({r.dialect for r in results})
+    by_dialect = {d: summarize([r for r in results if r.dialect == d], elapsed) for d in dialects}
+    print_report(summary, by_dialect)
+    failures = [r for r in results if not r.ok]
+    if failures:
+        print(f"[!] First failure: status {failures[0].status} {failures[0].error or ''}")
+
+    report = {
+        "meta": {"label": args.label, "host": args.host, "time": datetime.now(timezone.utc).isoformat(),
+                 "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")}},
+        "summary": summary,
+        "by_dialect": by_dialect,
+    }
+    if args.raw:
+        report["requests"] = [r.to_dict() for r in results]
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"[-] Report written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(summary, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RKLLM API load generator and latency benchmark")
+    parser.add_argument('--host', type=str, default="http://localhost:8080", help='Server address')
+    parser.add_argument('--dialect', type=str, default="openai", choices=list(DIALECTS),
+                        help='API to load (a workload line may override it with "dialect")')
+    parser.add_argument('--prompt', type=str, default="Hello, explain quantum mechanics briefly.",
+                        help='Prompt used when no --workload is given')
+    parser.add_argument('--workload', type=str, help='JSONL file of requests to replay in order, cycling if needed')
+    parser.add_argument('--requests', '-n', type=int, default=32, help='Total requests to send')
+    parser.add_argument('--concurrency', '-c', type=int, default=1, help='Closed loop: requests in flight at once')
+    parser.add_argument('--rate', type=float, default=0, help='Open loop: mean arrival rate in req/s (Poisson); 0 for closed loop')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for open-loop arrival times')
+    parser.add_argument('--max_tokens', type=int, default=128, help='Generation limit per chat request')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='Send non-streaming requests (no TTFT)')
+    parser.add_argument('--no-nonce', dest='nonce', action='store_false',
+                        help='Send prompts unchanged, so repeats are served from the completion and embedding caches')
+    parser.add_argument('--warmup', type=int, default=1, help='Requests sent before measuring')
+    parser.add_argument('--timeout', type=float, default=600, help='Per-request timeout in seconds')
+    parser.add_argument('--label', type=str, default="", help='Name for this run in the report')
+    parser.add_argument('--output', '-o', type=str, help='Write the JSON report here')
+    parser.add_argument('--raw', action='store_true', help='Include per-request records in the report')
+    parser.add_argument('--compare', type=str, help='Earlier JSON report to compare against')
+    asyncio.run(main(parser.parse_args()))
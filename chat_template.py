@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+from image_store import image_store
+import tracing
+
+_THINK_BLOCK = re.compile(r'<think>.*?</think>', re.DOTALL)
+
+
+class ChatTemplate(object):
+    """
+    Prompt format of one model family. Every message renders to
+    `turn_start + content + turn_end` on its own, so rendered messages can be
+    cached and joined; `generation_prompt` opens the assistant reply.
+    """
+
+    def __init__(self, name: str, turn_start: str, turn_end: str, generation_prompt: str,
+                 nothink: str = "", roles: Dict[str, str] = None):
+        self.name = name
+        self.turn_start = turn_start
+        self.turn_end = turn_end
+        self.generation_prompt = generation_prompt
+        # Appended to every message when thinking is off (Qwen3's soft switch)
+        self.nothink = nothink
+        self.roles = roles or {}
+
+    def render_message(self, role: str, text: str, thinking: bool) -> str:
+        role = self.roles.get(role, role)
+        suffix = "" if thinking else self.nothink
+        return f"{self.turn_start.format(role=role)}{text}{suffix}{self.turn_end}"
+
+
+TEMPLATES = {}
+
+
+def register_template(template: ChatTemplate):
+    TEMPLATES[template.name] = template
+
+
+register_template(ChatTemplate("chatml", "<|im_start|>{role}\n", "<|im_end|>\n", "<|im_start|>assistant\n",
+                               nothink=" /nothink"))
+register_template(ChatTemplate("llama3", "<|start_header_id|>{role}<|end_header_id|>\n\n", "<|eot_id|>",
+                               "<|start_header_id|>assistant<|end_header_id|>\n\n"))
+register_template(ChatTemplate("gemma", "<start_of_turn>{role}\n", "<end_of_turn>\n", "<start_of_turn>model\n",
+                               roles={"assistant": "model", "system": "user"}))
+
+
+def guess_template(model_path: str) -> str:
+    """Template for a model file, from the family named in it; ChatML (Qwen, DeepSeek distills, ...) otherwise."""
+    name = os.path.basename(model_path or "").lower()
+    if re.search(r"llama[-_]?3", name):
+        return "llama3"
+    if "gemma" in name:
+        return "gemma"
+    return "chatml"
+
+
+def image_path(item: dict):
+    """
+    Path or URL the model reads an image content item from (OpenAI image_url
+    parts, Anthropic image blocks), or None for other items. Inline images are
+    decoded into the content-addressed image store; a resent image reuses its file.
+    """
+    if item.get("type") == "image_url":
+        img_url = item["image_url"]["url"]
+        if img_url.startswith("data:image"):
+            return image_store.put_data_url(img_url)
+        # Standard URL or local file path
+        return img_url
+    if item.get("type") == "image":
+        source = item.get("source") or {}
+        if source.get("type") == "base64":
+            return image_store.put_base64(source.get("data", ""), source.get("media_type", "image/png"))
+        return source.get("url") or None
+    return None
+
+
+def message_text(content):
+    """Text of a message with its images as <image>path</image> lines, and the image store files it refers to."""
+    if not isinstance(content, list):
+        return _THINK_BLOCK.sub('', str(content)), ()
+    text_content = ""
+    stored = []
+    for item in content:
+        if item.get("type") == "text":
+            text_content += item.get("text", "")
+            continue
+        img_path = image_path(item)
+        if img_path:
+            text_content = f"<image>{img_path}</image>\n" + text_content
+            if img_path.startswith(image_store.directory or "\0"):
+                stored.append(img_path)
+    # Remove chain-of-thought content if we don't want the model to see previous thought processes
+    return _THINK_BLOCK.sub('', text_content), tuple(stored)
+
+
+class RenderedPrompt(object):
+    """A rendered conversation; `boundaries[i]` is where message i ends in `prompt`."""
+
+    def __init__(self, prompt: str, boundaries: List[int]):
+        self.prompt = prompt
+        self.boundaries = boundaries
+
+    def prefix_len(self, last_message: Optional[int] = None) -> int:
+        """Length of the stable prefix ending after `last_message` (default: all messages, no generation prompt)."""
+        if not self.boundaries:
+            return 0
+        return self.boundaries[-1 if last_message is None else last_message]
+
+    def prefix(self, last_message: Optional[int] = None) -> str:
+        return self.prompt[:self.prefix_len(last_message)]
+
+
+class ChatTemplateRenderer(object):
+    """
+    Renders conversations with the active template. Each message's rendering
+    is cached by a hash of its role, content and thinking flag, so a long
+    transcript only pays for the messages that are new this turn.
+    Cached renderings of inline images are only reused while the image store
+    still holds their files, and count as a use of them.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.template = TEMPLATES["chatml"]
+        self.max_entries = max_entries
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, name: str = "chatml", max_entries: int = 1024):
+        self.template = TEMPLATES[name]
+        self.max_entries = max_entries
+        self._segments = OrderedDict()
+
+    def _key(self, role: str, content, thinking: bool) -> bytes:
+        h = hashlib.sha256()
+        h.update(f"{self.template.name}\0{role}\0{int(thinking)}\0".encode("utf-8"))
+        if isinstance(content, str):
+            h.update(content.encode("utf-8"))
+        else:
+            h.update(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return h.digest()
+
+    def segment(self, msg: Dict, thinking: bool) -> str:
+        role, content = msg['role'], msg['content']
+        key = self._key(role, content, thinking)
+        with self._lock:
+            cached = self._segments.get(key)
+            if cached is not None and image_store.touch(cached[1]):
+                self._segments.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+        text, stored = message_text(content)
+        rendered = self.template.render_message(role, text, thinking)
+        with self._lock:
+            self.misses += 1
+            if self.max_entries > 0:
+                self._segments[key] = (rendered, stored)
+                while len(self._segments) > self.max_entries:
+                    self._segments.popitem(last=False)
+        return rendered
+
+    def render(self, messages: List[Dict], thinking: bool = True, add_generation_prompt: bool = True) -> RenderedPrompt:
+        with tracing.phase("template"):
+            segments = [self.segment(msg, thinking) for msg in messages]
+        boundaries = []
+        offset = 0
+        for part in segments:
+            offset += len(part)
+            boundaries.append(offset)
+        if add_generation_prompt:
+            segments.append(self.template.generation_prompt)
+        return RenderedPrompt("".join(segments), boundaries)
+
+    @property
+    def turn_end(self) -> str:
+        return self.template.turn_end
+
+    def stats(self) -> dict:
+        return {"template": self.template.name, "segments": len(self._segments), "hits": self.hits, "misses": self.misses}
+
+
+chat_templates = ChatTemplateRenderer()
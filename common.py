@@ -1,15 +1,18 @@
-import json
-import re
-import threading
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any, Union
+from pydantic import BaseModel, NonNegativeInt, PositiveInt
+from typing import List, Optional, Dict, Any, Union, Literal
+from scheduler import NPUScheduler, Priority
+from stream_parser import parse_text
+from tools import tool_registry
 
-# Global hardware lock to ensure RKLLM inference runs strictly one at a time
-hw_lock = threading.Lock()
+# Global admission queue to ensure RKLLM inference runs strictly one at a time
+npu_scheduler = NPUScheduler()
 
 class GlobalState:
     model_path: str = ""
     rkllm_model: Any = None
+    # starting -> loading -> warming_up -> ready, or failed (see server.py load_model)
+    status: str = "starting"
+    error: Optional[str] = None
 
 global_state = GlobalState()
 
@@ -32,73 +35,97 @@ class ChatRequest(BaseModel):
     messages: List[Dict[str, Any]]
     tools: Optional[List[Dict[str, Any]]] = None
     stream: Optional[bool] = False
+    # OpenAI: {"include_usage": true} adds a final chunk with token usage
+    stream_options: Optional[Dict[str, Any]] = None
     think: Optional[bool] = True
+    # OpenAI generation limits
+    max_tokens: Optional[int] = None
+    max_completion_tokens: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    # OpenAI sampling; validated against the model's profile (see sampling.py)
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    frequency_penalty: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    # Ollama passes num_predict, stop and sampling settings here
+    options: Optional[Dict[str, Any]] = None
 
 class ChatResponse(BaseModel):
     model: str
     created_at: str
     message: ResponseMessage
     done: bool
+    done_reason: Optional[str] = None
+    eval_count: Optional[int] = None
+    prompt_eval_count: Optional[int] = None
+    # Nanoseconds, as in Ollama
+    prompt_eval_duration: Optional[int] = None
+    eval_duration: Optional[int] = None
 
 class EmbeddingRequest(BaseModel):
     input: Union[str, List[str]]
     model: str = "rkllm-model"
+    encoding_format: Literal["float", "base64"] = "float"
+    dtype: Literal["float32", "float16"] = "float32"
+    dimensions: Optional[int] = None
+    normalize: bool = False
+    pooling: Literal["last", "mean"] = "last"
+    # Inputs longer than chunk_size tokens (default: the model context) are embedded in overlapping windows
+    chunk_size: Optional[PositiveInt] = None
+    # Clamped to half the window by chunk_spans
+    chunk_overlap: NonNegativeInt = 64
+    aggregate: Literal["mean", "weighted", "none"] = "weighted"
+
+class PromptCacheRequest(BaseModel):
+    system: Optional[str] = None
+    messages: List[Dict[str, Any]] = []
+    tools: Optional[List[Dict[str, Any]]] = None
+    think: Optional[bool] = True
+    label: str = ""
+
+class CollectionRequest(BaseModel):
+    metric: Literal["cosine", "dot"] = "cosine"
+
+class VectorDocument(BaseModel):
+    id: str
+    text: str
+    metadata: Optional[Dict[str, Any]] = None
+
+class UpsertRequest(BaseModel):
+    documents: List[VectorDocument]
+    pooling: Literal["last", "mean"] = "last"
+
+class DeleteDocumentsRequest(BaseModel):
+    ids: List[str]
+
+class SearchRequest(BaseModel):
+    collection: str
+    query: Optional[str] = None
+    vector: Optional[List[float]] = None
+    top_k: int = 10
+    nprobe: int = 8
+    pooling: Literal["last", "mean"] = "last"
 
 # --- Utilities ---
 
+def request_priority(http_request, default: Priority) -> Priority:
+    """Lets callers demote or promote a request with the X-RKLLM-Priority header."""
+    value = http_request.headers.get("x-rkllm-priority", "").strip().upper()
+    return Priority.__members__.get(value, default)
+
+def request_timeout(http_request) -> Optional[float]:
+    """Per-request generation deadline in seconds, from the X-RKLLM-Timeout header."""
+    try:
+        return float(http_request.headers.get("x-rkllm-timeout", ""))
+    except ValueError:
+        return None
+
 def inject_tool_prompt(messages: List[Dict], tools: List[Dict]) -> List[Dict]:
-    tool_schemas = [t.get("function", t) for t in tools]
-    system_content = (
-        "You are a helpful assistant.\n\n"
-        "# Tools\n"
-        "You may call one or more functions to assist with the user query.\n"
-        "You are provided with function signatures within <tools></tools> XML tags:\n"
-        "<tools>\n"
-        f"{json.dumps(tool_schemas, indent=2)}\n"
-        "</tools>\n"
-        "For each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\n"
-        "<tool_call>\n"
-        '{"name": "function_name", "arguments": {"arg_name": "value"}}\n'
-        "</tool_call>"
-    )
-    new_messages = []
-    has_system = False
-    for msg in messages:
-        if msg.get("role") == "system":
-            new_messages.append({"role": "system", "content": system_content + "\n" + str(msg.get("content", ""))})
-            has_system = True
-        else:
-            new_messages.append(msg)
-    if not has_system:
-        new_messages.insert(0, {"role": "system", "content": system_content})
-    return new_messages
+    return tool_registry.prepare(messages, tools)[0]
 
 def parse_model_output(text: str, enable_think: bool) -> tuple[str, str, List[Dict]]:
     """Extracts both <think> and <tool_call> tags from generated text."""
-    thinking_content = ""
-    clean_text = text
-
-    think_pattern = r"<think>(.*?)</think>"
-    think_matches = list(re.finditer(think_pattern, clean_text, re.DOTALL))
-    for match in think_matches:
-        if enable_think:
-            thinking_content += match.group(1).strip() + "\n"
-        clean_text = clean_text.replace(match.group(0), "")
-
-    tool_calls = []
-    tool_pattern = r"<tool_call>(.*?)</tool_call>"
-    tool_matches = list(re.finditer(tool_pattern, clean_text, re.DOTALL))
-    for match in tool_matches:
-        try:
-            call_json = json.loads(match.group(1).strip())
-            tool_calls.append({
-                "function": {
-                    "name": call_json.get("name", ""),
-                    "arguments": call_json.get("arguments", {})
-                }
-            })
-            clean_text = clean_text.replace(match.group(0), "")
-        except json.JSONDecodeError:
-            pass
-
-    return clean_text.strip(), thinking_content.strip(), tool_calls
+    clean_text, thinking_content, calls = parse_text(text, enable_think)
+    return clean_text, thinking_content, [{"function": call} for call in calls]
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+from utils import apply_chat_template
+from image_store import is_inline_image
+from sampling import SamplingProfile
+import tracing
+
+
+class CompletionCache(object):
+    """
+    Exact-match cache of finished generations.
+
+    With greedy decoding (top_k = 1 or temperature = 0) a formatted prompt
+    always yields the same tokens for a given model, LoRA adapter, startup
+    prompt cache, sampling profile and limits; all of them go into the key. Entries are the token
+    list, so a hit can be replayed as a stream without touching the NPU. A
+    bounded in-memory LRU sits on top of an optional directory of JSON files;
+    both tiers honour the TTL.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self.directory is not None
+
+    def configure(self, max_entries: int = 256, ttl: float = 3600.0, directory: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self._memory = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._prune_disk()
+
+    def key_for(self, rkllm_model, model_path: str, messages: List[Dict], thinking: bool = True,
+                limits=None, sampling=None) -> Optional[str]:
+        """
+        Key identifying a chat request's output, or None when identical requests
+        may legitimately differ: sampling is not greedy, or the messages refer to
+        images by URL or path (the file behind it may change). Inline images are
+        keyed by content through the image store.
+        Also used to coalesce identical in-flight requests (see singleflight.py).
+        """
+        if rkllm_model is None:
+            return None
+        if sampling is None:
+            sampling = SamplingProfile.native(rkllm_model)
+        if not sampling.greedy:
+            return None
+        for msg in messages:
+            content = msg.get("content")
+            if isinstance(content, list) and any(item.get("type") != "text" and not is_inline_image(item)
+                                                 for item in content if isinstance(item, dict)):
+                return None
+
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            "model": model_path,
+            "lora": getattr(rkllm_model, "lora_model_path", None),
+            "prompt_cache": getattr(rkllm_model, "prompt_cache_path", None),
+            "sampling": sampling.to_dict(),
+            "max_new_tokens": rkllm_model.sampling.get("max_new_tokens"),
+            "limits": limits.key() if limits is not None else None,
+        }, sort_keys=True).encode("utf-8"))
+        h.update(b"\0")
+        h.update(apply_chat_template(messages, thinking=thinking).encode("utf-8"))
+        return h.hexdigest()[:32]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        """Returns {"tokens": [...], "finish_reason": ..., ...} for a cached reply."""
+        if key is None or not self.enabled:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+            elif self.directory:
+                entry = self._read(key)
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            trace = tracing.current()
+            if trace is not None:
+                trace.attributes["completion_cache"] = "hit"
+            return entry[1]
+
+    def put(self, key: Optional[str], tokens: List[str], limits=None):
+        """Stores a reply with how it ended (see GenerationLimits.outcome)."""
+        if key is None or not tokens or not self.enabled:
+            return
+        entry = (time.time(), {"tokens": tokens, **(limits.outcome() if limits is not None else {})})
+        with self._lock:
+            self._remember(key, entry)
+        if not self.directory:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(key, entry)
+            return
+        # Called from the generation's on_complete; the file write must not hold up the event loop
+        loop.run_in_executor(None, self._write, key, entry)
+
+    def _write(self, key: str, entry: tuple):
+        tmp_path = self._path(key) + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"created": entry[0], **entry[1]}, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"[Warning] Failed to write completion cache entry {key}: {e}")
+
+    def _remember(self, key: str, entry: tuple):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            created = float(data.pop("created"))
+            data["tokens"] = list(data["tokens"])
+            entry = (created, data)
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            print(f"[Warning] Dropping corrupt completion cache entry {key}")
+            os.remove(path)
+            return None
+        if self._expired(entry[0]):
+            os.remove(path)
+            return None
+        return entry
+
+    def _prune_disk(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                self._read(name[:-5])
+
+    def headers(self, key: Optional[str], status: str) -> dict:
+        """`status` is hit, miss, or shared (attached to an identical running generation)."""
+        if key is None:
+            return {}
+        return {"X-Completion-Cache": status}
+
+    def stats(self) -> dict:
+        return {"entries_memory": len(self._memory), "hits": self.hits, "misses": self.misses}
+
+
+completion_cache = CompletionCache()
+
+
+async def replay_tokens(cached: dict, limits=None):
+    """Async generator over a cached reply, a drop-in for get_RKLLM_output."""
+    if limits is not None:
+        limits.restore(cached)
+    for token in cached["tokens"]:
+        yield token
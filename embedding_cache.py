@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from common import npu_scheduler
+from rkllm import get_RKLLM_embeddings_batch
+import metrics
+
+
+class VectorStore(object):
+    """
+    Append-only on-disk vectors of one dimension: `<dim>.keys` holds 16-byte
+    digests, `<dim>.f32` the float32 rows in the same order. Rows are read
+    through a memory map, so a restart only has to load the key index.
+    """
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, directory: str, dim: int):
+        self.dim = dim
+        self.keys_path = os.path.join(directory, f"{dim}.keys")
+        self.vectors_path = os.path.join(directory, f"{dim}.f32")
+        self.rows = {}
+        self._map = None
+
+        keys = open(self.keys_path, "rb").read() if os.path.exists(self.keys_path) else b""
+        vector_rows = os.path.getsize(self.vectors_path) // (4 * dim) if os.path.exists(self.vectors_path) else 0
+        # A crash between the two appends leaves them out of step; trust the shorter one
+        count = min(len(keys) // self.DIGEST_SIZE, vector_rows)
+        for row in range(count):
+            self.rows[keys[row * self.DIGEST_SIZE:(row + 1) * self.DIGEST_SIZE]] = row
+        self._truncate(count)
+
+    def _truncate(self, count: int):
+        for path, size in ((self.keys_path, count * self.DIGEST_SIZE), (self.vectors_path, count * 4 * self.dim)):
+            with open(path, "ab") as f:
+                f.truncate(size)
+
+    def get(self, digest: bytes) -> Optional[np.ndarray]:
+        row = self.rows.get(digest)
+        if row is None:
+            return None
+        if self._map is None or row >= self._map.shape[0]:
+            self._map = np.memmap(self.vectors_path, dtype="<f4", mode="r", shape=(len(self.rows), self.dim))
+        return np.array(self._map[row], dtype=np.float32)
+
+    def put_many(self, items: dict):
+        """Appends {digest: vector} rows not stored yet, with one write per file."""
+        new = [(digest, vector) for digest, vector in items.items() if digest not in self.rows]
+        if not new:
+            return
+        with open(self.vectors_path, "ab") as f:
+            f.write(b"".join(vector.astype("<f4", copy=False).tobytes() for _, vector in new))
+        with open(self.keys_path, "ab") as f:
+            f.write(b"".join(digest for digest, _ in new))
+        for digest, _ in new:
+            self.rows[digest] = len(self.rows)
+
+
+class EmbeddingCache(object):
+    """
+    Content-addressed cache in front of get_RKLLM_embeddings, keyed by
+    (model path, pooling mode, text). A bounded in-memory LRU sits on top of
+    an optional memory-mapped disk tier that survives restarts.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.directory = None
+        self._memory = OrderedDict()
+        self._stores = {}
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def configure(self, max_entries: int = 4096, directory: str = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._stores = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if name.endswith(".keys") and name[:-5].isdigit():
+                    dim = int(name[:-5])
+                    self._stores[dim] = VectorStore(directory, dim)
+
+    @staticmethod
+    def key(model_path: str, pooling: str, text: str) -> bytes:
+        h = hashlib.blake2b(digest_size=VectorStore.DIGEST_SIZE)
+        h.update(model_path.encode("utf-8"))
+        h.update(b"\0")
+        h.update(pooling.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                metrics.embedding_cache_lookups.inc("memory")
+                return vector
+            for store in self._stores.values():
+                vector = store.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.hits_disk += 1
+                    metrics.embedding_cache_lookups.inc("disk")
+                    return vector
+            self.misses += 1
+            metrics.embedding_cache_lookups.inc("miss")
+            return None
+
+    def put_many(self, items: dict):
+        """Stores {key: vector}; blocking file I/O with a disk tier, so callers run it off the event loop."""
+        items = {key: vector for key, vector in items.items() if vector.size > 0}
+        with self._lock:
+            by_dim = {}
+            for key, vector in items.items():
+                self._remember(key, vector)
+                by_dim.setdefault(vector.shape[-1], {})[key] = vector
+            if not self.directory:
+                return
+            for dim, rows in by_dim.items():
+                store = self._stores.get(dim)
+                if store is None:
+                    store = self._stores[dim] = VectorStore(self.directory, dim)
+                store.put_many(rows)
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries_memory": len(self._memory),
+            "entries_disk": sum(len(s.rows) for s in self._stores.values()),
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+        }
+
+
+embedding_cache = EmbeddingCache()
+
+
+async def get_cached_embeddings(rkllm_model, model_path: str, texts: list, pooling: str, priority,
+                                usage: dict = None):
+    """
+    Embeds `texts` through the cache, taking the NPU queue only for misses.
+    Returns (vectors, cached_count, queue_headers); raises QueueRejected when the queue is full.
+    Tokens prefilled for the misses are added to usage["prompt_tokens"]; cache hits cost none.
+    """
+    keys = [embedding_cache.key(model_path, pooling, text) for text in texts]
+    vectors = [embedding_cache.get(key) for key in keys]
+    cached = sum(v is not None for v in vectors)
+    if cached == len(texts):
+        return vectors, cached, {}
+
+    ticket = await npu_scheduler.acquire(priority)
+    try:
+        missing = [idx for idx, vector in enumerate(vectors) if vector is None]
+        computed = await get_RKLLM_embeddings_batch(rkllm_model, [texts[idx] for idx in missing], pooling=pooling,
+                                                   usage=usage)
+        for idx, vector in zip(missing, computed):
+            vectors[idx] = vector
+    finally:
+        ticket.release()
+    await asyncio.get_running_loop().run_in_executor(
+        None, embedding_cache.put_many, {keys[idx]: vectors[idx] for idx in missing})
+    return vectors, cached, ticket.headers()
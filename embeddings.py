@@ -0,0 +1,84 @@
+import base64
+from typing import Optional
+
+import numpy as np
+
+
+def pool_hidden_states(hidden: np.ndarray, mode: str = "last") -> np.ndarray:
+    """
+    Reduces a (num_tokens, embd_size) view of the runtime buffer to one float32 vector.
+    Always returns a fresh array, so the runtime buffer may be reused afterwards.
+    """
+    if mode == "mean":
+        return hidden.mean(axis=0, dtype=np.float32)
+    return np.array(hidden[-1], dtype=np.float32, copy=True)
+
+
+def postprocess(vector: np.ndarray, dimensions: Optional[int] = None, normalize: bool = False) -> np.ndarray:
+    """Truncates to `dimensions` (Matryoshka style) and optionally L2-normalizes."""
+    if dimensions is not None and 0 < dimensions < vector.shape[-1]:
+        vector = vector[..., :dimensions]
+    if normalize:
+        norm = np.linalg.norm(vector, axis=-1, keepdims=True)
+        vector = vector / np.maximum(norm, 1e-12)
+    return vector
+
+
+def encode(vector: np.ndarray, encoding_format: str = "float", dtype: str = "float32"):
+    """
+    Renders a vector for the response body: a JSON list of floats, or the
+    base64 of the little-endian buffer as in OpenAI's encoding_format=base64.
+    """
+    np_dtype = np.dtype("<f2") if dtype == "float16" else np.dtype("<f4")
+    vector = vector.astype(np_dtype, copy=False)
+    if encoding_format == "base64":
+        return base64.b64encode(vector.tobytes()).decode("ascii")
+    return vector.tolist()
+
+
+def estimate_token_offsets(text: str) -> np.ndarray:
+    """
+    Cumulative token estimate at every character boundary (length len(text)+1).
+    Without a tokenizer we assume ~4 ASCII letters per token and one token for
+    every other character. Digits, punctuation and CJK characters often are
+    one token each in Qwen-style vocabularies, so this overestimates prose
+    (smaller windows) but keeps numbers and code inside the context.
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+    letters = ((codes >= ord("a")) & (codes <= ord("z"))) | ((codes >= ord("A")) & (codes <= ord("Z")))
+    cost = np.where(letters, 0.25, 1.0)
+    return np.concatenate(([0.0], np.cumsum(cost)))
+
+
+def chunk_spans(text: str, window: int, overlap: int = 0) -> list:
+    """
+    Splits `text` into (start, end) character spans of at most ~`window` tokens
+    that overlap by ~`overlap` tokens, preferring to cut at whitespace.
+    Short texts come back as a single span.
+    """
+    window = max(1, window)
+    offsets = estimate_token_offsets(text)
+    if offsets[-1] <= window:
+        return [(0, len(text))]
+
+    overlap = max(0, min(overlap, window // 2))
+    spans = []
+    start = 0
+    while True:
+        end = int(np.searchsorted(offsets, offsets[start] + window, side="right")) - 1
+        if end >= len(text):
+            spans.append((start, len(text)))
+            return spans
+        cut = max(text.rfind(" ", start + (end - start) * 4 // 5, end), text.rfind("\n", start + (end - start) * 4 // 5, end))
+        if cut > start:
+            end = cut
+        spans.append((start, end))
+        start = max(int(np.searchsorted(offsets, offsets[end] - overlap, side="left")), start + 1)
+
+
+def aggregate(vectors: list, weights: list, mode: str = "weighted") -> np.ndarray:
+    """Combines chunk vectors into one: plain mean, or mean weighted by chunk length."""
+    stacked = np.stack(vectors)
+    if mode == "weighted":
+        return np.average(stacked, axis=0, weights=np.asarray(weights, dtype=np.float32)).astype(np.float32)
+    return stacked.mean(axis=0, dtype=np.float32)
@@ -0,0 +1,228 @@
+import asyncio
+import binascii
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+import tracing
+
+# Base64 characters decoded per step; a multiple of 4 so every step ends on a group boundary
+DECODE_CHUNK = 256 * 1024
+
+EXTENSIONS = {"image/jpeg": "jpg", "image/jpg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+_IMAGE_TAG = re.compile(r"<image>(.*?)</image>", re.DOTALL)
+_WHITESPACE = re.compile(r"\s")
+
+
+class ImageEntry(object):
+    def __init__(self, digest: str, path: str, size: int, last_used: float):
+        self.digest = digest
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        self.refs = 0
+
+
+class ImageStore(object):
+    """
+    Content-addressed store for images sent inline with chat requests.
+
+    Files are named by the SHA-256 of the decoded image, so a picture resent
+    on every turn of a chat is written once. The digest of the base64 text is
+    remembered as well; a repeat upload is matched on that without decoding
+    it again. Images referenced by a running generation are pinned (see
+    hold()); the rest are removed once unused for `ttl` seconds or, least
+    recently used first, when the store grows past `max_bytes`.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 256 * 1024 * 1024
+        self.ttl = 1800.0
+        self._entries = OrderedDict()
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def configure(self, directory: str = None, max_mb: int = 256, ttl: float = 1800.0, tmpfs: bool = False):
+        if directory is None:
+            base = "/dev/shm" if tmpfs and os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            directory = os.path.join(base, "rkllm_images")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._aliases = {}
+        self._adopt()
+
+    def _adopt(self):
+        """Picks up images left by a previous run, oldest first."""
+        files = []
+        for name in os.listdir(self.directory):
+            digest, _, ext = name.partition(".")
+            path = os.path.join(self.directory, name)
+            if len(digest) != 64 or not ext:
+                if name.startswith(".tmp-"):
+                    os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, digest, path, stat.st_size))
+        for mtime, digest, path, size in sorted(files):
+            self._entries[digest] = ImageEntry(digest, path, size, mtime)
+        self._evict()
+
+    def put_base64(self, encoded: str, media_type: str = "image/png") -> str:
+        """Stores a base64 encoded image and returns its path."""
+        if self.directory is None:
+            self.configure()
+        alias = hashlib.sha256(encoded.encode("ascii", "ignore")).hexdigest()
+        with self._lock:
+            entry = self._entries.get(self._aliases.get(alias, ""))
+            if entry is not None and os.path.exists(entry.path):
+                self._touch(entry)
+                return entry.path
+
+        with tracing.phase("image_decode"):
+            if _WHITESPACE.search(encoded):
+                # Whitespace anywhere (e.g. MIME line wrapping) would shift the group boundaries of the chunks
+                encoded = "".join(encoded.split())
+            digest = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+            size = 0
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for start in range(0, len(encoded), DECODE_CHUNK):
+                        data = binascii.a2b_base64(encoded[start:start + DECODE_CHUNK])
+                        digest.update(data)
+                        f.write(data)
+                        size += len(data)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        digest = digest.hexdigest()
+        path = os.path.join(self.directory, f"{digest}.{EXTENSIONS.get(media_type, 'png')}")
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and os.path.exists(entry.path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+                entry = ImageEntry(digest, path, size, time.time())
+                self._entries[digest] = entry
+            self._aliases[alias] = digest
+            self._touch(entry)
+            # The caller is about to use this file; an image over budget goes once it is released
+            self._evict(keep=digest)
+            return entry.path
+
+    def put_data_url(self, url: str) -> str:
+        header, encoded = url.split(",", 1)
+        media_type = header[len("data:"):].split(";", 1)[0]
+        return self.put_base64(encoded, media_type)
+
+    async def put_inline(self, messages: List[Dict]):
+        """
+        Decodes the inline images of a chat request on a worker thread. Rendering
+        the request afterwards finds them by the digest of their base64 text,
+        so a large upload does not stall the event loop and every stream on it.
+        """
+        puts = []
+        for msg in messages:
+            content = msg.get("content")
+            if not isinstance(content, list):
+                continue
+            for item in content:
+                if not isinstance(item, dict) or not is_inline_image(item):
+                    continue
+                if item.get("type") == "image_url":
+                    url = item["image_url"]
+                    url = url.get("url", "") if isinstance(url, dict) else url
+                    # As chat_template.image_path(), which only stores data:image URLs
+                    if url.startswith("data:image"):
+                        puts.append(functools.partial(self.put_data_url, url))
+                else:
+                    source = item["source"]
+                    puts.append(functools.partial(self.put_base64, source.get("data", ""),
+                                                  source.get("media_type", "image/png")))
+        if not puts:
+            return
+        loop = asyncio.get_running_loop()
+        for put in puts:
+            await loop.run_in_executor(None, put)
+
+    def touch(self, paths) -> bool:
+        """Marks stored images as used again; False if any of them is gone."""
+        with self._lock:
+            for path in paths:
+                entry = self._entries.get(os.path.basename(path).partition(".")[0])
+                if entry is None or entry.path != path or not os.path.exists(path):
+                    return False
+                self._touch(entry)
+        return True
+
+    def hold(self, prompt: str) -> List[ImageEntry]:
+        """Pins the stored images a prompt refers to until release()."""
+        held = []
+        if not self._entries:
+            return held
+        with self._lock:
+            for path in _IMAGE_TAG.findall(prompt):
+                entry = self._entries.get(os.path.basename(path).partition(".")[0])
+                if entry is not None and entry.path == path:
+                    entry.refs += 1
+                    held.append(entry)
+        return held
+
+    def release(self, held: List[ImageEntry]):
+        with self._lock:
+            for entry in held:
+                entry.refs -= 1
+                entry.last_used = time.time()
+            self._evict()
+
+    def _touch(self, entry: ImageEntry):
+        entry.last_used = time.time()
+        self._entries.move_to_end(entry.digest)
+
+    def _evict(self, keep: str = None):
+        now = time.time()
+        total = sum(e.size for e in self._entries.values())
+        for entry in list(self._entries.values()):
+            if entry.refs > 0 or entry.digest == keep:
+                continue
+            if total <= self.max_bytes and now - entry.last_used < self.ttl:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            del self._entries[entry.digest]
+            total -= entry.size
+        if len(self._aliases) > 4 * len(self._entries) + 64:
+            self._aliases = {a: d for a, d in self._aliases.items() if d in self._entries}
+
+    def stats(self) -> dict:
+        return {"images": len(self._entries), "bytes": sum(e.size for e in self._entries.values()),
+                "pinned": sum(1 for e in self._entries.values() if e.refs > 0), "directory": self.directory}
+
+
+def is_inline_image(item: dict) -> bool:
+    """Whether a content item carries its image data, so it renders the same on every request."""
+    if item.get("type") == "image_url":
+        url = item.get("image_url", {})
+        url = url.get("url", "") if isinstance(url, dict) else url
+        return url.startswith("data:")
+    if item.get("type") == "image":
+        return (item.get("source") or {}).get("type") == "base64"
+    return False
+
+
+image_store = ImageStore()
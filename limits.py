@@ -0,0 +1,147 @@
+import time
+from typing import List, Optional, Union
+
+# Server-wide deadline (seconds) for requests that do not set one; 0 disables it
+default_timeout = 0.0
+
+
+class GenerationLimits(object):
+    """
+    Per-request stopping rules enforced in get_RKLLM_output: a token budget,
+    stop strings and a wall-clock deadline. Whichever triggers first aborts the
+    NPU run and is recorded in `finish_reason`:
+
+        stop           the model ended the reply itself
+        stop_sequence  one of `stop` appeared in the output (`stop_sequence` holds it)
+        length         `max_tokens` tokens were generated
+        timeout        `timeout` seconds passed since the request arrived
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, stop: Union[str, List[str], None] = None,
+                 timeout: Optional[float] = None):
+        self.max_tokens = max_tokens if max_tokens is not None and max_tokens > 0 else None
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stop = [s for s in (stop or []) if s]
+        timeout = timeout if timeout is not None else default_timeout
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self.created_at = time.monotonic()
+
+        self.finish_reason = None
+        self.stop_sequence = None
+        self.completion_tokens = 0
+        # From the runtime's RKLLMPerfStat once the run has finished (see record_perf), else estimated
+        self.prompt_tokens = 0
+        self.prefill_ms = 0.0
+        self.generate_ms = 0.0
+        self._pending = ""
+
+    def key(self) -> dict:
+        """The parts that change what a run produces, for completion_cache.key_for()."""
+        return {"max_tokens": self.max_tokens, "stop": self.stop}
+
+    def flight_key(self, cache_key: Optional[str]) -> Optional[str]:
+        """
+        Requests only share a running generation if they would also stop at the
+        same time. A deadline counts from each request's own arrival, so a
+        request with one never starts or joins a shared generation.
+        """
+        return cache_key if cache_key is not None and self.timeout is None else None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline, or None without one."""
+        if self.timeout is None:
+            return None
+        return max(0.0, self.created_at + self.timeout - time.monotonic())
+
+    def feed(self, token: str) -> str:
+        """
+        Counts a token and returns the text that can be sent on. Text that could
+        be the start of a stop string is held back until the next token shows
+        whether it really is; on a match the output ends right before it.
+        """
+        self.completion_tokens += 1
+        if not self.stop:
+            if self.max_tokens is not None and self.completion_tokens >= self.max_tokens:
+                self.finish_reason = "length"
+            return token
+
+        text = self._pending + token
+        match = None
+        for s in self.stop:
+            index = text.find(s)
+            if index != -1 and (match is None or index < match[0]):
+                match = (index, s)
+        if match is not None:
+            self._pending = ""
+            self.finish_reason = "stop_sequence"
+            self.stop_sequence = match[1]
+            return text[:match[0]]
+
+        hold = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(text)), hold, -1):
+                if text.endswith(s[:n]):
+                    hold = n
+                    break
+        self._pending = text[len(text) - hold:] if hold else ""
+        if self.max_tokens is not None and self.completion_tokens >= self.max_tokens:
+            self.finish_reason = "length"
+            return self.flush(text[:len(text) - hold])
+        return text[:len(text) - hold]
+
+    def flush(self, text: str = "") -> str:
+        """Releases held-back text once the run is over without a stop string match."""
+        text, self._pending = text + self._pending, ""
+        return text
+
+    def record_perf(self, perf: dict):
+        """Takes token counts and timings from the run's RKLLMPerfStat; an aborted run keeps its own token count."""
+        self.prompt_tokens = perf["prefill_tokens"]
+        self.prefill_ms = perf["prefill_time_ms"]
+        self.generate_ms = perf["generate_time_ms"]
+        if not self.aborted and perf["generate_tokens"] > 0:
+            self.completion_tokens = perf["generate_tokens"]
+
+    def estimate_prompt(self, n_tokens: int):
+        """Prompt size for a run cut short before the runtime reported RKLLMPerfStat (no tokenizer here)."""
+        if not self.prompt_tokens:
+            self.prompt_tokens = n_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def aborted(self) -> bool:
+        return self.finish_reason in ("stop_sequence", "length", "timeout")
+
+    # --- Protocol mappings ---
+
+    @property
+    def openai_finish_reason(self) -> str:
+        return "length" if self.finish_reason in ("length", "timeout") else "stop"
+
+    @property
+    def ollama_done_reason(self) -> str:
+        return "length" if self.finish_reason in ("length", "timeout") else "stop"
+
+    @property
+    def anthropic_stop_reason(self) -> str:
+        if self.finish_reason == "stop_sequence":
+            return "stop_sequence"
+        if self.finish_reason in ("length", "timeout"):
+            return "max_tokens"
+        return "end_turn"
+
+    # --- Completion cache ---
+
+    def outcome(self) -> dict:
+        return {"finish_reason": self.finish_reason, "stop_sequence": self.stop_sequence,
+                "completion_tokens": self.completion_tokens, "prompt_tokens": self.prompt_tokens}
+
+    def restore(self, outcome: dict):
+        self.finish_reason = outcome.get("finish_reason") or "stop"
+        self.stop_sequence = outcome.get("stop_sequence")
+        self.completion_tokens = outcome.get("completion_tokens", 0)
+        self.prompt_tokens = outcome.get("prompt_tokens", 0)
@@ -0,0 +1,126 @@
+import bisect
+import threading
+from typing import Dict, Tuple
+
+# Latency buckets in seconds, from a cached reply to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Throughput buckets in tokens per second; decode on the NPU is tens, prefill hundreds
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value:g}")
+        return "\n".join(lines)
+
+
+class Gauge(object):
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> str:
+        return f"# HELP {self.name} {self.help}\n# TYPE {self.name} gauge\n{self.name} {self.value:g}"
+
+
+class Histogram(object):
+    """Cumulative-bucket histogram in the Prometheus text format; observe() is thread-safe."""
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = labels
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), then sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series):
+                    total += count
+                    le = f'le="{bound:g}"' if bound != "+Inf" else 'le="+Inf"'
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {total}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series[-1]:g}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {total}")
+        return "\n".join(lines)
+
+
+time_to_first_token = Histogram("rkllm_time_to_first_token_seconds",
+                                "Time from request arrival to the first generated token")
+prefill_seconds = Histogram("rkllm_prefill_duration_seconds", "Prefill time of an NPU run, from RKLLMPerfStat",
+                            labels=("kind",))
+decode_seconds = Histogram("rkllm_decode_duration_seconds", "Decode time of an NPU run, from RKLLMPerfStat")
+prefill_rate = Histogram("rkllm_prefill_tokens_per_second", "Prefill throughput of an NPU run",
+                         buckets=RATE_BUCKETS, labels=("kind",))
+decode_rate = Histogram("rkllm_decode_tokens_per_second", "Decode throughput of an NPU run", buckets=RATE_BUCKETS)
+queue_wait = Histogram("rkllm_queue_wait_seconds", "Time a request waited for the NPU", labels=("priority",))
+npu_hold = Histogram("rkllm_npu_hold_seconds", "Time a request held the NPU", labels=("priority",))
+request_duration = Histogram("rkllm_request_duration_seconds", "Time until response headers were sent",
+                             labels=("endpoint",))
+requests_total = Counter("rkllm_requests_total", "HTTP requests by endpoint and status", labels=("endpoint", "status"))
+tokens_total = Counter("rkllm_tokens_total", "Tokens processed on the NPU", labels=("phase",))
+embedding_cache_lookups = Counter("rkllm_embedding_cache_lookups_total",
+                                  "Embedding cache lookups by result (memory or disk hit, miss)", labels=("result",))
+npu_memory = Gauge("rkllm_npu_memory_mb", "Memory used by the RKLLM runtime at the end of the last run")
+
+ALL = (requests_total, request_duration, queue_wait, npu_hold, time_to_first_token, prefill_seconds, decode_seconds,
+       prefill_rate, decode_rate, tokens_total, embedding_cache_lookups, npu_memory)
+
+
+def record_perf(kind: str, perf: dict):
+    """Records the RKLLMPerfStat of a finished run (see InferenceContext.perf)."""
+    prefill_s = perf["prefill_time_ms"] / 1000.0
+    decode_s = perf["generate_time_ms"] / 1000.0
+    if perf["prefill_tokens"] > 0:
+        prefill_seconds.observe(prefill_s, kind)
+        tokens_total.inc("prefill", amount=perf["prefill_tokens"])
+        if prefill_s > 0:
+            prefill_rate.observe(perf["prefill_tokens"] / prefill_s, kind)
+    if perf["generate_tokens"] > 0:
+        decode_seconds.observe(decode_s)
+        tokens_total.inc("decode", amount=perf["generate_tokens"])
+        if decode_s > 0:
+            decode_rate.observe(perf["generate_tokens"] / decode_s)
+    if perf["memory_usage_mb"] > 0:
+        npu_memory.set(perf["memory_usage_mb"])
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in ALL) + "\n"
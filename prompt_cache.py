@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+
+class PromptCacheEntry(object):
+    def __init__(self, key: str, prefix_len: int, size: int, label: str = "", last_used: float = 0.0):
+        self.key = key
+        self.prefix_len = prefix_len
+        self.size = size
+        self.label = label
+        self.last_used = last_used
+
+    def to_dict(self) -> dict:
+        return {"key": self.key, "prefix_len": self.prefix_len, "size": self.size,
+                "label": self.label, "last_used": self.last_used}
+
+
+class PromptCacheManager(object):
+    """
+    Library of saved RKLLM prompt caches (prefilled KV for a fixed prompt prefix).
+
+    Files are named by the SHA-256 of the rendered prefix they were built from,
+    so identical system prompts or tool blocks map to the same file. The library
+    is capped by total size on disk and evicts the least recently used entries.
+    """
+
+    INDEX_FILE = "index.json"
+    # Cache hits only update access times in memory; they reach index.json at most this often
+    TOUCH_SAVE_INTERVAL = 60.0
+
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 2048 * 1024 * 1024
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def configure(self, directory: str, max_mb: int = 2048):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self._load_index()
+
+    @staticmethod
+    def key(prefix: str) -> str:
+        return hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.rkcache")
+
+    def get(self, key: str) -> Optional[PromptCacheEntry]:
+        return self._entries.get(key)
+
+    def entries(self) -> list:
+        return sorted(self._entries.values(), key=lambda e: e.last_used, reverse=True)
+
+    def total_bytes(self) -> int:
+        return sum(e.size for e in self._entries.values())
+
+    def match(self, prompt: str, boundaries=None) -> Optional[PromptCacheEntry]:
+        """
+        Returns the longest cached prefix of `prompt`, if any. Prefixes always end
+        on a message, so with the rendered message `boundaries` only those are tried.
+        """
+        if not self.enabled:
+            return None
+        lengths = sorted({e.prefix_len for e in self._entries.values() if e.prefix_len < len(prompt)}, reverse=True)
+        if boundaries is not None:
+            ends = set(boundaries)
+            lengths = [length for length in lengths if length in ends]
+        for length in lengths:
+            entry = self._entries.get(self.key(prompt[:length]))
+            if entry is not None and entry.prefix_len == length:
+                self.touch(entry)
+                return entry
+        return None
+
+    def touch(self, entry: PromptCacheEntry):
+        entry.last_used = time.time()
+        self._dirty = True
+        if entry.last_used - self._saved_at >= self.TOUCH_SAVE_INTERVAL:
+            self._save_index()
+
+    def flush(self):
+        """Writes access times recorded since the last save, e.g. at shutdown."""
+        if self._dirty:
+            self._save_index()
+
+    def add(self, prefix: str, label: str = "") -> PromptCacheEntry:
+        """Registers the cache file for `prefix` after the runtime has written it."""
+        key = self.key(prefix)
+        path = self.path(key)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        entry = PromptCacheEntry(key, len(prefix), size, label, time.time())
+        with self._lock:
+            self._entries[key] = entry
+        self._evict(keep=key)
+        self._save_index()
+        return entry
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self._save_index()
+        return True
+
+    def _evict(self, keep: str):
+        while self.total_bytes() > self.max_bytes:
+            victims = [e for e in self._entries.values() if e.key != keep]
+            if not victims:
+                return
+            victim = min(victims, key=lambda e: e.last_used)
+            print(f"[Info] Evicting prompt cache {victim.key} ({victim.size} bytes)")
+            self.remove(victim.key)
+
+    def _load_index(self):
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        self._entries = {}
+        if not os.path.exists(index_path):
+            return
+        try:
+            with open(index_path, "r") as f:
+                for item in json.load(f):
+                    if os.path.exists(self.path(item["key"])):
+                        self._entries[item["key"]] = PromptCacheEntry(**item)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[Warning] Ignoring corrupt prompt cache index: {e}")
+
+    def _save_index(self):
+        if not self.enabled:
+            return
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        with self._lock:
+            data = [e.to_dict() for e in self._entries.values()]
+            self._dirty = False
+            self._saved_at = time.time()
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, index_path)
+
+
+prompt_caches = PromptCacheManager()
@@ -3,13 +3,26 @@ import sys
 import os
 import threading
 import queue
+import itertools
+import asyncio
+import concurrent.futures
+import time
+import logging
 
-# Set the dynamic library path
-rkllm_lib = ctypes.CDLL('lib/librkllmrt.so')
+import numpy as np
+
+from embeddings import pool_hidden_states, estimate_token_offsets
+from limits import GenerationLimits
+from image_store import image_store
+from vision_encoder import vision_encoder
+import metrics
+import tracing
+
+# Path of the runtime library; it is loaded by the first RKLLM created without another runtime
+RKLLM_LIB_PATH = 'lib/librkllmrt.so'
 
 # Define the structures from the library
 RKLLM_Handle_t = ctypes.c_void_p
-userdata = ctypes.c_void_p(None)
 
 LLMCallState = ctypes.c_int
 LLMCallState.RKLLM_RUN_NORMAL = 0
@@ -174,36 +187,187 @@ class RKLLMResult(ctypes.Structure):
     ]
 
 
-# Define thread-safe queue for retrieving generated tokens and embeddings
-output_queue = queue.Queue()
-global_state = -1
+class InferenceContext(object):
+    """
+    One unit of NPU work and the channel its results come back on.
+
+    The context id travels through the userdata pointer so the callback can
+    route results to the right request; anything arriving after the context
+    is closed is dropped. Consumers either iterate it (sync or async) for
+    tokens or wait on `done`, which resolves once the worker is through with
+    the run: rkllm_run has returned and the KV cache bookkeeping is final.
+    """
+
+    GENERATE = "generate"
+    EMBED = "embed"
+    PREFILL = "prefill"
+
+    def __init__(self, kind: str, prompt: str, role: str = "system", enable_thinking: bool = True, loop=None,
+                 session=None, clear_kv: bool = False, prompt_cache: str = None, save_prompt_cache: str = None,
+                 pooling: str = "last", image_embeds: np.ndarray = None, image_size: int = 0,
+                 request_id: str = None):
+        self.id = next(_context_ids)
+        # ID of the HTTP request (see tracing.py), for log lines
+        self.request_id = request_id
+        self.kind = kind
+        self.prompt = prompt
+        self.role = role
+        self.enable_thinking = enable_thinking
+        self.state = -1
+        self.pooling = pooling
+        # Embedding jobs may carry several inputs for one batched rkllm_run
+        self.prompts = list(prompt) if isinstance(prompt, (list, tuple)) else [prompt]
+        self.embeddings = [None] * len(self.prompts)
+        self.text_parts = []
+        # RKLLMPerfStat of the run as a dict, filled in by the FINISH callback
+        self.perf = None
+        # RKLLMResults the FINISH callback may read; more than one only for a batched run
+        self.n_results = 1
+
+        # Vision encoder output for the prompt's <image> placeholders, [n_image, n_image_tokens, dim] in prompt order
+        self.image_embeds = image_embeds
+        self.image_size = image_size
+
+        # Multi-turn KV reuse: runs with a session keep their history in the cache
+        self.session = session
+        self.clear_kv = clear_kv
+
+        # Prompt cache file to have loaded for this run (None: the server default, "": none),
+        # and where a PREFILL run should save its KV cache
+        self.prompt_cache = prompt_cache
+        self.save_prompt_cache = save_prompt_cache
+        self.cancelled = False
+        self.finished = False
+        self.done = concurrent.futures.Future()
+        self.model = None
+
+        self.submitted_at = None
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+
+    @property
+    def userdata(self):
+        return ctypes.c_void_p(self.id)
+
+    @property
+    def embedding(self):
+        return self.embeddings[0]
+
+    def put(self, item):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        else:
+            self._queue.put(item)
+
+    def token(self, text: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.text_parts.append(text)
+        self.put(text)
+
+    def fail(self, error: Exception):
+        self.put(error)
+        self.finish()
+
+    def finish(self):
+        """Idempotent: ends the token stream; called by the FINISH callback and again by the worker."""
+        if self.finished:
+            return
+        self.finished = True
+        self.finished_at = time.monotonic()
+        self.put(None)  # Sentinel to mark end of generation
+
+    def settle(self):
+        """Called by the worker last, once it no longer touches the NPU or the KV cache for this context."""
+        self.finish()
+        if not self.done.done():
+            self.done.set_result(self.embeddings)
+
+    def cancel(self):
+        """Drops a pending job, or aborts it on the NPU if it is already running."""
+        if self.finished or self.cancelled:
+            return
+        self.cancelled = True
+        if self.started_at is not None and self.model is not None:
+            self.model.abort()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is None:
+            # Keep the sentinel so repeated iteration terminates too
+            self._queue.put_nowait(None)
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+# Generated text echoed to the console; off unless enable_token_echo() is called
+token_log = logging.getLogger("rkllm.tokens")
+token_log.propagate = False
+
+
+def enable_token_echo():
+    """Writes every generated token to stdout as it arrives (debugging only, costs CPU per token)."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.terminator = ""
+    token_log.addHandler(handler)
+    token_log.setLevel(logging.DEBUG)
+
+
+_context_ids = itertools.count(1)
+_contexts = {}
+_contexts_lock = threading.Lock()
 
 
 # Callback function to receive data from C++ runtime
 def callback_impl(result, userdata, state):
-    global global_state
+    ctx = _contexts.get(userdata)
+    if ctx is None or ctx.finished:
+        # Late callback from an aborted or foreign run
+        return 0
+
     if state == LLMCallState.RKLLM_RUN_FINISH:
-        global_state = state
-
-        # Extract Embeddings if they exist in the payload
-        if result and result.contents.last_hidden_layer.embd_size > 0:
-            embd_size = result.contents.last_hidden_layer.embd_size
-            hidden_states_ptr = ctypes.cast(
-                result.contents.last_hidden_layer.hidden_states,
-                ctypes.POINTER(ctypes.c_float * embd_size)
-            )
-            # Safely cast pointer array to Python list
-            vector = [float(hidden_states_ptr.contents[i]) for i in range(embd_size)]
-            output_queue.put({"embedding": vector})
-
-        output_queue.put(None)  # Sentinel to mark end of generation
+        ctx.state = state
+        if result:
+            perf = result[0].perf
+            ctx.perf = {name: getattr(perf, name) for name, _ in RKLLMPerfStat._fields_}
+
+        # Extract Embeddings if they exist in the payload.
+        # A batched run reports one RKLLMResult per input; never read past what it was given
+        if result and ctx.kind == InferenceContext.EMBED:
+            for i in range(min(ctx.n_results, len(ctx.prompts))):
+                layer = result[i].last_hidden_layer
+                if layer.embd_size <= 0:
+                    continue
+                # Zero-copy view of the runtime buffer; pooling makes the one copy we keep
+                hidden = np.ctypeslib.as_array(layer.hidden_states, shape=(max(layer.num_tokens, 1), layer.embd_size))
+                ctx.embeddings[i] = pool_hidden_states(hidden, ctx.pooling)
+
+        ctx.finish()
     elif state == LLMCallState.RKLLM_RUN_ERROR:
-        global_state = state
-        output_queue.put(Exception("RKLLM Runtime Error"))
+        ctx.state = state
+        ctx.fail(Exception("RKLLM Runtime Error"))
     elif state == LLMCallState.RKLLM_RUN_NORMAL:
-        global_state = state
+        ctx.state = state
         text = result.contents.text.decode('utf-8')
-        output_queue.put(text)
+        ctx.token(text)
     return 0
 
 
@@ -211,13 +375,46 @@ callback_type = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(RKLLMResult), ctyp
 callback = callback_type(callback_impl)
 
 
+_library = None
+
+
+def load_library(path: str = None):
+    """
+    Binds librkllmrt.so with the argument types of every function RKLLM calls.
+    Any object with the same functions can stand in for it (see rkllm_sim.py).
+    """
+    global _library
+    if _library is not None:
+        return _library
+    lib = ctypes.CDLL(path or RKLLM_LIB_PATH)
+    signatures = {
+        "rkllm_init": [ctypes.POINTER(RKLLM_Handle_t), ctypes.POINTER(RKLLMParam), callback_type],
+        "rkllm_run": [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p],
+        "rkllm_set_chat_template": [RKLLM_Handle_t, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p],
+        "rkllm_set_function_tools": [RKLLM_Handle_t, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p],
+        "rkllm_destroy": [RKLLM_Handle_t],
+        "rkllm_clear_kv_cache": [RKLLM_Handle_t, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)],
+        "rkllm_load_lora": [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)],
+        "rkllm_load_prompt_cache": [RKLLM_Handle_t, ctypes.c_char_p],
+        "rkllm_release_prompt_cache": [RKLLM_Handle_t],
+    }
+    for name, argtypes in signatures.items():
+        function = getattr(lib, name)
+        function.argtypes = argtypes
+        function.restype = ctypes.c_int
+    _library = lib
+    return lib
+
+
 class RKLLM(object):
     """
     RKLLM class handles initialization, inference, and release operations
-    for the RKLLM model bound dynamically from librkllmrt.so.
+    for the RKLLM model bound dynamically from librkllmrt.so, or from
+    `runtime` when given (e.g. rkllm_sim.SimulatedRuntime).
     """
 
-    def __init__(self, config:dict, model_path, lora_model_path=None, prompt_cache_path=None, platform="rk3588"):
+    def __init__(self, config:dict, model_path, lora_model_path=None, prompt_cache_path=None, platform="rk3588",
+                 runtime=None):
         rkllm_param = RKLLMParam()
         rkllm_param.model_path = bytes(model_path, 'utf-8')
 
@@ -237,16 +434,20 @@ class RKLLM(object):
         rkllm_param.mirostat = 0
         rkllm_param.mirostat_tau = 5.0
         rkllm_param.mirostat_eta = 0.1
+        # Startup sampling profile; the runtime cannot change it per run (see sampling.py)
+        for name, value in config.get("sampling", {}).items():
+            setattr(rkllm_param, name, value)
         rkllm_param.is_async = False
 
-        # Set valid Vision tags
-        rkllm_param.img_start = "<image>".encode('utf-8')
-        rkllm_param.img_end = "</image>".encode('utf-8')
-        rkllm_param.img_content = "".encode('utf-8')
+        # Set valid Vision tags; with a vision encoder these are the model's own image tokens
+        vision_tokens = config.get("vision_tokens", {})
+        rkllm_param.img_start = vision_tokens.get("img_start", "<image>").encode('utf-8')
+        rkllm_param.img_end = vision_tokens.get("img_end", "</image>").encode('utf-8')
+        rkllm_param.img_content = vision_tokens.get("img_content", "").encode('utf-8')
 
         rkllm_param.extend_param.base_domain_id = 0
         rkllm_param.extend_param.embed_flash = 1
-        rkllm_param.extend_param.n_batch = 1
+        rkllm_param.extend_param.n_batch = config.get("n_batch", 1)
         rkllm_param.extend_param.use_cross_attn = 0
         rkllm_param.extend_param.enabled_cpus_num = 4
 
@@ -257,35 +458,20 @@ class RKLLM(object):
 
         self.handle = RKLLM_Handle_t()
 
+        rkllm_lib = runtime if runtime is not None else load_library()
         self.rkllm_init = rkllm_lib.rkllm_init
-        self.rkllm_init.argtypes = [ctypes.POINTER(RKLLM_Handle_t), ctypes.POINTER(RKLLMParam), callback_type]
-        self.rkllm_init.restype = ctypes.c_int
 
         ret = self.rkllm_init(ctypes.byref(self.handle), ctypes.byref(rkllm_param), callback)
         if ret != 0:
-            print("\n[Error] RKLLM initialization failed\n")
-            exit(1)
-        else:
-            print("\n[Success] RKLLM initialization successful!\n")
+            raise RuntimeError(f"RKLLM initialization failed: {model_path}")
+        print("\n[Success] RKLLM initialization successful!\n")
 
         self.rkllm_run = rkllm_lib.rkllm_run
-        self.rkllm_run.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam),
-                                   ctypes.c_void_p]
-        self.rkllm_run.restype = ctypes.c_int
-
         self.set_chat_template = rkllm_lib.rkllm_set_chat_template
-        self.set_chat_template.argtypes = [RKLLM_Handle_t, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
-        self.set_chat_template.restype = ctypes.c_int
-
         self.set_function_tools_ = rkllm_lib.rkllm_set_function_tools
-        self.set_function_tools_.argtypes = [RKLLM_Handle_t, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
-        self.set_function_tools_.restype = ctypes.c_int
-
         self.rkllm_destroy = rkllm_lib.rkllm_destroy
-        self.rkllm_destroy.argtypes = [RKLLM_Handle_t]
-        self.rkllm_destroy.restype = ctypes.c_int
-
         self.rkllm_abort = rkllm_lib.rkllm_abort
+        self.rkllm_clear_kv_cache = rkllm_lib.rkllm_clear_kv_cache
 
         rkllm_lora_params = None
         if lora_model_path:
@@ -296,29 +482,110 @@ class RKLLM(object):
             lora_adapter.lora_adapter_name = ctypes.c_char_p((lora_adapter_name).encode('utf-8'))
             lora_adapter.scale = 1.0
 
-            rkllm_load_lora = rkllm_lib.rkllm_load_lora
-            rkllm_load_lora.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)]
-            rkllm_load_lora.restype = ctypes.c_int
-            rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
+            rkllm_lib.rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
             rkllm_lora_params = RKLLMLoraParam()
             rkllm_lora_params.lora_adapter_name = ctypes.c_char_p((lora_adapter_name).encode('utf-8'))
 
+        # Batched embedding runs need a runtime that reports one RKLLMResult per input. librkllmrt
+        # cannot be asked, so it gets one input per run unless it declares `batched_results`
+        self.n_batch = rkllm_param.extend_param.n_batch if getattr(rkllm_lib, "batched_results", False) else 1
+        if self.n_batch < rkllm_param.extend_param.n_batch:
+            print(f"[Warning] Runtime does not declare batched results; embedding one input per run "
+                  f"instead of {rkllm_param.extend_param.n_batch}")
+        self.max_context_len = rkllm_param.max_context_len
+
         self.rkllm_infer_params = RKLLMInferParam()
         ctypes.memset(ctypes.byref(self.rkllm_infer_params), 0, ctypes.sizeof(RKLLMInferParam))
         self.rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
         self.rkllm_infer_params.lora_params = ctypes.pointer(rkllm_lora_params) if rkllm_lora_params else None
         self.rkllm_infer_params.keep_history = 0
 
-        self.prompt_cache_path = None
+        self.rkllm_load_prompt_cache = rkllm_lib.rkllm_load_prompt_cache
+        self.rkllm_release_prompt_cache = rkllm_lib.rkllm_release_prompt_cache
+
+        self.prompt_cache_path = prompt_cache_path
+        self.loaded_prompt_cache = None
         if prompt_cache_path:
-            self.prompt_cache_path = prompt_cache_path
-            rkllm_load_prompt_cache = rkllm_lib.rkllm_load_prompt_cache
-            rkllm_load_prompt_cache.argtypes = [RKLLM_Handle_t, ctypes.c_char_p]
-            rkllm_load_prompt_cache.restype = ctypes.c_int
-            rkllm_load_prompt_cache(self.handle, ctypes.c_char_p((prompt_cache_path).encode('utf-8')))
+            self.load_prompt_cache(prompt_cache_path)
 
         self.tools = None
 
+        # Everything besides the prompt that decides what a generation produces (see completion_cache.py)
+        self.lora_model_path = lora_model_path
+        self.sampling = {name: getattr(rkllm_param, name) for name in (
+            "max_new_tokens", "top_k", "top_p", "temperature", "repeat_penalty", "frequency_penalty",
+            "presence_penalty", "mirostat", "mirostat_tau", "mirostat_eta")}
+
+        # Conversation currently held in the KV cache (see session.py), and whether
+        # the cache holds any history at all (set by keep_history runs, reset by a clear)
+        self.kv_session = None
+        self.kv_history = False
+
+        # Single long-lived thread that owns every rkllm_run call
+        self._jobs = queue.Queue()
+        self.current = None
+        self._worker = threading.Thread(target=self._work_loop, name="rkllm-npu", daemon=True)
+        self._worker.start()
+
+    def submit(self, ctx: InferenceContext) -> InferenceContext:
+        """Queues a context for the NPU worker and returns it for the caller to consume."""
+        ctx.model = self
+        ctx.submitted_at = time.monotonic()
+        self._jobs.put(ctx)
+        return ctx
+
+    def _work_loop(self):
+        while True:
+            ctx = self._jobs.get()
+            if ctx is None:
+                return
+            if ctx.cancelled:
+                ctx.settle()
+                continue
+
+            with _contexts_lock:
+                _contexts[ctx.id] = ctx
+            self.current = ctx
+            ctx.started_at = time.monotonic()
+            # Only a session hit continues the conversation in the KV cache; anything
+            # else (a new conversation, embeddings, one-off prompts) starts from a clean one
+            continues = ctx.session is not None and not ctx.clear_kv and self.kv_session is not None
+            clear_kv = ctx.clear_kv or (self.kv_history and not continues)
+            # The cache is in flux until the run ends; nobody may plan against it meanwhile
+            self.kv_session = None
+            try:
+                if clear_kv:
+                    self.clear_kv_cache()
+                    self.kv_history = False
+                wanted = self.prompt_cache_path if ctx.prompt_cache is None else ctx.prompt_cache
+                if clear_kv or wanted != self.loaded_prompt_cache:
+                    self.load_prompt_cache(wanted)
+                self.rkllm_infer_params.keep_history = 1 if ctx.session is not None else 0
+                if ctx.session is not None:
+                    self.kv_history = True
+                if ctx.kind == InferenceContext.EMBED:
+                    self.get_embeddings(ctx.prompts, ctx)
+                elif ctx.kind == InferenceContext.PREFILL:
+                    self.save_prefill(ctx.prompt, ctx.save_prompt_cache, ctx)
+                else:
+                    self.run(ctx.role, ctx.enable_thinking, ctx.prompt, ctx)
+            except Exception as e:
+                ctx.fail(e)
+            finally:
+                if ctx.perf is not None:
+                    metrics.record_perf(ctx.kind, ctx.perf)
+                # Only a run that completed normally leaves a reusable conversation behind
+                completed = ctx.session is not None and not ctx.cancelled and ctx.state == LLMCallState.RKLLM_RUN_FINISH
+                if completed:
+                    ctx.session.ctx = ctx
+                # Otherwise kv_history stays set, so the partial conversation an aborted or
+                # failed run leaves behind is cleared before the next job
+                self.kv_session = ctx.session if completed else None
+                self.current = None
+                with _contexts_lock:
+                    _contexts.pop(ctx.id, None)
+                ctx.settle()
+
     def set_function_tools(self, system_prompt, tools, tool_response_str):
         if self.tools is None or not self.tools == tools:
             self.tools = tools
@@ -326,107 +593,258 @@ class RKLLM(object):
                                      ctypes.c_char_p(tools.encode('utf-8')),
                                      ctypes.c_char_p(tool_response_str.encode('utf-8')))
 
-    def run(self, role, enable_thinking, prompt):
+    def run(self, role, enable_thinking, prompt, ctx: InferenceContext):
         rkllm_input = RKLLMInput()
         rkllm_input.role = role.encode('utf-8') if role is not None else "user".encode('utf-8')
         rkllm_input.enable_thinking = ctypes.c_bool(enable_thinking if enable_thinking is not None else False)
-        rkllm_input.input_type = RKLLMInputType.RKLLM_INPUT_PROMPT
-        rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
-        self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(self.rkllm_infer_params), None)
-
-    def get_embedding(self, prompt):
-        """Switches the NPU to embedding mode, extracts vectors, and switches back."""
+        if ctx.image_embeds is not None:
+            # The runtime puts one image's embedding at each <image> placeholder; count the
+            # images actually encoded, not the placeholders (user text may contain one too)
+            n_image, n_image_tokens = ctx.image_embeds.shape[:2]
+            multimodal = rkllm_input.input_data.multimodal_input
+            rkllm_input.input_type = RKLLMInputType.RKLLM_INPUT_MULTIMODAL
+            multimodal.prompt = ctypes.c_char_p(prompt.encode('utf-8'))
+            multimodal.image_embed = ctx.image_embeds.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+            multimodal.n_image_tokens = n_image_tokens
+            multimodal.n_image = n_image
+            multimodal.image_width = ctx.image_size
+            multimodal.image_height = ctx.image_size
+        else:
+            rkllm_input.input_type = RKLLMInputType.RKLLM_INPUT_PROMPT
+            rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
+        self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(self.rkllm_infer_params), ctx.userdata)
+
+    def get_embeddings(self, prompts, ctx: InferenceContext):
+        """
+        Switches the NPU to embedding mode (prefill only), extracts vectors, and switches back.
+        Up to n_batch prompts go through the NPU in a single run.
+        """
+        if len(prompts) > self.n_batch:
+            raise ValueError(f"{len(prompts)} inputs in one run, but the runtime takes at most {self.n_batch}")
+        ctx.n_results = len(prompts)
         self.rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER
 
-        rkllm_input = RKLLMInput()
-        rkllm_input.role = b"user"
-        rkllm_input.enable_thinking = False
-        rkllm_input.input_type = RKLLMInputType.RKLLM_INPUT_PROMPT
-        rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
-
-        self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(self.rkllm_infer_params), None)
-
-        self.rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
+        rkllm_inputs = (RKLLMInput * len(prompts))()
+        for rkllm_input, prompt in zip(rkllm_inputs, prompts):
+            rkllm_input.role = b"user"
+            rkllm_input.enable_thinking = False
+            rkllm_input.input_type = RKLLMInputType.RKLLM_INPUT_PROMPT
+            rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
+
+        try:
+            self.rkllm_run(self.handle, rkllm_inputs, ctypes.byref(self.rkllm_infer_params), ctx.userdata)
+        finally:
+            self.rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
+
+    def save_prefill(self, prompt, path, ctx: InferenceContext):
+        """Prefills `prompt` without decoding and saves the resulting KV cache to `path`."""
+        cache_params = RKLLMPromptCacheParam()
+        cache_params.save_prompt_cache = 1
+        cache_params.prompt_cache_path = ctypes.c_char_p(path.encode('utf-8'))
+        self.rkllm_infer_params.prompt_cache_params = ctypes.pointer(cache_params)
+        try:
+            self.get_embeddings([prompt], ctx)
+        finally:
+            self.rkllm_infer_params.prompt_cache_params = None
+
+    def load_prompt_cache(self, path):
+        """Swaps the prompt cache prepended to subsequent runs; an empty path just releases it."""
+        if self.loaded_prompt_cache:
+            self.rkllm_release_prompt_cache(self.handle)
+            self.loaded_prompt_cache = None
+        if path:
+            ret = self.rkllm_load_prompt_cache(self.handle, ctypes.c_char_p(path.encode('utf-8')))
+            if ret != 0:
+                raise RuntimeError(f"Failed to load prompt cache: {path}")
+            self.loaded_prompt_cache = path
+
+    def clear_kv_cache(self):
+        return self.rkllm_clear_kv_cache(self.handle, 0, None, None)
 
     def abort(self):
         return self.rkllm_abort(self.handle)
 
     def release(self):
+        self._jobs.put(None)
+        self._worker.join(timeout=10.0)
         self.rkllm_destroy(self.handle)
 
 
-def get_RKLLM_output(rkllm_model, chat_formatted):
-    """
-    Generator function to stream tokens from the RKLLM runtime.
-    """
-    global global_state
+def record_run_spans(trace, ctx: InferenceContext):
+    """Worker handoff, prefill (until the first token) and decode of a run, from the context's timestamps."""
+    end = ctx.finished_at or time.monotonic()
+    trace.span("dispatch", ctx.submitted_at, ctx.started_at or end)
+    if ctx.kind != InferenceContext.GENERATE:
+        # Not "prefill": that is the prefill phase of a generation in the same trace
+        trace.span("prompt_cache_prefill" if ctx.kind == InferenceContext.PREFILL else ctx.kind, ctx.started_at, end)
+        return
+    trace.span("prefill", ctx.started_at, ctx.first_token_at or end)
+    trace.span("decode", ctx.first_token_at, end)
 
-    while not output_queue.empty():
-        output_queue.get_nowait()
 
-    global_state = -1
+async def wait_settled(ctx: InferenceContext):
+    """
+    Waits until the worker is through with `ctx`. Callers do this before giving
+    up their ticket, so an aborted run cannot overlap the next request and the
+    next plan_session sees the final kv_session.
+    """
+    await asyncio.shield(asyncio.wrap_future(ctx.done))
 
-    model_thread = threading.Thread(target=rkllm_model.run, args=('system', True, chat_formatted,))
-    model_thread.start()
 
+async def get_RKLLM_output(rkllm_model, chat_formatted, session=None, on_complete=None, limits=None):
+    """
+    Async generator that streams tokens from the NPU worker.
+    Closing it early (e.g. client disconnect) aborts the run.
+    Pass a SessionPlan (see session.py) to keep the conversation in the KV cache.
+    `limits` (a GenerationLimits) can end the run early with rkllm_abort; it
+    records why the run ended. `on_complete` receives the emitted text of a
+    run that ended normally or on a token/stop-string limit.
+    With a vision encoder configured, the prompt's images go in as embeddings.
+    """
+    limits = limits if limits is not None else GenerationLimits()
+    trace = tracing.current()
+    tag = f" [{trace.id}]" if trace is not None else ""
+    # Images the prompt points at must outlive the run, whatever the store's TTL or budget
+    held_images = image_store.hold(chat_formatted)
+    try:
+        chat_formatted, image_embeds = await vision_encoder.encode_prompt(chat_formatted)
+    except BaseException:
+        image_store.release(held_images)
+        raise
+    ctx = rkllm_model.submit(InferenceContext(InferenceContext.GENERATE, chat_formatted,
+                                              loop=asyncio.get_running_loop(),
+                                              session=session.record if session is not None else None,
+                                              clear_kv=session is not None and session.clear_kv,
+                                              prompt_cache=session.prompt_cache if session is not None else None,
+                                              image_embeds=image_embeds, image_size=vision_encoder.image_size,
+                                              request_id=trace.id if trace is not None else None))
+    emitted = []
+    echo = token_log.isEnabledFor(logging.DEBUG)
     try:
         while True:
-            item = output_queue.get()
-
-            if item is None:
+            try:
+                remaining = limits.remaining()
+                if remaining is None:
+                    item = await ctx.__anext__()
+                else:
+                    item = await asyncio.wait_for(ctx.__anext__(), remaining)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                limits.finish_reason = "timeout"
                 break
 
-            if isinstance(item, Exception):
-                raise item
+            if not limits.completion_tokens:
+                metrics.time_to_first_token.observe(time.monotonic() - limits.created_at)
+            text = limits.feed(item)
+            if echo:
+                token_log.debug(item)
+            if text:
+                emitted.append(text)
+                yield text
+            if limits.finish_reason is not None:
+                break
 
-            print(item, end="", flush=True)
-            yield item
+        if limits.aborted:
+            # Cancelling marks the run as cut short, so its KV cache is not kept as a session
+            print(f"\n[Info]{tag} Generation limit reached ({limits.finish_reason}), aborting RKLLM inference...")
+            ctx.cancel()
+        if limits.finish_reason != "stop_sequence":
+            tail = limits.flush()
+            if tail:
+                emitted.append(tail)
+                yield tail
+        if limits.finish_reason is None:
+            limits.finish_reason = "stop"
+        # An aborted run may still report RKLLMPerfStat until the worker is through with it
+        await wait_settled(ctx)
+        if ctx.perf is not None:
+            limits.record_perf(ctx.perf)
+        else:
+            n_image_tokens = image_embeds.shape[0] * image_embeds.shape[1] if image_embeds is not None else 0
+            limits.estimate_prompt(int(round(estimate_token_offsets(chat_formatted)[-1])) + n_image_tokens)
 
-    except GeneratorExit:
-        print("\n[Info] Client disconnected! Aborting RKLLM inference...")
-        rkllm_model.abort()
-        raise
+        completed = limits.finish_reason in ("stop_sequence", "length") or (
+            not ctx.cancelled and ctx.state == LLMCallState.RKLLM_RUN_FINISH)
+        if on_complete is not None and completed:
+            on_complete(emitted)
 
     except Exception as e:
-        print(f"\n[Error] Inference error: {e}")
-        rkllm_model.abort()
+        print(f"\n[Error]{tag} Inference error: {e}")
         raise
 
     finally:
-        if model_thread.is_alive():
-            model_thread.join(timeout=10.0)
-            if model_thread.is_alive():
-                print("\n[Warning] Inference thread did not stop within timeout.")
-        print("\n[Info] Inference thread finished.")
-
+        if not ctx.finished:
+            if not ctx.cancelled:
+                print(f"\n[Info]{tag} Client disconnected! Aborting RKLLM inference...")
+            ctx.cancel()
+        await wait_settled(ctx)
+        image_store.release(held_images)
+        if trace is not None:
+            record_run_spans(trace, ctx)
+            trace.attributes.update(finish_reason=limits.finish_reason, prompt_tokens=limits.prompt_tokens,
+                                    completion_tokens=limits.completion_tokens)
+        print(f"\n[Info]{tag} Inference finished.")
 
-def get_RKLLM_embeddings(rkllm_model, text: str):
-    """Blocking function to retrieve embeddings securely via the queue."""
-    global global_state
 
-    while not output_queue.empty():
-        output_queue.get_nowait()
+async def get_RKLLM_embeddings(rkllm_model, text: str, pooling: str = "last"):
+    """Runs an embedding job on the NPU worker and waits for its float32 vector."""
+    return (await get_RKLLM_embeddings_batch(rkllm_model, [text], pooling))[0]
 
-    global_state = -1
 
-    thread = threading.Thread(target=rkllm_model.get_embedding, args=(text,))
-    thread.start()
-
-    embedding_vector = []
+async def get_RKLLM_embeddings_batch(rkllm_model, texts, pooling: str = "last", usage: dict = None):
+    """
+    Embeds many texts at once: duplicates are embedded once, inputs are sorted
+    by length so each n_batch group has similar prefill cost, all groups are
+    queued on the worker back to back, and results come back in input order.
+    Tokens prefilled for them (from RKLLMPerfStat) are added to usage["prompt_tokens"].
+    """
+    unique = list(dict.fromkeys(texts))
+    unique.sort(key=len)
+    size = max(1, rkllm_model.n_batch)
+    loop = asyncio.get_running_loop()
+
+    ctxs = [rkllm_model.submit(InferenceContext(InferenceContext.EMBED, unique[i:i + size], role="user",
+                                                enable_thinking=False, loop=loop, pooling=pooling))
+            for i in range(0, len(unique), size)]
     try:
-        while True:
-            item = output_queue.get()
-            if item is None:
-                break
-            if isinstance(item, Exception):
-                raise item
-            if isinstance(item, dict) and "embedding" in item:
-                embedding_vector = item["embedding"]
+        for ctx in ctxs:
+            async for _ in ctx:
+                pass
     finally:
-        thread.join()
-
-    return embedding_vector
-
-
-def get_global_state():
-    return global_state
\ No newline at end of file
+        for ctx in ctxs:
+            ctx.cancel()
+        for ctx in ctxs:
+            await wait_settled(ctx)
+        trace = tracing.current()
+        if trace is not None:
+            for ctx in ctxs:
+                record_run_spans(trace, ctx)
+
+    if usage is not None:
+        usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + sum(
+            ctx.perf["prefill_tokens"] for ctx in ctxs if ctx.perf is not None)
+
+    empty = np.zeros(0, dtype=np.float32)
+    vectors = {}
+    for ctx in ctxs:
+        for text, vector in zip(ctx.prompts, ctx.embeddings):
+            vectors[text] = vector if vector is not None else empty
+    return [vectors[text] for text in texts]
+
+
+async def save_RKLLM_prompt_cache(rkllm_model, prefix: str, path: str):
+    """Prefills `prefix` from an empty KV cache and saves it as a reusable prompt cache file."""
+    ctx = rkllm_model.submit(InferenceContext(InferenceContext.PREFILL, prefix, enable_thinking=False,
+                                              loop=asyncio.get_running_loop(), clear_kv=True,
+                                              prompt_cache="", save_prompt_cache=path))
+    try:
+        async for _ in ctx:
+            pass
+    finally:
+        ctx.cancel()
+        await wait_settled(ctx)
+        trace = tracing.current()
+        if trace is not None:
+            record_run_spans(trace, ctx)
+    return ctx.state == LLMCallState.RKLLM_RUN_FINISH
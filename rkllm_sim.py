@@ -0,0 +1,228 @@
+import ctypes
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from rkllm import (LLMCallState, RKLLMInferMode, RKLLMInputType, RKLLMResult)
+
+# Text the simulated model "generates"; each entry is one token
+VOCABULARY = (" the", " NPU", " model", " runs", " on", " a", " Rockchip", " board", " and", " streams", " tokens",
+              " quickly", ",", " while", " prefill", " costs", " more", " per", " batch", ".", " It", " answers",
+              " every", " request", " in", " order", " with", " simulated", " latency")
+
+
+def _target(arg):
+    """The object behind a ctypes.byref() argument; arrays and pointers pass through."""
+    return getattr(arg, "_obj", arg)
+
+
+class SimulatedRuntime(object):
+    """
+    Stand-in for librkllmrt.so with the same functions and callback protocol,
+    for running the server without an NPU (pass it to RKLLM(runtime=...)).
+
+    Runs sleep for `prefill_ms_per_token` per prompt token and
+    1/`decode_tokens_per_s` per generated token, each scaled by a random
+    factor in 1 ± `jitter`. Every token arrives as a RUN_NORMAL callback and
+    the run ends with RUN_FINISH carrying RKLLMPerfStat, or with RUN_ERROR on
+    context overflow or with probability `error_rate`. Hidden-state runs
+    return deterministic vectors of `embd_size`. rkllm_abort stops the run
+    after `abort_latency_ms`; the aborted run ends with RUN_FINISH only if
+    `finish_on_abort`. Replies depend only on the prompt, as with greedy
+    decoding, so completion caching behaves as on the device.
+
+    Prompts are counted as one token per 4 characters.
+    """
+
+    # Hidden-state runs over an array of inputs report one RKLLMResult per input (see RKLLM.n_batch)
+    batched_results = True
+
+    def __init__(self, prefill_ms_per_token: float = 2.0, decode_tokens_per_s: float = 15.0, jitter: float = 0.1,
+                 error_rate: float = 0.0, reply_tokens: int = 64, embd_size: int = 1536, memory_mb: float = 1500.0,
+                 abort_latency_ms: float = 0.0, finish_on_abort: bool = False, seed: int = 0):
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.decode_tokens_per_s = decode_tokens_per_s
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.embd_size = embd_size
+        self.memory_mb = memory_mb
+        self.abort_latency_ms = abort_latency_ms
+        self.finish_on_abort = finish_on_abort
+        self._random = random.Random(seed)
+        self._callback = None
+        self._param = None
+        self._aborted = threading.Event()
+        self.kv_tokens = 0
+        self.prompt_cache_tokens = 0
+
+    # --- librkllmrt functions ---
+
+    def rkllm_init(self, handle, param, callback) -> int:
+        self._param = _target(param)
+        self._callback = callback
+        _target(handle).value = id(self)
+        return 0
+
+    def rkllm_run(self, handle, rkllm_input, infer_param, userdata) -> int:
+        self._aborted.clear()
+        inputs = list(rkllm_input) if isinstance(rkllm_input, ctypes.Array) else [_target(rkllm_input)]
+        params = _target(infer_param)
+        if params.mode == RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER:
+            return self._hidden_states(inputs, params, userdata)
+        return self._generate(inputs[0], params, userdata)
+
+    def rkllm_abort(self, handle) -> int:
+        if self.abort_latency_ms > 0:
+            threading.Timer(self.abort_latency_ms / 1000.0, self._aborted.set).start()
+        else:
+            self._aborted.set()
+        return 0
+
+    def rkllm_clear_kv_cache(self, handle, keep_system_prompt, start_pos, end_pos) -> int:
+        self.kv_tokens = self.prompt_cache_tokens
+        return 0
+
+    def rkllm_load_prompt_cache(self, handle, path) -> int:
+        path = getattr(path, "value", path).decode("utf-8")
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.prompt_cache_tokens = json.load(f)["tokens"]
+        except (OSError, ValueError, KeyError):
+            return -1
+        self.kv_tokens = self.prompt_cache_tokens
+        return 0
+
+    def rkllm_release_prompt_cache(self, handle) -> int:
+        self.prompt_cache_tokens = 0
+        return 0
+
+    def rkllm_set_chat_template(self, handle, system_prompt, prompt_prefix, prompt_postfix) -> int:
+        return 0
+
+    def rkllm_set_function_tools(self, handle, system_prompt, tools, tool_response_str) -> int:
+        return 0
+
+    def rkllm_load_lora(self, handle, lora_adapter) -> int:
+        return 0
+
+    def rkllm_destroy(self, handle) -> int:
+        return 0
+
+    # --- Simulation ---
+
+    def _scaled(self, seconds: float) -> float:
+        return seconds * (1.0 + self._random.uniform(-self.jitter, self.jitter))
+
+    @staticmethod
+    def _count_tokens(text: bytes) -> int:
+        return max(1, len(text) // 4)
+
+    @staticmethod
+    def _prompt(rkllm_input) -> tuple:
+        """Prompt text and its token count, including image tokens of a multimodal input."""
+        if rkllm_input.input_type == RKLLMInputType.RKLLM_INPUT_MULTIMODAL:
+            multimodal = rkllm_input.input_data.multimodal_input
+            text = multimodal.prompt or b""
+            return text, SimulatedRuntime._count_tokens(text) + multimodal.n_image_tokens * multimodal.n_image
+        text = rkllm_input.input_data.prompt_input or b""
+        return text, SimulatedRuntime._count_tokens(text)
+
+    def _emit(self, userdata, state: int, result: RKLLMResult = None):
+        self._callback(ctypes.pointer(result) if result is not None else None, userdata, state)
+
+    def _fail(self, userdata) -> int:
+        self._emit(userdata, LLMCallState.RKLLM_RUN_ERROR)
+        return -1
+
+    def _prefill(self, n_tokens: int) -> bool:
+        """Sleeps for the prefill of `n_tokens`; False if aborted meanwhile."""
+        return not self._aborted.wait(self._scaled(n_tokens * self.prefill_ms_per_token / 1000.0))
+
+    def _perf(self, result: RKLLMResult, prefill_tokens: int, prefill_s: float, generate_tokens: int, generate_s: float):
+        result.perf.prefill_tokens = prefill_tokens
+        result.perf.prefill_time_ms = prefill_s * 1000.0
+        result.perf.generate_tokens = generate_tokens
+        result.perf.generate_time_ms = generate_s * 1000.0
+        result.perf.memory_usage_mb = self.memory_mb + self.kv_tokens * 0.1
+
+    def _generate(self, rkllm_input, params, userdata) -> int:
+        text, n_prompt = self._prompt(rkllm_input)
+        param = self._param
+        if self.kv_tokens + n_prompt >= param.max_context_len:
+            return self._fail(userdata)
+
+        start = time.monotonic()
+        if not self._prefill(n_prompt):
+            return self._finish_aborted(userdata, n_prompt, start, 0, start)
+        first_token = time.monotonic()
+        self.kv_tokens += n_prompt
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._fail(userdata)
+
+        words = random.Random(hashlib.sha256(text).digest())
+        limit = min(self.reply_tokens, param.max_new_tokens, param.max_context_len - self.kv_tokens)
+        interval = 1.0 / self.decode_tokens_per_s if self.decode_tokens_per_s > 0 else 0.0
+        generated = 0
+        while generated < limit:
+            if self._aborted.wait(self._scaled(interval)):
+                return self._finish_aborted(userdata, n_prompt, start, generated, first_token)
+            result = RKLLMResult()
+            token = VOCABULARY[words.randrange(len(VOCABULARY))].encode("utf-8")
+            result.text = token
+            result.token_id = words.randrange(32000)
+            generated += 1
+            self.kv_tokens += 1
+            self._emit(userdata, LLMCallState.RKLLM_RUN_NORMAL, result)
+
+        result = RKLLMResult()
+        self._perf(result, n_prompt, first_token - start, generated, time.monotonic() - first_token)
+        if not params.keep_history:
+            self.kv_tokens = self.prompt_cache_tokens
+        self._emit(userdata, LLMCallState.RKLLM_RUN_FINISH, result)
+        return 0
+
+    def _finish_aborted(self, userdata, n_prompt: int, start: float, generated: int, first_token: float) -> int:
+        self.kv_tokens = self.prompt_cache_tokens
+        if self.finish_on_abort:
+            result = RKLLMResult()
+            self._perf(result, n_prompt, first_token - start, generated, time.monotonic() - first_token)
+            self._emit(userdata, LLMCallState.RKLLM_RUN_FINISH, result)
+        return 0
+
+    def _hidden_states(self, inputs, params, userdata) -> int:
+        """Prefill-only run: one last-hidden-layer result per input, or a saved prompt cache."""
+        prompts = [self._prompt(rkllm_input) for rkllm_input in inputs]
+        n_tokens = sum(n for _, n in prompts)
+        if any(n >= self._param.max_context_len for _, n in prompts):
+            return self._fail(userdata)
+        start = time.monotonic()
+        if not self._prefill(n_tokens):
+            return self._finish_aborted(userdata, n_tokens, start, 0, start)
+
+        cache_params = params.prompt_cache_params.contents if params.prompt_cache_params else None
+        if cache_params is not None and cache_params.save_prompt_cache:
+            path = cache_params.prompt_cache_path.decode("utf-8")
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"tokens": n_tokens, "simulated": True}, f)
+
+        results = (RKLLMResult * len(prompts))()
+        # The arrays must outlive the callback, which reads them through raw pointers
+        hidden = []
+        for result, (text, n) in zip(results, prompts):
+            rng = np.random.default_rng(int.from_bytes(hashlib.sha256(text).digest()[:8], "little"))
+            states = rng.standard_normal((n, self.embd_size), dtype=np.float32)
+            hidden.append(states)
+            result.last_hidden_layer.hidden_states = states.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+            result.last_hidden_layer.embd_size = self.embd_size
+            result.last_hidden_layer.num_tokens = n
+        self._perf(results[0], n_tokens, time.monotonic() - start, 0, 0.0)
+        self._callback(ctypes.cast(results, ctypes.POINTER(RKLLMResult)), userdata, LLMCallState.RKLLM_RUN_FINISH)
+        self.kv_tokens = self.prompt_cache_tokens
+        return 0
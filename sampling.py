@@ -0,0 +1,108 @@
+import math
+from typing import Dict, List, Optional, Tuple
+
+# How to treat requests whose sampling settings the loaded model cannot honour:
+# "nearest" serves them with the model's profile and reports what was adjusted,
+# "strict" rejects them with a 400.
+policy = "nearest"
+
+# Field -> (type, minimum, maximum); bounds are inclusive
+FIELDS = {
+    "top_k": (int, 0, 1024),
+    "top_p": (float, 0.0, 1.0),
+    "temperature": (float, 0.0, 2.0),
+    "repeat_penalty": (float, 0.0, 2.0),
+    "frequency_penalty": (float, -2.0, 2.0),
+    "presence_penalty": (float, -2.0, 2.0),
+    "mirostat": (int, 0, 2),
+    "mirostat_tau": (float, 0.0, 10.0),
+    "mirostat_eta": (float, 0.0, 1.0),
+}
+
+# Fields that stop mattering once decoding is greedy (top_k == 1 or temperature == 0)
+GREEDY_IRRELEVANT = ("top_k", "top_p", "temperature")
+
+
+class SamplingError(ValueError):
+    """Raised for sampling settings that are invalid or, under the strict policy, unsupported."""
+
+
+class SamplingProfile(object):
+    """
+    A complete set of sampling settings.
+
+    The RKLLM runtime only takes sampling settings in rkllm_init (RKLLMInferParam
+    has no sampling fields), so every run uses the profile the model was loaded
+    with. Requests are resolved against it: settings it already satisfies pass,
+    the rest are adjusted to it or rejected depending on `policy`.
+    """
+
+    def __init__(self, values: Dict[str, float]):
+        self.values = {name: values[name] for name in FIELDS}
+
+    @classmethod
+    def native(cls, rkllm_model) -> "SamplingProfile":
+        return cls(rkllm_model.sampling)
+
+    @property
+    def greedy(self) -> bool:
+        return self.values["top_k"] == 1 or self.values["temperature"] == 0
+
+    def to_dict(self) -> dict:
+        return {name: round(value, 6) if isinstance(value, float) else value for name, value in self.values.items()}
+
+    def differs(self, other: "SamplingProfile") -> List[str]:
+        """Fields whose difference would change what decoding produces."""
+        ignored = GREEDY_IRRELEVANT if self.greedy and other.greedy else ()
+        return [name for name in FIELDS if name not in ignored and not math.isclose(
+            float(self.values[name]), float(other.values[name]), rel_tol=1e-6, abs_tol=1e-6)]
+
+
+def validate_sampling(requested: Dict[str, object]) -> Dict[str, float]:
+    """Checks type and range of every requested field; unset (None) fields are dropped."""
+    values = {}
+    for name, value in requested.items():
+        if value is None:
+            continue
+        if name not in FIELDS:
+            raise SamplingError(f"Unknown sampling parameter: {name}")
+        kind, low, high = FIELDS[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise SamplingError(f"{name} must be a number")
+        if kind is int and value != int(value):
+            raise SamplingError(f"{name} must be an integer")
+        if not low <= value <= high:
+            raise SamplingError(f"{name} must be between {low} and {high}, got {value}")
+        values[name] = kind(value)
+    return values
+
+
+def resolve_sampling(rkllm_model, requested: Dict[str, object]) -> Tuple[SamplingProfile, List[str]]:
+    """
+    Returns the profile a request will actually run with and the names of the
+    requested fields it does not honour. Raises SamplingError for invalid
+    values, and for unsupported ones under the strict policy.
+    """
+    values = validate_sampling(requested)
+    profile = SamplingProfile.native(rkllm_model)
+    wanted = SamplingProfile({**profile.values, **values})
+    adjusted = [name for name in profile.differs(wanted) if name in values]
+    if adjusted and policy == "strict":
+        raise SamplingError("The loaded model only supports its startup sampling profile "
+                            f"({profile.to_dict()}); cannot apply: {', '.join(adjusted)}")
+    return profile, adjusted
+
+
+def sampling_headers(adjusted: List[str]) -> dict:
+    return {"X-Sampling-Adjusted": ",".join(adjusted)} if adjusted else {}
+
+
+def pick(source: Optional[dict], names=tuple(FIELDS)) -> Dict[str, object]:
+    """Collects sampling fields from a request body or options dict, mapping aliases."""
+    aliases = {"repetition_penalty": "repeat_penalty"}
+    picked = {}
+    for key, value in (source or {}).items():
+        name = aliases.get(key, key)
+        if name in names and value is not None:
+            picked[name] = value
+    return picked
@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import math
+import time
+from collections import deque
+from enum import IntEnum
+
+import metrics
+import tracing
+
+
+class Priority(IntEnum):
+    """Admission classes, lower value is served first."""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class QueueRejected(Exception):
+    """Raised when a request cannot be admitted to the NPU queue."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+_ticket_ids = itertools.count(1)
+
+
+class Ticket(object):
+    """
+    Grants exclusive use of the NPU to one request.
+    Must be released exactly once; extra releases are ignored.
+    """
+
+    def __init__(self, scheduler, priority: Priority, position: int):
+        self.id = next(_ticket_ids)
+        self.priority = priority
+        self.position = position
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        self._scheduler = scheduler
+        self._future = None
+
+    @property
+    def wait_time(self) -> float:
+        end = self.granted_at if self.granted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    def headers(self) -> dict:
+        return {
+            "X-Queue-Position": str(self.position),
+            "X-Queue-Wait-Ms": str(int(self.wait_time * 1000)),
+        }
+
+    def release(self):
+        self._scheduler.release(self)
+
+
+class NPUScheduler(object):
+    """
+    Bounded, asyncio-aware admission queue in front of the NPU.
+
+    Requests wait as futures on the event loop (not in worker threads), are
+    served FIFO within a priority class, and background requests that have
+    waited longer than `starvation_after` seconds jump ahead of interactive ones.
+    """
+
+    def __init__(self, max_depth: int = 16, max_wait: float = 30.0, starvation_after: float = 10.0):
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.starvation_after = starvation_after
+        self._waiting = {p: deque() for p in Priority}
+        self._holder = None
+        self._loop = None
+        self._avg_hold = 5.0
+
+    def configure(self, max_depth: int = None, max_wait: float = None, starvation_after: float = None):
+        if max_depth is not None:
+            self.max_depth = max_depth
+        if max_wait is not None:
+            self.max_wait = max_wait
+        if starvation_after is not None:
+            self.starvation_after = starvation_after
+
+    @property
+    def busy(self) -> bool:
+        return self._holder is not None
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    def snapshot(self) -> dict:
+        return {
+            "busy": self.busy,
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "waiting": {p.name.lower(): len(q) for p, q in self._waiting.items()},
+            "avg_hold_s": round(self._avg_hold, 3),
+        }
+
+    def estimate_wait(self, ahead: int) -> int:
+        return max(1, math.ceil(self._avg_hold * (ahead + 1)))
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE) -> Ticket:
+        """Waits for the NPU. Raises QueueRejected when the queue is full or max_wait elapses."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop and self._holder is None and self.depth() == 0:
+            self._loop = loop
+
+        ahead = (1 if self._holder is not None else 0) + sum(
+            len(q) for p, q in self._waiting.items() if p <= priority)
+        ticket = Ticket(self, priority, ahead)
+
+        if self._holder is None and self.depth() == 0:
+            self._grant(ticket)
+            tracing.span("queue_wait", ticket.enqueued_at, ticket.granted_at, position=ticket.position)
+            return ticket
+
+        if self.depth() >= self.max_depth:
+            raise QueueRejected("queue_full", self.estimate_wait(self.depth()))
+
+        ticket._future = self._loop.create_future()
+        self._waiting[priority].append(ticket)
+        try:
+            await asyncio.wait_for(ticket._future, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._discard(ticket)
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueRejected("queue_timeout", self.estimate_wait(self.depth())) from None
+            raise
+        tracing.span("queue_wait", ticket.enqueued_at, ticket.granted_at, position=ticket.position)
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """Thread-safe; may be called from threadpool workers."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is None or running is self._loop:
+            self._release(ticket)
+        else:
+            self._loop.call_soon_threadsafe(self._release, ticket)
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted_at = time.monotonic()
+        self._holder = ticket
+        metrics.queue_wait.observe(ticket.wait_time, ticket.priority.name.lower())
+
+    def _discard(self, ticket: Ticket):
+        # The grant may have landed between the timeout firing and the waiter resuming
+        if ticket._future is not None and ticket._future.done() and not ticket._future.cancelled():
+            self._release(ticket)
+            return
+        try:
+            self._waiting[ticket.priority].remove(ticket)
+        except ValueError:
+            pass
+
+    def _release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if self._holder is not ticket:
+            return
+        hold = time.monotonic() - ticket.granted_at
+        self._avg_hold = 0.8 * self._avg_hold + 0.2 * hold
+        metrics.npu_hold.observe(hold, ticket.priority.name.lower())
+        self._holder = None
+        self._dispatch()
+
+    def _next_waiter(self):
+        now = time.monotonic()
+        starved = [q[0] for q in self._waiting.values()
+                   if q and now - q[0].enqueued_at >= self.starvation_after]
+        if starved:
+            return min(starved, key=lambda t: t.enqueued_at)
+        for p in Priority:
+            if self._waiting[p]:
+                return self._waiting[p][0]
+        return None
+
+    def _dispatch(self):
+        while self._holder is None:
+            ticket = self._next_waiter()
+            if ticket is None:
+                return
+            self._waiting[ticket.priority].popleft()
+            if ticket._future.done():
+                continue
+            self._grant(ticket)
+            ticket._future.set_result(ticket)
+
+
+async def iterate_with_ticket(ticket: Ticket, iterator):
+    """
+    Relays an async token stream and releases the ticket when the stream
+    ends or the client goes away. Closing the inner stream aborts its NPU run.
+    """
+    try:
+        async for chunk in iterator:
+            yield chunk
+    finally:
+        await iterator.aclose()
+        ticket.release()
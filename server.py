@@ -1,20 +1,40 @@
+import asyncio
 import sys
 import os
 import subprocess
 import resource
 import argparse
+import time
 
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from common import hw_lock, global_state
-from rkllm import RKLLM, get_RKLLM_output
+from common import npu_scheduler, global_state
+from scheduler import Priority, QueueRejected, iterate_with_ticket
+from rkllm import RKLLM, get_RKLLM_output, get_RKLLM_embeddings, enable_token_echo
 from utils import apply_chat_template
+import session
+import limits
+import sampling
+import stream_encoder
+import metrics
+import tracing
 
 from api_openai import router as openai_router
 from api_ollama import router as ollama_router
 from api_claude import router as claude_router
+from api_cache import router as cache_router
+from api_search import router as search_router
+from prompt_cache import prompt_caches
+from embedding_cache import embedding_cache
+from completion_cache import completion_cache
+from singleflight import flights
+from vector_index import vector_index
+from tools import tool_registry
+from image_store import image_store
+from chat_template import chat_templates, guess_template, TEMPLATES
+from vision_encoder import vision_encoder, NPU_CORES
 
 app = FastAPI(title="RKLLM API Server", description="OpenAI and Ollama Compatible API (Vision & Embeddings)")
 
@@ -26,34 +46,219 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Endpoints that answer while the model is still loading
+MODEL_FREE_PATHS = {"/health", "/health/live", "/health/ready", "/metrics", "/debug/traces", "/docs", "/redoc",
+                    "/openapi.json", "/v1/models", "/api/tags", "/api/version"}
+
+# Set in __main__: builds the RKLLM instance (blocking), and what to run through it before reporting ready
+model_loader = None
+warmup_mode = "none"
+warmup_tokens = 8
+_load_task = None
+
+WARMUP_MESSAGES = [{"role": "user", "content": "Hello!"}]
+
+@app.middleware("http")
+async def require_model(request: Request, call_next):
+    """Answers 503 for anything that needs the model until it is loaded and warmed up."""
+    if global_state.status != "ready" and request.url.path not in MODEL_FREE_PATHS:
+        return JSONResponse(status_code=503, headers={"Retry-After": "5"},
+                            content={"error": f"Model is not ready ({global_state.status})"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    start = time.monotonic()
+    trace = tracing.start(request.headers.get("x-request-id"), request.url.path) if tracing.enabled else None
+    response = await call_next(request)
+    # The route template, so path parameters do not become label values
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", "other")
+    if endpoint != "/metrics":
+        metrics.requests_total.inc(endpoint, str(response.status_code))
+        metrics.request_duration.observe(time.monotonic() - start, endpoint)
+    if trace is not None:
+        trace.endpoint = endpoint
+        trace.status = response.status_code
+        response.headers["X-Request-ID"] = trace.id
+        response.body_iterator = traced_body(trace, response.body_iterator)
+    return response
+
+async def traced_body(trace, body):
+    """Times sending the response body, which for streams covers the whole generation as the client sees it."""
+    start = time.monotonic()
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        trace.span("response", start)
+        trace.finish()
+
+@app.on_event("startup")
+async def start_model_load():
+    """Loads the model in the background so the port answers (e.g. /health/live) during a multi-GB load."""
+    global _load_task
+    if model_loader is not None:
+        _load_task = asyncio.get_running_loop().create_task(load_model())
+
+async def load_model():
+    global_state.status = "loading"
+    start = time.monotonic()
+    try:
+        global_state.rkllm_model = await asyncio.to_thread(model_loader)
+    except Exception as e:
+        global_state.status = "failed"
+        global_state.error = str(e)
+        print(f"[Error] Failed to load the model: {e}")
+        return
+    print(f"[Info] Model loaded in {time.monotonic() - start:.1f}s")
+    if warmup_mode != "none":
+        global_state.status = "warming_up"
+        start = time.monotonic()
+        try:
+            await warm_up(global_state.rkllm_model, warmup_mode, warmup_tokens)
+            print(f"[Info] Warmup ({warmup_mode}) finished in {time.monotonic() - start:.1f}s")
+        except Exception as e:
+            print(f"[Warning] Warmup failed, serving anyway: {e}")
+    global_state.status = "ready"
+
+async def warm_up(model, mode: str, max_tokens: int):
+    """Runs a short generation and/or embedding so first-run costs are not paid by a user request."""
+    ticket = await npu_scheduler.acquire(Priority.BACKGROUND)
+    try:
+        if mode in ("chat", "all"):
+            async for _ in get_RKLLM_output(model, apply_chat_template(WARMUP_MESSAGES),
+                                            limits=limits.GenerationLimits(max_tokens=max_tokens)):
+                pass
+        if mode in ("embed", "all"):
+            await get_RKLLM_embeddings(model, WARMUP_MESSAGES[0]["content"])
+    finally:
+        ticket.release()
+
 app.include_router(openai_router)
 app.include_router(ollama_router)
 app.include_router(claude_router)
+app.include_router(cache_router)
+app.include_router(search_router)
 
 @app.get("/health")
 def health_check():
     """Simple health check endpoint."""
-    return {"status": "ok", "state": "idle" if not hw_lock.locked() else "busy"}
+    ready = global_state.status == "ready"
+    return {"status": "ok" if global_state.status != "failed" else "error",
+            "state": ("idle" if not npu_scheduler.busy else "busy") if ready else global_state.status,
+            "error": global_state.error, "queue": npu_scheduler.snapshot(),
+            "embedding_cache": embedding_cache.stats(), "completion_cache": completion_cache.stats(), "shared_generations": len(flights),
+            "tools": tool_registry.stats(), "images": image_store.stats(), "chat_template": chat_templates.stats(),
+            "vision_encoder": vision_encoder.stats() if vision_encoder.enabled else None,
+            "sampling": sampling.SamplingProfile.native(global_state.rkllm_model).to_dict() if global_state.rkllm_model else None}
+
+@app.get("/health/live")
+def liveness():
+    """Liveness probe: the server is up, including while the model loads; fails only if loading failed."""
+    if global_state.status == "failed":
+        return JSONResponse(status_code=503, content={"status": "failed", "error": global_state.error})
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness():
+    """Readiness probe: the model is loaded and warmed up."""
+    if global_state.status != "ready":
+        return JSONResponse(status_code=503, headers={"Retry-After": "5"}, content={"status": global_state.status})
+    return {"status": "ready", "state": "idle" if not npu_scheduler.busy else "busy"}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition of request, queue and NPU performance series."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/traces")
+def slow_traces(min_ms: float = None, limit: int = 20):
+    """Slowest recent requests with their per-phase spans (requires --trace y)."""
+    if not tracing.enabled:
+        return JSONResponse(status_code=404, content={"error": "Tracing is disabled; start the server with --trace y"})
+    found = tracing.traces.recent(tracing.slow_ms if min_ms is None else min_ms, limit)
+    return {"traces": [t.to_dict() for t in found]}
 
 @app.get("/hello")
-def test():
+async def test():
+    try:
+        ticket = await npu_scheduler.acquire(Priority.INTERACTIVE)
+    except QueueRejected as e:
+        return JSONResponse(status_code=503, headers=e.headers(), content={"error": "Server busy"})
     user_message = "Hello!"
     messages = [{'role':'user','content':user_message}]
     messages_formatted = apply_chat_template(messages)
     results = get_RKLLM_output(global_state.rkllm_model, messages_formatted)
-    def stream_generator():
-        for r in results:
+    async def stream_generator():
+        async for r in results:
             yield r
         yield '\n'
-    return StreamingResponse(stream_generator(), media_type='text/event-stream')
+    return StreamingResponse(iterate_with_ticket(ticket, stream_generator()), media_type='text/event-stream')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--rkllm_model_path', '-m', type=str, default="models/qwen3-vl-2b-instruct_w8a8_rk3588.rkllm")
     parser.add_argument('--max_context_len', '-c', type=int, default=4096)
     parser.add_argument('--target_platform', '-t', type=str, default="rk3588")
+    parser.add_argument('--n_batch', type=int, default=1, help='Inputs per NPU run for batched embeddings; librkllmrt does not declare support, so only the simulator batches')
     parser.add_argument('--lora_model_path', '-lm', type=str)
     parser.add_argument('--prompt_cache_path', type=str)
+    parser.add_argument('--prompt_cache_dir', type=str, help='Directory for the named prompt cache library (enables /v1/prompt_caches)')
+    parser.add_argument('--prompt_cache_max_mb', type=int, default=2048, help='Disk budget for the prompt cache library')
+    parser.add_argument('--embedding_cache_size', type=int, default=4096, help='Embeddings kept in memory (0 disables the memory tier)')
+    parser.add_argument('--embedding_cache_dir', type=str, help='Directory for the persistent embedding cache')
+    parser.add_argument('--completion_cache_size', type=int, default=256, help='Finished replies kept in memory for identical prompts (0 disables the memory tier)')
+    parser.add_argument('--completion_cache_ttl', type=float, default=3600, help='Seconds a cached reply stays valid (0: no expiry)')
+    parser.add_argument('--completion_cache_dir', type=str, help='Directory for the persistent completion cache')
+    parser.add_argument('--generation_timeout', type=float, default=0, help='Default wall-clock limit in seconds for one chat request (0: none; X-RKLLM-Timeout overrides)')
+    parser.add_argument('--top_k', type=int, help='Sampling profile the model is loaded with (default 1, greedy)')
+    parser.add_argument('--top_p', type=float)
+    parser.add_argument('--temperature', type=float)
+    parser.add_argument('--repeat_penalty', type=float)
+    parser.add_argument('--frequency_penalty', type=float)
+    parser.add_argument('--presence_penalty', type=float)
+    parser.add_argument('--sampling_policy', type=str, default='nearest', choices=['nearest', 'strict'],
+                        help='Requests asking for other sampling settings: serve with the loaded profile (nearest) or reject (strict)')
+    parser.add_argument('--stream_coalesce_ms', type=float, default=0, help='Group streamed tokens arriving within this many ms into one chunk (0: send each token)')
+    parser.add_argument('--stream_coalesce_chars', type=int, default=256, help='Max characters per coalesced chunk')
+    parser.add_argument('--echo_tokens', type=str, default='n', help='Print generated tokens to the console (y/n)')
+    parser.add_argument('--coalesce', type=str, default='y', help='Let identical concurrent requests share one generation (y/n)')
+    parser.add_argument('--vector_index_dir', type=str, help='Directory for persistent /v1/search collections (in-memory if unset)')
+    parser.add_argument('--image_dir', type=str, help='Directory for decoded inline images (default: rkllm_images in the temp dir)')
+    parser.add_argument('--image_cache_mb', type=int, default=256, help='Disk budget for decoded images not used by a running generation')
+    parser.add_argument('--image_ttl', type=float, default=1800, help='Seconds an unused decoded image is kept')
+    parser.add_argument('--image_tmpfs', type=str, default='n', help='Keep decoded images in /dev/shm when --image_dir is unset (y/n)')
+    parser.add_argument('--chat_template', type=str, default='auto', choices=['auto'] + list(TEMPLATES),
+                        help='Prompt format of the model (auto: guessed from the model file name, ChatML by default)')
+    parser.add_argument('--template_cache_size', type=int, default=1024, help='Rendered messages kept for reuse across turns')
+    parser.add_argument('--vision_model_path', type=str, help='Vision encoder (.rknn); images are then fed to the LLM as embeddings')
+    parser.add_argument('--vision_image_size', type=int, default=448, help='Input resolution of the vision encoder')
+    parser.add_argument('--vision_cache_size', type=int, default=32, help='Image embeddings kept in memory')
+    parser.add_argument('--vision_npu_core', type=str, default='auto', choices=list(NPU_CORES), help='NPU core(s) the vision encoder runs on')
+    parser.add_argument('--vision_img_start', type=str, default='<|vision_start|>', help="Model token opening an image")
+    parser.add_argument('--vision_img_end', type=str, default='<|vision_end|>', help="Model token closing an image")
+    parser.add_argument('--vision_img_content', type=str, default='<|image_pad|>', help="Model token standing for one image embedding")
+    parser.add_argument('--trace', type=str, default='n', help='Record per-request phase timings (y/n); see /debug/traces')
+    parser.add_argument('--trace_buffer', type=int, default=256, help='Finished traces kept in memory')
+    parser.add_argument('--trace_slow_ms', type=float, default=1000, help='Default threshold for /debug/traces')
+    parser.add_argument('--trace_export', type=str, help='Append finished traces to this file')
+    parser.add_argument('--trace_format', type=str, default='jsonl', choices=['jsonl', 'otlp'], help='Format of --trace_export')
+    parser.add_argument('--runtime', type=str, default='rkllm', choices=['rkllm', 'sim'],
+                        help='NPU runtime: librkllmrt.so, or a simulator for development and load testing without a board')
+    parser.add_argument('--sim_prefill_ms', type=float, default=2.0, help='Simulated prefill cost per prompt token in ms')
+    parser.add_argument('--sim_decode_tps', type=float, default=15.0, help='Simulated decode rate in tokens per second')
+    parser.add_argument('--sim_jitter', type=float, default=0.1, help='Random +/- fraction applied to every simulated delay')
+    parser.add_argument('--sim_error_rate', type=float, default=0.0, help='Probability that a simulated run ends with a runtime error')
+    parser.add_argument('--sim_reply_tokens', type=int, default=64, help='Tokens per simulated reply (capped by max_new_tokens)')
+    parser.add_argument('--sim_abort_ms', type=float, default=0.0, help='Simulated delay before an abort takes effect')
+    parser.add_argument('--sim_seed', type=int, default=0, help='Seed for simulated jitter and errors')
+    parser.add_argument('--warmup', type=str, default='chat', choices=['none', 'chat', 'embed', 'all'],
+                        help='Run a short generation and/or embedding after loading, before reporting ready')
+    parser.add_argument('--warmup_tokens', type=int, default=8, help='Tokens generated by the warmup generation')
+    parser.add_argument('--queue_max_depth', type=int, default=16, help='Max requests waiting for the NPU before rejecting')
+    parser.add_argument('--queue_max_wait', type=float, default=30.0, help='Max seconds a request waits for the NPU')
+    parser.add_argument('--kv_session', type=str, default='y', help='Reuse the KV cache across turns of the same conversation (y/n)')
 
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('--port', '-p', type=int, default=8080)
@@ -63,11 +268,31 @@ if __name__ == "__main__":
     rkllm_model_path = os.path.join("/rkllm_server/models/",
                                     args.rkllm_model_path) if args.isDocker.lower() == 'y' else args.rkllm_model_path
 
-    if not os.path.exists(rkllm_model_path):
+    if args.runtime == 'rkllm' and not os.path.exists(rkllm_model_path):
         print(f"[Error] RKLLM model path does not exist: {rkllm_model_path}")
         sys.exit(1)
 
     global_state.model_path = rkllm_model_path
+    npu_scheduler.configure(max_depth=args.queue_max_depth, max_wait=args.queue_max_wait)
+    session.enabled = args.kv_session.lower() == 'y'
+    if args.prompt_cache_dir:
+        prompt_caches.configure(args.prompt_cache_dir, args.prompt_cache_max_mb)
+    embedding_cache.configure(args.embedding_cache_size, args.embedding_cache_dir)
+    limits.default_timeout = args.generation_timeout
+    sampling.policy = args.sampling_policy
+    stream_encoder.window_ms = args.stream_coalesce_ms
+    stream_encoder.max_frame_chars = args.stream_coalesce_chars
+    if args.echo_tokens.lower() == 'y':
+        enable_token_echo()
+    flights.enabled = args.coalesce.lower() == 'y'
+    completion_cache.configure(args.completion_cache_size, args.completion_cache_ttl, args.completion_cache_dir)
+    if args.vector_index_dir:
+        vector_index.configure(args.vector_index_dir)
+    chat_templates.configure(guess_template(rkllm_model_path) if args.chat_template == 'auto' else args.chat_template,
+                             args.template_cache_size)
+    if args.trace.lower() == 'y':
+        tracing.configure(args.trace_buffer, args.trace_slow_ms, args.trace_export, args.trace_format)
+    image_store.configure(args.image_dir, args.image_cache_mb, args.image_ttl, args.image_tmpfs.lower() == 'y')
 
     if args.isDocker.lower() != 'y':
         fix_req_file = f"fix_freq_{args.target_platform}.sh"
@@ -80,17 +305,48 @@ if __name__ == "__main__":
 
     resource.setrlimit(resource.RLIMIT_NOFILE, (102400, 102400))
 
+    try:
+        native_sampling = sampling.validate_sampling({name: getattr(args, name, None) for name in sampling.FIELDS})
+    except sampling.SamplingError as e:
+        print(f"[Error] Invalid sampling profile: {e}")
+        sys.exit(1)
+
     config = {
-        "max_context_len": args.max_context_len
+        "max_context_len": args.max_context_len,
+        "n_batch": args.n_batch,
+        "sampling": native_sampling
     }
+    if args.vision_model_path:
+        config["vision_tokens"] = {"img_start": args.vision_img_start, "img_end": args.vision_img_end,
+                                   "img_content": args.vision_img_content}
+        print(f"[Info] Vision encoder: {args.vision_model_path}")
 
     print(f"[Info] RKLLM Model Path: {rkllm_model_path}")
     print(f"[Info] RKLLM Config: {config}")
 
-    global_state.rkllm_model = RKLLM(config, rkllm_model_path, args.lora_model_path, args.prompt_cache_path, args.target_platform)
+    runtime = None
+    if args.runtime == 'sim':
+        from rkllm_sim import SimulatedRuntime
+        runtime = SimulatedRuntime(args.sim_prefill_ms, args.sim_decode_tps, args.sim_jitter, args.sim_error_rate,
+                                   args.sim_reply_tokens, abort_latency_ms=args.sim_abort_ms, seed=args.sim_seed)
+        print(f"[Info] Simulated runtime: {args.sim_prefill_ms} ms/prefill token, {args.sim_decode_tps} decode tok/s")
+
+    def load_models():
+        if args.vision_model_path:
+            vision_encoder.configure(args.vision_model_path, args.vision_image_size, args.vision_cache_size,
+                                     args.vision_npu_core)
+        return RKLLM(config, rkllm_model_path, args.lora_model_path, args.prompt_cache_path, args.target_platform,
+                     runtime=runtime)
+
+    model_loader = load_models
+    warmup_mode = args.warmup
+    warmup_tokens = args.warmup_tokens
 
     import uvicorn
 
     uvicorn.run(app, host=args.host, port=args.port)
 
-    global_state.rkllm_model.release()
+    if global_state.rkllm_model is not None:
+        global_state.rkllm_model.release()
+    vision_encoder.release()
+    prompt_caches.flush()
@@ -0,0 +1,129 @@
+import re
+from typing import List, Dict, Optional
+
+from chat_template import chat_templates
+from prompt_cache import prompt_caches
+from rkllm import save_RKLLM_prompt_cache
+from vision_encoder import vision_encoder
+
+
+class SessionRecord(object):
+    """
+    The conversation currently held in the runtime KV cache: the messages that
+    were prefilled plus the reply the model generated for them.
+    """
+
+    def __init__(self, messages: List[Dict], thinking: bool):
+        self.messages = messages
+        self.thinking = thinking
+        self.prompt_cache = None
+        self.ctx = None
+
+    @property
+    def reply(self) -> str:
+        return "".join(self.ctx.text_parts) if self.ctx is not None else ""
+
+
+class SessionPlan(object):
+    """What to submit for one chat turn, and whether the KV cache or a prompt cache could be reused."""
+
+    def __init__(self, prompt: str, record: Optional[SessionRecord], hit: bool, prompt_cache: str = None):
+        self.prompt = prompt
+        self.record = record
+        self.hit = hit
+        self.prompt_cache = prompt_cache
+        self.prompt_cache_status = None
+        self.build_prefix = None
+        if record is not None:
+            record.prompt_cache = prompt_cache
+
+    @property
+    def clear_kv(self) -> bool:
+        return self.record is not None and not self.hit
+
+    def use_prompt_cache(self, path: str, prefix_len: int, status: str):
+        self.prompt = self.prompt[prefix_len:]
+        self.prompt_cache = path
+        self.prompt_cache_status = status
+        if self.record is not None:
+            self.record.prompt_cache = path
+
+    def headers(self) -> dict:
+        headers = {}
+        if self.record is not None:
+            headers["X-KV-Cache"] = "hit" if self.hit else "miss"
+        if self.prompt_cache_status:
+            headers["X-Prompt-Cache"] = self.prompt_cache_status
+        return headers
+
+
+enabled = True
+
+
+def _normalize_reply(content) -> str:
+    if isinstance(content, list):
+        content = "".join(item.get("text", "") for item in content if item.get("type") == "text")
+    return re.sub(r'<think>.*?</think>', '', str(content or ""), flags=re.DOTALL).strip()
+
+
+def _extends(record: SessionRecord, messages: List[Dict], thinking: bool) -> bool:
+    n = len(record.messages)
+    if record.thinking != thinking or len(messages) <= n + 1:
+        return False
+    if messages[:n] != record.messages:
+        return False
+    reply = messages[n]
+    return reply.get("role") == "assistant" and _normalize_reply(reply.get("content")) == _normalize_reply(record.reply)
+
+
+def plan_session(rkllm_model, messages: List[Dict], thinking: bool = True, cache_breakpoint: int = None) -> SessionPlan:
+    """
+    Renders the prompt for a chat turn. When `messages` extends the conversation
+    already in the KV cache by the model's own last reply, only the new suffix
+    is submitted (keep_history=1); otherwise the cache is reset and the whole
+    conversation is prefilled, starting from the longest saved prompt cache
+    that prefixes it.
+
+    `cache_breakpoint` marks the last message of a prefix the caller wants
+    cached (Anthropic cache_control); if no cache exists for it yet the plan
+    carries `build_prefix` for prepare_prompt_cache to build.
+
+    The comparison ignores <think> blocks in the previous reply, since clients
+    usually strip them; the KV cache still holds the original reasoning.
+    """
+    messages = [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+    record = SessionRecord(messages, thinking) if enabled else None
+
+    previous = getattr(rkllm_model, "kv_session", None)
+    if record is not None and previous is not None and _extends(previous, messages, thinking):
+        suffix = messages[len(previous.messages) + 1:]
+        # The cache ends right after the generated reply, so close that turn first
+        prompt = chat_templates.turn_end + chat_templates.render(suffix, thinking=thinking).prompt
+        return SessionPlan(prompt, record, True, prompt_cache=previous.prompt_cache)
+
+    rendered = chat_templates.render(messages, thinking=thinking)
+    plan = SessionPlan(rendered.prompt, record, False)
+    entry = prompt_caches.match(plan.prompt, rendered.boundaries)
+    if entry is not None:
+        plan.use_prompt_cache(prompt_caches.path(entry.key), entry.prefix_len, "hit")
+    elif cache_breakpoint is not None and prompt_caches.enabled:
+        prefix = rendered.prefix(cache_breakpoint)
+        # Prompt caches are built from text; with a vision encoder, images only go in as embeddings
+        if len(prefix) < len(plan.prompt) and not (vision_encoder.enabled and "<image>" in prefix):
+            plan.build_prefix = prefix
+    return plan
+
+
+async def prepare_prompt_cache(rkllm_model, plan: SessionPlan, label: str = "cache_control"):
+    """Builds and saves the prompt cache a plan asked for, then points the plan at it."""
+    if plan.build_prefix is None:
+        return
+    path = prompt_caches.path(prompt_caches.key(plan.build_prefix))
+    try:
+        if await save_RKLLM_prompt_cache(rkllm_model, plan.build_prefix, path):
+            prompt_caches.add(plan.build_prefix, label=label)
+            plan.use_prompt_cache(path, len(plan.build_prefix), "created")
+    except Exception as e:
+        # The request still works without the cache, it just pays the full prefill
+        print(f"[Warning] Failed to build prompt cache: {e}")
+    plan.build_prefix = None
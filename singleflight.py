@@ -0,0 +1,181 @@
+import asyncio
+from typing import Awaitable, Callable, Optional, Tuple
+
+import tracing
+
+
+class Flight(object):
+    """
+    One generation shared by every identical request that arrives while it runs.
+
+    `start` is awaited once, in a background task: it takes the NPU ticket,
+    plans the prompt and returns (headers, token stream). The task pumps the
+    stream into `tokens`; each subscriber replays what was produced so far and
+    then follows live. A subscriber leaving never stops the run for the others;
+    only when the last one has gone is the task cancelled, which closes the
+    stream and so aborts the NPU run and releases the ticket. Every request
+    counts as a subscriber from attach() until its Subscription is closed, or
+    until ready() fails.
+    """
+
+    def __init__(self, key: Optional[str], group=None, limits=None):
+        self.key = key
+        # The starting request's GenerationLimits; records how the shared run ended
+        self.limits = limits
+        self.tokens = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self._group = group
+        self._ready = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def start(self, start: Callable[[], Awaitable[Tuple[dict, object]]]):
+        self._task = asyncio.get_running_loop().create_task(self._run(start))
+
+    async def _run(self, start):
+        source = None
+        try:
+            headers, source = await start()
+            self._ready.set_result(headers)
+            async for token in source:
+                self.tokens.append(token)
+                self._wake()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("Generation cancelled")
+        except Exception as e:
+            if not self._ready.done():
+                self._ready.set_exception(e)
+            self.error = e
+        finally:
+            if not self._ready.done():
+                self._ready.cancel()
+            if source is not None:
+                await source.aclose()
+            self.finished = True
+            self._wake()
+            if self._group is not None:
+                self._group.discard(self)
+
+    def _wake(self):
+        # Swap the event so waiters that wake up re-arm on a fresh one
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def ready(self) -> dict:
+        """
+        Waits until the generation holds the NPU and returns its response headers.
+        Re-raises whatever stopped it from starting (e.g. QueueRejected); the
+        caller is then no longer subscribed.
+        """
+        try:
+            return await asyncio.shield(self._ready)
+        except BaseException:
+            self.leave()
+            raise
+
+    def leave(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.finished and self._task is not None:
+            # New identical requests must start over rather than join a dying run
+            if self._group is not None:
+                self._group.discard(self)
+            print("\n[Info] Last subscriber left, cancelling shared generation...")
+            self._task.cancel()
+
+    def subscribe(self) -> "Subscription":
+        """All tokens of the generation, from the first one; the caller must iterate or close it."""
+        return Subscription(self)
+
+    async def _follow(self):
+        index = 0
+        while True:
+            while index < len(self.tokens):
+                yield self.tokens[index]
+                index += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class Subscription(object):
+    """
+    One request's token stream from a Flight. It leaves the flight once, when
+    iteration ends for any reason or on close(). A response that is dropped
+    before its body is iterated never runs the generator's cleanup, so
+    handlers also close it once the response is done (and it closes itself
+    when collected), or the shared run would never be cancelled.
+    """
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.closed = False
+        self._tokens = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if self._tokens is None:
+            self._tokens = self.flight._follow()
+        try:
+            return await self._tokens.__anext__()
+        except BaseException:
+            self.close()
+            raise
+
+    async def aclose(self):
+        if self._tokens is not None:
+            await self._tokens.aclose()
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.leave()
+
+    def __del__(self):
+        self.close()
+
+
+class FlightGroup(object):
+    """Registry of running generations, keyed by completion_cache.key_for()."""
+
+    def __init__(self):
+        self.enabled = True
+        self._flights = {}
+
+    def attach(self, key: Optional[str], start, limits=None) -> Tuple[Flight, bool]:
+        """
+        Joins the running generation for `key`, or starts a new one with `start`.
+        Returns (flight, shared). Requests without a key never share.
+        """
+        flight = self._flights.get(key) if key is not None and self.enabled else None
+        shared = flight is not None
+        if flight is None:
+            flight = Flight(key, self, limits)
+            if key is not None and self.enabled:
+                self._flights[key] = flight
+            flight.start(start)
+        flight.subscribers += 1
+        if shared:
+            # The NPU phases are recorded in the trace of the request that started the run
+            trace = tracing.current()
+            if trace is not None:
+                trace.attributes["shared_generation"] = True
+        return flight, shared
+
+    def discard(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
+
+
+flights = FlightGroup()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+from json.encoder import encode_basestring_ascii
+
+# Stands in for the token text while a chunk template is rendered
+TOKEN = "\x00rkllm-token\x00"
+
+# Coalescing window for streamed tokens (see frames); 0 sends every token as it arrives
+window_ms = 0.0
+max_frame_chars = 256
+
+
+class ChunkEncoder(object):
+    """
+    Pre-rendered streaming chunk. The payload is serialized once with TOKEN in
+    place of the text, then split around it, so encoding a token is just
+    escaping the token and joining three strings. Output is byte-identical to
+    json.dumps of the same payload.
+    """
+
+    def __init__(self, payload: dict, before: str = "", after: str = ""):
+        head, tail = json.dumps(payload).split(encode_basestring_ascii(TOKEN), 1)
+        self.prefix = before + head
+        self.suffix = tail + after
+
+    def __call__(self, text: str) -> str:
+        return self.prefix + encode_basestring_ascii(text) + self.suffix
+
+
+def sse(payload: dict, event: str = None) -> ChunkEncoder:
+    """Server-Sent Events frame, optionally with an event name (Anthropic)."""
+    return ChunkEncoder(payload, f"event: {event}\ndata: " if event else "data: ", "\n\n")
+
+
+def ndjson(payload: dict) -> ChunkEncoder:
+    """Newline-delimited JSON frame (Ollama)."""
+    return ChunkEncoder(payload, "", "\n")
+
+
+async def frames(tokens, window: float = None, max_chars: int = None):
+    """
+    Groups a token stream into frames: after the first token of a frame,
+    further tokens are added for up to `window` ms or `max_chars` characters.
+    Fewer, larger frames cost less per token to encode and send. With a zero
+    window tokens pass straight through.
+    """
+    window = (window_ms if window is None else window) / 1000.0
+    max_chars = max_frame_chars if max_chars is None else max_chars
+    if window <= 0:
+        async for token in tokens:
+            yield token
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = tokens.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            try:
+                parts = [await pending]
+            except StopAsyncIteration:
+                pending = None
+                return
+            pending = None
+            size = len(parts[0])
+            deadline = loop.time() + window
+            ended = False
+            while size < max_chars:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                pending = asyncio.ensure_future(iterator.__anext__())
+                # wait() leaves the pending read running, so it carries over to the next frame
+                done, _ = await asyncio.wait((pending,), timeout=remaining)
+                if not done:
+                    break
+                finished, pending = pending, None
+                try:
+                    token = finished.result()
+                except StopAsyncIteration:
+                    ended = True
+                    break
+                parts.append(token)
+                size += len(token)
+            yield "".join(parts)
+            if ended:
+                return
+    finally:
+        if pending is not None:
+            # Cancelling the in-flight read also finalizes the source generator
+            pending.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
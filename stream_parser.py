@@ -0,0 +1,205 @@
+import json
+from typing import Dict, List, Tuple
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+TOOL_OPEN, TOOL_CLOSE = "<tool_call>", "</tool_call>"
+
+# Event kinds; also the parser states (inside a <tool_call> nothing is emitted until it closes)
+CONTENT, THINKING, TOOL_CALL = "content", "thinking", "tool_call"
+
+# Tags that end the current state, and the state each one switches to
+_TAGS = {
+    CONTENT: ((THINK_OPEN, THINKING), (TOOL_OPEN, TOOL_CALL)),
+    THINKING: ((THINK_CLOSE, CONTENT),),
+    TOOL_CALL: ((TOOL_CLOSE, CONTENT),),
+}
+
+
+class StreamParser(object):
+    """
+    Incremental parser for model output with <think> and <tool_call> blocks.
+
+    feed() takes the output piece by piece and returns the events that are
+    already certain, as (kind, value) pairs:
+
+        ("content", text)     reply text, outside any block
+        ("thinking", text)    text inside <think>...</think>
+        ("tool_call", call)   {"name": ..., "arguments": ...}, once </tool_call> arrives
+
+    Each character is looked at once. Only a possible partial tag at the end of
+    a piece is held back until the next piece decides it, as is whitespace that
+    would be stripped if the section ended there, so the joined events equal
+    what parse_model_output() returns for the whole text. A <tool_call> whose
+    body is not valid JSON is passed on as content, tags included.
+
+    A <think> that is never closed is not a thought either: close() passes it
+    on as content, tag included, like the regex parser did. Thinking text that
+    was already streamed cannot be taken back, so this only holds for its
+    events when they are held until </think> (`hold_thinking`, as parse_text()
+    does) or dropped (`enable_think` off).
+    """
+
+    def __init__(self, enable_think: bool = True, hold_thinking: bool = False):
+        self.enable_think = enable_think
+        self.hold_thinking = hold_thinking
+        self.state = CONTENT
+        self.tool_calls = 0
+        self._tail = ""
+        self._call = []
+        # Per section: whether text has been emitted, and trailing whitespace not yet sent
+        self._started = {CONTENT: False, THINKING: False}
+        self._space = {CONTENT: "", THINKING: ""}
+        self._think_blocks = 0
+        # Raw text of the open <think> block, and its events while they are held
+        self._block = []
+        self._held = []
+        # Set once an unterminated <think> has been passed on; later ones are plain text too
+        self._literal_think = False
+
+    def feed(self, text: str) -> List[Tuple[str, object]]:
+        events = []
+        text, self._tail = self._tail + text, ""
+        pos = 0
+        while pos < len(text):
+            index = text.find("<", pos)
+            if index == -1:
+                self._emit(events, text[pos:])
+                break
+            tags = self._tags()
+            for tag, state in tags:
+                if text.startswith(tag, index):
+                    self._emit(events, text[pos:index])
+                    self._switch(events, state)
+                    pos = index + len(tag)
+                    break
+            else:
+                rest = text[index:]
+                if any(tag.startswith(rest) for tag, _ in tags):
+                    # Could still become a tag; decide once more text arrives
+                    self._emit(events, text[pos:index])
+                    self._tail = rest
+                    break
+                self._emit(events, text[pos:index + 1])
+                pos = index + 1
+        return events
+
+    def close(self) -> List[Tuple[str, object]]:
+        """Ends the stream; an unterminated <tool_call> or unstreamed <think> is passed on as content."""
+        events = []
+        tail, self._tail = self._tail, ""
+        if self.state == TOOL_CALL:
+            self.state = CONTENT
+            self._emit(events, TOOL_OPEN + "".join(self._call) + tail)
+            self._call = []
+        elif self.state == THINKING and (self.hold_thinking or not self.enable_think):
+            # The block is reply text after all; tool calls in it still count
+            self.state = CONTENT
+            self._literal_think = True
+            block, self._block, self._held = "".join(self._block) + tail, [], []
+            self._emit(events, THINK_OPEN)
+            events.extend(self.feed(block))
+            events.extend(self.close())
+        else:
+            self._emit(events, tail)
+        return events
+
+    def _tags(self):
+        if self._literal_think and self.state == CONTENT:
+            return ((TOOL_OPEN, TOOL_CALL),)
+        return _TAGS[self.state]
+
+    def _switch(self, events, state):
+        if self.state == TOOL_CALL:
+            body, self._call = "".join(self._call), []
+            call = _parse_call(body)
+            self.state = CONTENT
+            if call is None:
+                self._emit(events, TOOL_OPEN + body + TOOL_CLOSE)
+            else:
+                self.tool_calls += 1
+                events.append((TOOL_CALL, call))
+        elif self.state == THINKING:
+            events.extend(self._held)
+            self._block, self._held = [], []
+            self._space[THINKING] = ""
+            if self._started[THINKING]:
+                # Only blocks with text are separated from the next one
+                self._think_blocks += 1
+            self._started[THINKING] = False
+        self.state = state
+
+    def _emit(self, events, text):
+        if not text:
+            return
+        kind = self.state
+        if kind == TOOL_CALL:
+            self._call.append(text)
+            return
+        if kind == THINKING:
+            self._block.append(text)
+            if not self.enable_think:
+                return
+            if self.hold_thinking:
+                events = self._held
+        if not self._started[kind]:
+            text = text.lstrip()
+            if not text:
+                return
+            if kind == THINKING and self._think_blocks:
+                text = "\n" + text
+            self._started[kind] = True
+        body = text.rstrip()
+        if not body:
+            self._space[kind] += text
+            return
+        body, self._space[kind] = self._space[kind] + body, text[len(body):]
+        if events and events[-1][0] == kind:
+            events[-1] = (kind, events[-1][1] + body)
+        else:
+            events.append((kind, body))
+
+
+def _parse_call(body: str):
+    try:
+        call = json.loads(body.strip())
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(call, dict):
+        return None
+    arguments = call.get("arguments", {})
+    if isinstance(arguments, str):
+        # Some models encode the arguments object as a JSON string, OpenAI style
+        try:
+            arguments = json.loads(arguments)
+        except json.JSONDecodeError:
+            pass
+    return {"name": call.get("name", ""), "arguments": arguments}
+
+
+async def parse_stream(tokens, enable_think: bool = True, parser: StreamParser = None):
+    """Runs an async token stream through a StreamParser, yielding its events."""
+    parser = parser or StreamParser(enable_think)
+    try:
+        async for token in tokens:
+            for event in parser.feed(token):
+                yield event
+    finally:
+        # A client going away closes this generator; pass that on to the source
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+    for event in parser.close():
+        yield event
+
+
+def parse_text(text: str, enable_think: bool = True) -> Tuple[str, str, List[Dict]]:
+    """Parses a complete output; returns (content, thinking, tool calls)."""
+    parser = StreamParser(enable_think, hold_thinking=True)
+    content, thinking, tool_calls = [], [], []
+    for kind, value in parser.feed(text) + parser.close():
+        if kind == CONTENT:
+            content.append(value)
+        elif kind == THINKING:
+            thinking.append(value)
+        else:
+            tool_calls.append(value)
+    return "".join(content), "".join(thinking), tool_calls
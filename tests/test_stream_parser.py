@@ -0,0 +1,41 @@
+import unittest
+
+from stream_parser import CONTENT, THINKING, StreamParser, parse_text
+
+
+def stream(text: str, enable_think: bool, size: int = 3) -> list:
+    parser = StreamParser(enable_think)
+    events = []
+    for start in range(0, len(text), size):
+        events += parser.feed(text[start:start + size])
+    return events + parser.close()
+
+
+class UnterminatedThinkTest(unittest.TestCase):
+    """A <think> that never closes stays in the reply, as with the regex parser it replaced."""
+
+    def test_parse_text_keeps_it_as_content(self):
+        for enable_think in (True, False):
+            self.assertEqual(parse_text("Hello <think>half a thought", enable_think),
+                             ("Hello <think>half a thought", "", []))
+
+    def test_stream_without_thinking_flushes_it_as_content(self):
+        events = stream("<think>cut short by max_tokens", enable_think=False)
+        self.assertEqual("".join(value for kind, value in events if kind == CONTENT),
+                         "<think>cut short by max_tokens")
+
+    def test_tool_call_inside_is_still_parsed(self):
+        content, thinking, calls = parse_text('<think>x <tool_call>{"name": "f", "arguments": {}}</tool_call>')
+        self.assertEqual((content, thinking), ("<think>x", ""))
+        self.assertEqual(calls, [{"name": "f", "arguments": {}}])
+
+    def test_closed_blocks_are_unchanged(self):
+        self.assertEqual(parse_text("<think> a </think><think></think><think>b</think> reply "),
+                         ("reply", "a\nb", []))
+        events = stream("<think>a</think>reply", enable_think=True)
+        self.assertEqual(events[0], (THINKING, "a"))
+        self.assertEqual("".join(value for kind, value in events[1:] if kind == CONTENT), "reply")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+TOOL_PROMPT = (
+    "You are a helpful assistant.\n\n"
+    "# Tools\n"
+    "You may call one or more functions to assist with the user query.\n"
+    "You are provided with function signatures within <tools></tools> XML tags:\n"
+    "<tools>\n"
+    "{schemas}\n"
+    "</tools>\n"
+    "For each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\n"
+    "<tool_call>\n"
+    '{{"name": "function_name", "arguments": {{"arg_name": "value"}}}}\n'
+    "</tool_call>"
+)
+
+
+class ToolSet(object):
+    """A registered set of function tools and the system prompt block rendered for it."""
+
+    def __init__(self, key: str, schemas: List[Dict]):
+        self.key = key
+        self.schemas = schemas
+        self.block = TOOL_PROMPT.format(schemas=json.dumps(schemas, indent=2))
+        self.uses = 0
+
+
+class ToolRegistry(object):
+    """
+    Tool sets seen by the chat endpoints, keyed by a hash of their schemas.
+
+    OpenAI/Ollama ({"type": "function", "function": {...}}) and Anthropic
+    ({"name", "description", "input_schema"}) tools are normalized to the same
+    schema first, so one set sent through any API maps to one entry. The
+    rendered block is byte-identical on every request, so the prompt that
+    carries it keeps matching the KV session and the prompt cache library.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(tools: List[Dict]) -> List[Dict]:
+        schemas = []
+        for tool in tools or []:
+            if not isinstance(tool, dict):
+                continue
+            if "input_schema" in tool:
+                # Anthropic tool; server tools (web_search, ...) have no schema and are skipped
+                schema = {"name": tool.get("name", ""), "description": tool.get("description", ""),
+                          "parameters": tool["input_schema"]}
+            else:
+                schema = tool.get("function", tool)
+            if schema.get("name"):
+                schemas.append(schema)
+        return schemas
+
+    def register(self, tools: List[Dict]) -> Optional[ToolSet]:
+        schemas = self.normalize(tools)
+        if not schemas:
+            return None
+        key = hashlib.sha256(json.dumps(schemas, sort_keys=True, separators=(",", ":")).encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            tool_set = self._sets.get(key)
+            if tool_set is None:
+                tool_set = ToolSet(key, schemas)
+                self._sets[key] = tool_set
+                while len(self._sets) > self.max_entries:
+                    self._sets.popitem(last=False)
+            else:
+                self._sets.move_to_end(key)
+            tool_set.uses += 1
+        return tool_set
+
+    def prepare(self, messages: List[Dict], tools: Optional[List[Dict]]) -> Tuple[List[Dict], Optional[ToolSet]]:
+        """
+        Renders tool calls and tool results already in the conversation as text
+        and puts the tool block in front of the system message. Returns the new
+        messages and the tool set (None without tools).
+        """
+        messages = render_tool_messages(messages)
+        tool_set = self.register(tools) if tools else None
+        if tool_set is None:
+            return messages, None
+        new_messages = []
+        has_system = False
+        for msg in messages:
+            if msg.get("role") == "system" and not has_system:
+                new_messages.append({"role": "system", "content": tool_set.block + "\n" + str(msg.get("content", ""))})
+                has_system = True
+            else:
+                new_messages.append(msg)
+        if not has_system:
+            new_messages.insert(0, {"role": "system", "content": tool_set.block})
+        return new_messages, tool_set
+
+    @staticmethod
+    def breakpoint(messages: List[Dict], tool_set: Optional[ToolSet]) -> Optional[int]:
+        """Index of the system message carrying the tool block, for plan_session(cache_breakpoint=...)."""
+        if tool_set is None:
+            return None
+        return next((i for i, msg in enumerate(messages) if msg.get("role") == "system"), None)
+
+    def stats(self) -> dict:
+        return {"tool_sets": len(self._sets), "uses": sum(s.uses for s in self._sets.values())}
+
+
+def tool_call_text(name: str, arguments) -> str:
+    if isinstance(arguments, str):
+        try:
+            arguments = json.loads(arguments)
+        except json.JSONDecodeError:
+            pass
+    return "<tool_call>\n" + json.dumps({"name": name, "arguments": arguments}) + "\n</tool_call>"
+
+
+def tool_response_text(content) -> str:
+    if isinstance(content, list):
+        content = "".join(b.get("text", "") for b in content if isinstance(b, dict) and b.get("type") == "text")
+    elif not isinstance(content, str):
+        content = json.dumps(content)
+    return "<tool_response>\n" + content + "\n</tool_response>"
+
+
+def render_tool_messages(messages: List[Dict]) -> List[Dict]:
+    """
+    Turns OpenAI/Ollama tool traffic into the text the model produced and expects:
+    assistant tool_calls become <tool_call> blocks, "tool" messages become a
+    user turn with a <tool_response> block.
+    """
+    rendered = []
+    for msg in messages:
+        if msg.get("role") == "assistant" and msg.get("tool_calls"):
+            parts = [msg["content"]] if isinstance(msg.get("content"), str) and msg["content"] else []
+            for call in msg["tool_calls"]:
+                function = call.get("function", call)
+                parts.append(tool_call_text(function.get("name", ""), function.get("arguments", {})))
+            rendered.append({"role": "assistant", "content": "\n".join(parts)})
+        elif msg.get("role") == "tool":
+            rendered.append({"role": "user", "content": tool_response_text(msg.get("content", ""))})
+        else:
+            rendered.append(msg)
+    return rendered
+
+
+tool_registry = ToolRegistry()
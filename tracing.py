@@ -0,0 +1,195 @@
+import contextvars
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+enabled = False
+# Traces at least this long are returned by recent(); see GET /debug/traces
+slow_ms = 1000.0
+
+_current = contextvars.ContextVar("rkllm_trace", default=None)
+
+
+class Trace(object):
+    """
+    Phases of one HTTP request as (name, start, end) spans on the monotonic
+    clock. The trace travels with the request's asyncio context (see
+    current()), so routers, the scheduler and get_RKLLM_output add their spans
+    without it being passed around.
+    """
+
+    def __init__(self, request_id: str, endpoint: str):
+        self.id = request_id
+        self.endpoint = endpoint
+        self.status = None
+        self.start_ns = time.time_ns()
+        self.start = time.monotonic()
+        self.end = None
+        self.spans = []
+        self.attributes = {}
+
+    def span(self, name: str, start: Optional[float], end: Optional[float] = None, **attributes):
+        if start is None:
+            return
+        self.spans.append((name, start, end if end is not None else time.monotonic(), attributes))
+
+    def finish(self, status: int = None):
+        if self.end is not None:
+            return
+        self.end = time.monotonic()
+        if status is not None:
+            self.status = status
+        traces.add(self)
+        if exporter is not None:
+            exporter.put(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end if self.end is not None else time.monotonic()) - self.start) * 1000.0
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id, "endpoint": self.endpoint, "status": self.status, "start_unix_ns": self.start_ns,
+            "duration_ms": round(self.duration_ms, 3), "attributes": self.attributes,
+            "spans": [{"name": name, "offset_ms": round((start - self.start) * 1000.0, 3),
+                       "duration_ms": round((end - start) * 1000.0, 3), **attributes}
+                      for name, start, end, attributes in self.spans],
+        }
+
+    def to_otlp(self) -> dict:
+        """The trace as an OTLP/JSON ExportTraceServiceRequest, one root span plus one child per phase."""
+        trace_id = uuid.uuid5(uuid.NAMESPACE_OID, self.id).hex
+        root_id = trace_id[:16]
+
+        def unix_ns(t: float) -> str:
+            return str(self.start_ns + int((t - self.start) * 1e9))
+
+        def attrs(values: dict) -> list:
+            return [{"key": k, "value": {"stringValue": str(v)}} for k, v in values.items()]
+
+        spans = [{"traceId": trace_id, "spanId": root_id, "name": self.endpoint, "kind": 2,
+                  "startTimeUnixNano": unix_ns(self.start), "endTimeUnixNano": unix_ns(self.end or self.start),
+                  "attributes": attrs({"rkllm.request_id": self.id, "http.status_code": self.status, **self.attributes})}]
+        for i, (name, start, end, attributes) in enumerate(self.spans):
+            spans.append({"traceId": trace_id, "spanId": f"{i + 1:016x}", "parentSpanId": root_id, "name": name,
+                          "kind": 1, "startTimeUnixNano": unix_ns(start), "endTimeUnixNano": unix_ns(end),
+                          "attributes": attrs(attributes)})
+        return {"resourceSpans": [{"resource": {"attributes": attrs({"service.name": "rkllm-api-server"})},
+                                   "scopeSpans": [{"scope": {"name": "rkllm"}, "spans": spans}]}]}
+
+
+class TraceBuffer(object):
+    """
+    Fixed-size ring of finished traces. Writers claim a slot with next() on an
+    itertools.count, which is atomic, so recording needs no lock; a reader may
+    see a slot being overwritten and just gets the newer trace.
+    """
+
+    def __init__(self, size: int = 256):
+        self.resize(size)
+
+    def resize(self, size: int):
+        self._slots = [None] * max(1, size)
+        self._next = itertools.count()
+
+    def add(self, trace: Trace):
+        self._slots[next(self._next) % len(self._slots)] = trace
+
+    def recent(self, min_ms: float = 0.0, limit: int = 20) -> List[Trace]:
+        found = [t for t in list(self._slots) if t is not None and t.duration_ms >= min_ms]
+        found.sort(key=lambda t: t.duration_ms, reverse=True)
+        return found[:limit]
+
+
+class TraceExporter(object):
+    """Appends finished traces to a file from a background thread, as JSON lines or OTLP/JSON lines."""
+
+    def __init__(self, path: str, fmt: str = "jsonl"):
+        self.path = path
+        self.format = fmt
+        self._queue = queue.SimpleQueue()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._write_loop, name="rkllm-trace-export", daemon=True).start()
+
+    def put(self, trace: Trace):
+        self._queue.put(trace)
+
+    def _write_loop(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                trace = self._queue.get()
+                record = trace.to_otlp() if self.format == "otlp" else trace.to_dict()
+                f.write(json.dumps(record) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+
+traces = TraceBuffer()
+exporter = None
+
+
+def configure(buffer_size: int = 256, slow: float = 1000.0, export_path: str = None, export_format: str = "jsonl"):
+    global enabled, slow_ms, exporter
+    enabled = True
+    slow_ms = slow
+    traces.resize(buffer_size)
+    exporter = TraceExporter(export_path, export_format) if export_path else None
+
+
+def start(request_id: str, endpoint: str) -> Trace:
+    """Opens the trace of a request and makes it current for everything the request runs."""
+    trace = Trace(request_id or uuid.uuid4().hex[:16], endpoint)
+    _current.set(trace)
+    return trace
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def span(name: str, start: Optional[float], end: Optional[float] = None, **attributes):
+    """Adds a span with known timestamps to the current trace; a no-op without one."""
+    trace = _current.get()
+    if trace is not None:
+        trace.span(name, start, end, **attributes)
+
+
+class _Phase(object):
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.span(self.name, self.start)
+        return False
+
+
+class _NoPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name: str):
+    """`with tracing.phase("name"):` times a block into the current trace; shares one no-op object when off."""
+    trace = _current.get()
+    return _Phase(trace, name) if trace is not None else _NO_PHASE
@@ -1,63 +1,17 @@
-import re
-import base64
-import tempfile
-import os
-import uuid
+from chat_template import chat_templates
 
 
-def apply_chat_template(messages, thinking=True):
+def apply_chat_template(messages, thinking=True, add_generation_prompt=True):
     """
-    Applies the ChatML format, compatible with most models including Qwen.
+    Renders messages with the active chat template (ChatML unless configured, see chat_template.py).
     Now supports Multimodal (Vision) payload parsing.
+    Without the generation prompt the result is a reusable prefix of any longer conversation.
     """
-    im_start = "<|im_start|>"
-    im_end = "<|im_end|>"
+    return chat_templates.render(messages, thinking=thinking, add_generation_prompt=add_generation_prompt).prompt
 
-    prompt = ""
 
-    for msg in messages:
-        role = msg['role']
-        content = msg['content']
-        text_content = ""
-
-        # --- Multimodal / Vision Parsing ---
-        if isinstance(content, list):
-            for item in content:
-                if item.get("type") == "text":
-                    text_content += item.get("text", "")
-                elif item.get("type") == "image_url":
-                    img_url = item["image_url"]["url"]
-                    if img_url.startswith("data:image"):
-                        # Decode Base64 and save to temp file
-                        header, encoded = img_url.split(",", 1)
-                        img_data = base64.b64decode(encoded)
-                        ext = "jpg" if "jpeg" in header or "jpg" in header else "png"
-                        tmp_path = os.path.join(tempfile.gettempdir(), f"rkllm_vis_{uuid.uuid4().hex}.{ext}")
-                        with open(tmp_path, "wb") as f:
-                            f.write(img_data)
-                        text_content = f"<image>{tmp_path}</image>\n" + text_content
-                    else:
-                        # Standard URL or local file path
-                        text_content = f"<image>{img_url}</image>\n" + text_content
-        else:
-            text_content = str(content)
-        # -----------------------------------
-
-        # Remove chain-of-thought content if we don't want the model to see previous thought processes
-        text_content = re.sub(r'<think>.*?</think>', '', text_content, flags=re.DOTALL)
-
-        if thinking:
-            prompt += f"{im_start}{role}\n{text_content}{im_end}\n"
-        else:
-            prompt += f"{im_start}{role}\n{text_content} /nothink{im_end}\n"
-
-    # Append the assistant start tag to prompt the model to generate content
-    prompt += f"{im_start}assistant\n"
-
-    return prompt
-
-
-def make_llm_response(llm_output: str) -> dict:
+def make_llm_response(llm_output: str, finish_reason: str = "stop", completion_tokens: int = 0,
+                      reasoning_content: str = None, tool_calls: list = None, prompt_tokens: int = 0) -> dict:
     """
     Defines the standard OpenAI-compatible structure for the returned response.
     """
@@ -74,13 +28,20 @@ def make_llm_response(llm_output: str) -> dict:
                     "content": llm_output,
                 },
                 "logprobs": None,
-                "finish_reason": "stop"
+                "finish_reason": finish_reason
             }
         ],
         "usage": {
-            "prompt_tokens": 0,
-            "completion_tokens": 0,
-            "total_tokens": 0
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
         }
     }
+    message = rkllm_responses["choices"][0]["message"]
+    if reasoning_content:
+        message["reasoning_content"] = reasoning_content
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+        if not llm_output:
+            message["content"] = None
     return rkllm_responses
\ No newline at end of file
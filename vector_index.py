@@ -0,0 +1,352 @@
+import json
+import os
+import re
+import shutil
+import threading
+from typing import List, Dict, Optional
+
+import numpy as np
+
+METRICS = ("cosine", "dot")
+
+
+class VectorShapeError(ValueError):
+    """Vectors that cannot be stored or searched at all: missing, empty, or not all of one length."""
+
+
+def _as_matrix(vectors: List[np.ndarray], count: int) -> np.ndarray:
+    if len(vectors) != count:
+        raise VectorShapeError(f"Got {len(vectors)} vectors for {count} documents")
+    if not vectors:
+        raise VectorShapeError("No vectors given")
+    rows = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+    if any(row.ndim != 1 or row.size == 0 for row in rows):
+        raise VectorShapeError("Every vector must be a non-empty 1-d array (did embedding fail?)")
+    if len({row.shape[0] for row in rows}) > 1:
+        raise VectorShapeError("Vectors in one upsert differ in length")
+    return np.stack(rows)
+
+
+class IVFIndex(object):
+    """
+    Inverted-file approximate index: rows are bucketed by their nearest k-means
+    centroid, and a query only scans the buckets of its `nprobe` best centroids.
+    Rows added after training are kept in an exhaustively scanned tail.
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, bounds: np.ndarray, trained_rows: int):
+        self.centroids = centroids
+        self.order = order
+        self.bounds = bounds
+        self.trained_rows = trained_rows
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, iterations: int = 8, sample_size: int = 50000, seed: int = 0):
+        n = matrix.shape[0]
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = matrix[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))]
+        centroids = np.array(sample[rng.choice(sample.shape[0], size=nlist, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)[:, None]
+            centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        assign = np.concatenate([np.argmax(matrix[i:i + 65536] @ centroids.T, axis=1) for i in range(0, n, 65536)])
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        return cls(centroids.astype(np.float32), order, bounds, n)
+
+    def candidates(self, query: np.ndarray, nprobe: int, total_rows: int) -> np.ndarray:
+        nprobe = min(nprobe, self.centroids.shape[0])
+        best = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        buckets = [self.order[self.bounds[c]:self.bounds[c + 1]] for c in best]
+        buckets.append(np.arange(self.trained_rows, total_rows))
+        return np.concatenate(buckets)
+
+    def save(self, path: str):
+        np.savez(path, centroids=self.centroids, order=self.order, bounds=self.bounds,
+                 trained_rows=np.array(self.trained_rows))
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(data["centroids"], data["order"], data["bounds"], int(data["trained_rows"]))
+
+
+class Collection(object):
+    """
+    A named set of (id, text, metadata, vector) documents.
+
+    On disk a collection is `meta.json`, an append-only `vectors.f32` matrix
+    read through a memory map, and an append-only `log.jsonl` of puts and
+    deletes, so loading is a log replay plus an mmap. Upserting an existing id
+    appends a new row and tombstones the old one; `compact` drops dead rows.
+    Cosine collections store unit vectors so both metrics are a dot product.
+    """
+
+    IVF_THRESHOLD = 20000
+
+    def __init__(self, name: str, directory: Optional[str] = None, metric: str = "cosine", dim: int = None):
+        self.name = name
+        self.directory = directory
+        self.metric = metric
+        self.dim = dim
+        self.ids = []
+        self.records = []
+        self.rows = {}
+        # alive[row] is False for tombstoned rows; grown geometrically, only the first len(ids) count
+        self._alive = np.zeros(0, dtype=bool)
+        self._matrix = np.zeros((0, dim or 0), dtype=np.float32)
+        self._ivf = None
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.rows)
+
+    def info(self) -> dict:
+        return {"name": self.name, "metric": self.metric, "dim": self.dim, "count": self.count,
+                "index": "ivf" if self.count >= self.IVF_THRESHOLD else "flat"}
+
+    # --- Persistence ---
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @classmethod
+    def load(cls, name: str, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        collection = cls(name, directory, meta["metric"], meta.get("dim"))
+        log_path = collection._path("log.jsonl")
+        vectors_path = collection._path("vectors.f32")
+        row_size = 4 * (collection.dim or 0)
+        vector_rows = os.path.getsize(vectors_path) // row_size if row_size and os.path.exists(vectors_path) else 0
+        # Replay up to the first torn line or the first put without a vector row; a crash
+        # between the two appends of an upsert leaves the files out of step, so both are
+        # cut back to that point before anything is appended again
+        consistent = 0
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        entry = None
+                    if entry is None or (entry["op"] == "put" and len(collection.ids) >= vector_rows):
+                        break
+                    if entry["op"] == "put":
+                        collection._put_record(entry["id"], entry.get("text", ""), entry.get("metadata"))
+                    else:
+                        collection._delete_record(entry["id"])
+                    consistent += len(line)
+            with open(log_path, "ab") as f:
+                f.truncate(consistent)
+        if row_size and os.path.exists(vectors_path):
+            with open(vectors_path, "ab") as f:
+                f.truncate(len(collection.ids) * row_size)
+        collection._remap()
+        ivf_path = collection._path("ivf.npz")
+        if os.path.exists(ivf_path):
+            collection._ivf = IVFIndex.load(ivf_path)
+        return collection
+
+    def _save_meta(self):
+        if self.directory:
+            with open(self._path("meta.json"), "w") as f:
+                json.dump({"metric": self.metric, "dim": self.dim}, f)
+
+    def _remap(self):
+        rows = len(self.ids)
+        if self.directory and rows and self.dim:
+            self._matrix = np.memmap(self._path("vectors.f32"), dtype="<f4", mode="r", shape=(rows, self.dim))
+
+    # --- Mutation ---
+
+    def _put_record(self, doc_id: str, text: str, metadata):
+        old = self.rows.get(doc_id)
+        if old is not None:
+            self.ids[old] = None
+            self.records[old] = None
+            self._alive[old] = False
+        row = len(self.ids)
+        if row >= len(self._alive):
+            grown = np.zeros(max(1024, 2 * len(self._alive)), dtype=bool)
+            grown[:len(self._alive)] = self._alive
+            self._alive = grown
+        self._alive[row] = True
+        self.rows[doc_id] = row
+        self.ids.append(doc_id)
+        self.records.append({"text": text, "metadata": metadata})
+
+    def _delete_record(self, doc_id: str) -> bool:
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return False
+        self.ids[row] = None
+        self.records[row] = None
+        self._alive[row] = False
+        return True
+
+    def upsert(self, documents: List[Dict], vectors: List[np.ndarray]):
+        matrix = _as_matrix(vectors, len(documents))
+        if self.metric == "cosine":
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            # The first upsert fixes the dimension; concurrent first upserts must not both set it
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._matrix = np.zeros((0, self.dim), dtype=np.float32)
+                self._save_meta()
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Collection '{self.name}' holds {self.dim}-d vectors, got {matrix.shape[1]}-d")
+            for doc in documents:
+                self._put_record(str(doc["id"]), doc.get("text", ""), doc.get("metadata"))
+            if self.directory:
+                with open(self._path("vectors.f32"), "ab") as f:
+                    f.write(matrix.astype("<f4", copy=False).tobytes())
+                with open(self._path("log.jsonl"), "a") as f:
+                    for doc in documents:
+                        f.write(json.dumps({"op": "put", "id": str(doc["id"]), "text": doc.get("text", ""),
+                                            "metadata": doc.get("metadata")}) + "\n")
+                self._remap()
+            else:
+                self._matrix = np.concatenate([self._matrix, matrix])
+
+    def delete(self, ids: List[str]) -> int:
+        with self._lock:
+            deleted = [doc_id for doc_id in ids if self._delete_record(str(doc_id))]
+            if self.directory and deleted:
+                with open(self._path("log.jsonl"), "a") as f:
+                    for doc_id in deleted:
+                        f.write(json.dumps({"op": "del", "id": str(doc_id)}) + "\n")
+        if len(self.ids) > 1000 and self.count < len(self.ids) // 2:
+            self.compact()
+        return len(deleted)
+
+    def compact(self):
+        """Rewrites the collection without tombstoned rows."""
+        with self._lock:
+            live = np.array([i for i, doc_id in enumerate(self.ids) if doc_id is not None], dtype=np.int64)
+            matrix = np.array(self._matrix[live], dtype=np.float32) if len(live) else np.zeros((0, self.dim or 0), np.float32)
+            ids = [self.ids[i] for i in live]
+            records = [self.records[i] for i in live]
+            self.ids, self.records = ids, records
+            self.rows = {doc_id: i for i, doc_id in enumerate(ids)}
+            self._alive = np.ones(len(ids), dtype=bool)
+            self._ivf = None
+            if self.directory:
+                self._matrix = None
+                with open(self._path("vectors.f32.tmp"), "wb") as f:
+                    f.write(matrix.astype("<f4", copy=False).tobytes())
+                with open(self._path("log.jsonl.tmp"), "w") as f:
+                    for doc_id, record in zip(ids, records):
+                        f.write(json.dumps({"op": "put", "id": doc_id, **record}) + "\n")
+                os.replace(self._path("vectors.f32.tmp"), self._path("vectors.f32"))
+                os.replace(self._path("log.jsonl.tmp"), self._path("log.jsonl"))
+                if os.path.exists(self._path("ivf.npz")):
+                    os.remove(self._path("ivf.npz"))
+                self._remap()
+            else:
+                self._matrix = matrix
+
+    # --- Query ---
+
+    def _index(self) -> Optional[IVFIndex]:
+        rows = len(self.ids)
+        if self.count < self.IVF_THRESHOLD:
+            return None
+        if self._ivf is None or rows > 2 * self._ivf.trained_rows:
+            print(f"[Info] Training IVF index for collection '{self.name}' ({rows} rows)")
+            unit = self._matrix
+            if self.metric == "dot":
+                unit = self._matrix / np.maximum(np.linalg.norm(self._matrix, axis=1, keepdims=True), 1e-12)
+            self._ivf = IVFIndex.train(np.asarray(unit, dtype=np.float32))
+            if self.directory:
+                self._ivf.save(self._path("ivf.npz"))
+        return self._ivf
+
+    def search(self, query: np.ndarray, top_k: int = 10, nprobe: int = 8) -> List[Dict]:
+        query = np.asarray(query, dtype=np.float32)
+        if query.ndim != 1 or query.size == 0:
+            raise VectorShapeError("The query vector must be a non-empty 1-d array")
+        if self.dim is None or self.count == 0:
+            return []
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Collection '{self.name}' holds {self.dim}-d vectors, got a {query.shape[0]}-d query")
+        if self.metric == "cosine":
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        with self._lock:
+            ids, records, matrix = self.ids, self.records, self._matrix
+            index = self._index()
+            rows = index.candidates(query, nprobe, len(ids)) if index is not None else np.arange(len(ids))
+            scores = matrix[rows] @ query if index is not None else matrix @ query
+            alive = self._alive[rows] if index is not None else self._alive[:len(ids)].copy()
+
+        scores = np.where(alive, scores, -np.inf)
+        k = min(top_k, int(alive.sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [{"id": ids[rows[i]], "score": float(scores[i]), "text": records[rows[i]]["text"],
+                 "metadata": records[rows[i]]["metadata"]} for i in best]
+
+
+class VectorIndex(object):
+    """Registry of collections, persisted under one root directory when configured."""
+
+    NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+    def __init__(self):
+        self.directory = None
+        self.collections = {}
+
+    def configure(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.collections = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.exists(os.path.join(path, "meta.json")):
+                try:
+                    self.collections[name] = Collection.load(name, path)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"[Warning] Skipping unreadable collection '{name}': {e}")
+        print(f"[Info] Loaded {len(self.collections)} vector collection(s) from {directory}")
+
+    def get(self, name: str) -> Optional[Collection]:
+        return self.collections.get(name)
+
+    def create(self, name: str, metric: str = "cosine") -> Collection:
+        if not self.NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid collection name: {name!r}")
+        if metric not in METRICS:
+            raise ValueError(f"Unsupported metric: {metric!r}")
+        existing = self.collections.get(name)
+        if existing is not None:
+            return existing
+        directory = os.path.join(self.directory, name) if self.directory else None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        collection = Collection(name, directory, metric)
+        collection._save_meta()
+        self.collections[name] = collection
+        return collection
+
+    def drop(self, name: str) -> bool:
+        collection = self.collections.pop(name, None)
+        if collection is None:
+            return False
+        if collection.directory:
+            shutil.rmtree(collection.directory, ignore_errors=True)
+        return True
+
+
+vector_index = VectorIndex()
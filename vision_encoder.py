@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+from chat_template import image_path
+import tracing
+
+_IMAGE_TAG = re.compile(r"<image>(.*?)</image>\n?", re.DOTALL)
+
+# Placeholder the runtime replaces with one image's embedding in a multimodal prompt
+IMAGE_PLACEHOLDER = "<image>"
+
+# Colour used to pad images to a square before resizing, as in the RKLLM multimodal demo
+PAD_COLOR = (127, 127, 127)
+
+NPU_CORES = {"auto": "NPU_CORE_AUTO", "0": "NPU_CORE_0", "1": "NPU_CORE_1", "2": "NPU_CORE_2",
+             "0_1": "NPU_CORE_0_1", "0_1_2": "NPU_CORE_0_1_2"}
+
+
+class ImageError(ValueError):
+    """An image the encoder cannot read: not a local file (or inline data), or not a picture."""
+
+
+def _pillow():
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Pillow is required to read images for the vision encoder "
+                           "(uv sync --extra vision, or pip install pillow)")
+    return Image
+
+
+class VisionEncoder(object):
+    """
+    Runs the vision encoder (.rknn, through rknn-toolkit-lite2) as a pipeline
+    stage in front of the LLM. Images are encoded on a thread of their own, so
+    a request can encode its images while another one is still decoding, and
+    the resulting embeddings are kept in an LRU keyed by image digest and
+    encoder resolution. A picture resent on every turn of a chat, or shared by
+    several requests, goes through the encoder once.
+    """
+
+    def __init__(self):
+        self.model_path = None
+        self.image_size = 448
+        self.max_entries = 32
+        self._rknn = None
+        self._executor = None
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._rknn is not None
+
+    def configure(self, model_path: str, image_size: int = 448, max_entries: int = 32, npu_core: str = "auto"):
+        from rknnlite.api import RKNNLite
+
+        rknn = RKNNLite()
+        if rknn.load_rknn(model_path) != 0:
+            raise RuntimeError(f"Failed to load vision encoder: {model_path}")
+        if rknn.init_runtime(core_mask=getattr(RKNNLite, NPU_CORES[npu_core])) != 0:
+            raise RuntimeError(f"Failed to initialise vision encoder runtime: {model_path}")
+        self._rknn = rknn
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="rkllm-vision")
+        self.model_path = model_path
+        self.image_size = image_size
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+
+    def release(self):
+        if self._rknn is None:
+            return
+        self._executor.shutdown(wait=True)
+        self._rknn.release()
+        self._rknn = None
+
+    def _digest(self, path: str) -> str:
+        # Image store files are already named by the SHA-256 of their content
+        name = os.path.basename(path).partition(".")[0]
+        if len(name) == 64 and all(c in "0123456789abcdef" for c in name):
+            return name
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _load(self, path: str) -> np.ndarray:
+        """Decodes an image into the encoder's uint8 RGB input, padded to a square and resized."""
+        Image = _pillow()
+        with Image.open(path) as img:
+            img = img.convert("RGB")
+            side = max(img.size)
+            square = Image.new("RGB", (side, side), PAD_COLOR)
+            square.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+        square = square.resize((self.image_size, self.image_size), Image.BILINEAR)
+        return np.asarray(square, dtype=np.uint8)[np.newaxis]
+
+    def _encode(self, key: Tuple, path: str) -> np.ndarray:
+        try:
+            try:
+                image = self._load(path)
+            except (OSError, ValueError) as e:
+                raise ImageError(f"Cannot decode image {os.path.basename(path)}: {e}")
+            outputs = self._rknn.inference(inputs=[image], data_format="nhwc")
+            embedding = np.ascontiguousarray(outputs[0], dtype=np.float32)
+            embedding = embedding.reshape(-1, embedding.shape[-1])
+            with self._lock:
+                self._memory[key] = embedding
+                while len(self._memory) > self.max_entries:
+                    self._memory.popitem(last=False)
+            return embedding
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def encode(self, path: str) -> concurrent.futures.Future:
+        """Embedding of one image, [n_image_tokens, embed_dim] float32; cached or queued on the encoder thread."""
+        if not os.path.isfile(path):
+            raise ImageError(f"Image is not a local file or inline data: {path[:200]}")
+        key = (self._digest(path), self.image_size)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self.hits += 1
+                self._memory.move_to_end(key)
+                future = concurrent.futures.Future()
+                future.set_result(embedding)
+                return future
+            future = self._pending.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+            self.misses += 1
+            future = self._executor.submit(self._encode, key, path)
+            self._pending[key] = future
+            return future
+
+    @staticmethod
+    def _paths(messages: List[Dict]) -> List[str]:
+        paths = []
+        for msg in messages:
+            content = msg.get("content")
+            if not isinstance(content, list):
+                continue
+            for item in content:
+                path = image_path(item) if isinstance(item, dict) else None
+                if path:
+                    paths.append(path)
+        return paths
+
+    def check(self, messages: List[Dict]):
+        """
+        Raises ImageError for an image of a chat request that the encoder could
+        not read, so the request fails with a 400 before it queues for the NPU.
+        Remote URLs are not fetched; only local files and inline data are read.
+        """
+        if not self.enabled:
+            return
+        for path in self._paths(messages):
+            if not os.path.isfile(path):
+                raise ImageError(f"Image is not a local file or inline data: {path[:200]}")
+            try:
+                # Parses the header only; pixels are decoded on the encoder thread
+                with _pillow().open(path):
+                    pass
+            except (OSError, ValueError) as e:
+                raise ImageError(f"Cannot decode image {os.path.basename(path)}: {e}")
+
+    def prefetch(self, messages: List[Dict]):
+        """Starts encoding the images of a chat request without waiting, e.g. while it queues for the NPU."""
+        if not self.enabled:
+            return
+        for path in self._paths(messages):
+            if os.path.isfile(path):
+                try:
+                    self.encode(path)
+                except OSError as e:
+                    print(f"[Warning] Failed to prefetch image {path}: {e}")
+
+    async def encode_prompt(self, prompt: str) -> Tuple[str, Optional[np.ndarray]]:
+        """
+        Replaces every <image>path</image> in a rendered prompt with the runtime's
+        image placeholder and returns the prompt with the images' embeddings
+        stacked in prompt order as [n_image, n_image_tokens, embed_dim], or
+        (prompt, None) when there is nothing to encode.
+        """
+        if not self.enabled or IMAGE_PLACEHOLDER not in prompt:
+            return prompt, None
+        paths = _IMAGE_TAG.findall(prompt)
+        if not paths:
+            return prompt, None
+        with tracing.phase("vision_encode"):
+            embeddings = await asyncio.gather(*(asyncio.wrap_future(self.encode(path)) for path in paths))
+        return _IMAGE_TAG.sub(IMAGE_PLACEHOLDER, prompt), np.stack(embeddings)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._memory), "hits": self.hits, "misses": self.misses,
+                "pending": len(self._pending), "image_size": self.image_size}
+
+
+vision_encoder = VisionEncoder()